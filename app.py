@@ -2,7 +2,6 @@
 
 import streamlit as st
 import pandas as pd
-from ortools.sat.python import cp_model
 import calendar
 import datetime
 import os
@@ -10,6 +9,27 @@ import time
 import gspread
 from google.oauth2.service_account import Credentials
 import random
+import json
+import sqlite3
+import collections
+import contextlib
+import functools
+import hashlib
+import hmac
+import threading
+import uuid
+import urllib.parse
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as pads
+import pyarrow.fs as pafs
+import numpy as np
+import concurrent.futures
+import pickle
+import subprocess
+import tempfile
+import sys
+import shift_solver
 
 # =========================================================
 # ⚙️ 設定エリア
@@ -19,7 +39,7 @@ try:
     DEFAULT_ADMIN_PASSWORD = st.secrets["admin_password"]
     DEFAULT_SUPER_ADMIN_ID = "root"
     DEFAULT_SUPER_ADMIN_PASS = st.secrets["super_admin_pass"]
-    URL_REQUEST_DB = st.secrets["sheet_url"]
+    URL_REQUEST_DB = st.secrets["sheet_url"] if "tenants" not in st.secrets else ""
 except FileNotFoundError:
     st.error("⚠️ Secrets情報が見つかりません。Streamlit CloudのSettingsで設定してください。")
     st.stop()
@@ -31,6 +51,41 @@ except KeyError as e:
 # ※ご自身のスプレッドシートURLを設定してください
 URL_REQUEST_DB = "https://docs.google.com/spreadsheets/d/1y7H-9c2EJhpCKoXY6Va_RRx3dfDZoarxlUmQLdXEP6o/edit"
 
+# --- テナント（病院・病棟ごとの設定） ---
+# secrets に [tenants.<ID>] を並べると、1つのプロセスで複数の病院・病棟を扱える（ログイン画面で選択）。
+# テナントごとにスプレッドシート・スーパー管理者パスワード・キャッシュ・データバージョン・ローカル保存先を分け、
+# ソルバーの実行キューだけを全テナントで共有する。[tenants] がなければ上の設定を1テナントとして動かす
+#   [tenants.east]
+#   label = "東病棟"
+#   sheet_url = "https://docs.google.com/spreadsheets/d/..."
+#   super_admin_pass = "..."          # 省略時は共通の super_admin_pass
+#   feed_secret = "..."               # 配信リンクの鍵。省略時は共通の feed_secret（どちらもなければ配信しない）
+#   public_base_url = "https://..."   # 配信リンクの先頭に付けるアプリの公開URL。省略時は共通の public_base_url
+#   [tenants.east.gcp_service_account] # 省略時は共通のサービスアカウント
+DEFAULT_TENANT = "default"
+
+def _tenant_config(tenant_id, conf):
+    conf = dict(conf)
+    account = dict(conf["gcp_service_account"]) if "gcp_service_account" in conf else None
+    return {"id": tenant_id, "label": str(conf.get("label", tenant_id)), "sheet_url": conf["sheet_url"],
+            "super_admin_pass": str(conf.get("super_admin_pass", DEFAULT_SUPER_ADMIN_PASS)),
+            "service_account": account,
+            "feed_secret": str(conf.get("feed_secret", st.secrets.get("feed_secret", ""))),
+            "public_base_url": str(conf.get("public_base_url", st.secrets.get("public_base_url", ""))),
+            # Sheets APIの上限はサービスアカウントごとなので、流量制御も同じ単位で共有する
+            "quota_key": account.get("client_email", tenant_id) if account else ""}
+
+try:
+    TENANTS = {str(tid): _tenant_config(str(tid), conf) for tid, conf in st.secrets.get("tenants", {}).items()}
+except KeyError as e:
+    st.error(f"⚠️ テナントの設定が不足しています: {e}")
+    st.stop()
+if not TENANTS:
+    TENANTS = {DEFAULT_TENANT: {"id": DEFAULT_TENANT, "label": "", "sheet_url": URL_REQUEST_DB,
+                                "super_admin_pass": DEFAULT_SUPER_ADMIN_PASS, "service_account": None, "quota_key": "",
+                                "feed_secret": str(st.secrets.get("feed_secret", "")),
+                                "public_base_url": str(st.secrets.get("public_base_url", ""))}}
+
 # =========================================================
 # 🚀 アプリ初期設定 & セッション初期化
 # =========================================================
@@ -54,6 +109,8 @@ if 'schedule_df' not in st.session_state: st.session_state.schedule_df = None
 if 'system_phase' not in st.session_state: st.session_state.system_phase = "0_通常"
 if 'proc_year' not in st.session_state: st.session_state.proc_year = datetime.date.today().year
 if 'proc_month' not in st.session_state: st.session_state.proc_month = datetime.date.today().month
+if st.session_state.get('tenant_id') not in TENANTS:
+    st.session_state.tenant_id = st.query_params.get("tenant") if st.query_params.get("tenant") in TENANTS else next(iter(TENANTS))
 
 # データキャッシュ
 if 'master_staff' not in st.session_state: st.session_state.master_staff = None
@@ -62,6 +119,19 @@ if 'master_log' not in st.session_state: st.session_state.master_log = None
 if 'req_off_data' not in st.session_state: st.session_state.req_off_data = None
 if 'req_chg_data' not in st.session_state: st.session_state.req_chg_data = None
 if 'daily_reqs' not in st.session_state: st.session_state.daily_reqs = {}
+if 'scenario_runs' not in st.session_state: st.session_state.scenario_runs = []
+if 'solution_pool' not in st.session_state: st.session_state.solution_pool = []
+
+# バックエンド障害時の読み取り専用モード（再実行ごとに判定し直す）
+st.session_state.read_only_mode = False
+
+# このセッションのテナント。プロセス共通のキャッシュは必ずテナントIDをキーに含める
+TENANT_ID = st.session_state.tenant_id
+TENANT = TENANTS[TENANT_ID]
+
+def tenant_dir(base):
+    """ローカル保存先をテナントごとに分ける（従来の1テナント構成では元の場所のまま）"""
+    return base if TENANT_ID == DEFAULT_TENANT else os.path.join("tenants", TENANT_ID, base)
 
 # =========================================================
 # 🛠️ ヘルパー関数 (GSheet操作一元化 + キャッシュ対応)
@@ -70,7 +140,9 @@ def get_gspread_client():
     scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
     creds = None
     try:
-        if "gcp_service_account" in st.secrets:
+        if TENANT['service_account']:
+            creds = Credentials.from_service_account_info(TENANT['service_account'], scopes=scope)
+        elif "gcp_service_account" in st.secrets:
             key_dict = dict(st.secrets["gcp_service_account"])
             creds = Credentials.from_service_account_info(key_dict, scopes=scope)
     except: pass
@@ -82,154 +154,1112 @@ def get_gspread_client():
         return gspread.authorize(creds)
     return None
 
+# --- 処理時間の計測 ---
+# ストレージ呼び出し・ソルバー・集計処理・画面描画の所要時間をプロセス内に保持し、
+# 管理者サイドバーで p50/p95 を確認、JSON Lines で書き出せるようにする
+
+METRICS_WINDOW = 500  # 計測名ごとに保持する直近の件数
+
+class MetricsStore:
+    """計測名ごとに直近の計測値を保持するローリングストア（スレッドセーフ）"""
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self.spans = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, **attrs):
+        rec = {"ts": datetime.datetime.now().isoformat(timespec='milliseconds'), "name": name, "ms": round(seconds * 1000, 2)}
+        rec.update(attrs)
+        with self.lock:
+            self.spans.setdefault(name, collections.deque(maxlen=self.window)).append(rec)
+
+    def clear(self):
+        with self.lock: self.spans.clear()
+
+    def summary(self):
+        """計測名ごとの件数・p50・p95・最大(ms)をDataFrameで返す"""
+        with self.lock:
+            snapshot = {k: [r['ms'] for r in v] for k, v in self.spans.items()}
+        rows = []
+        for name, vals in sorted(snapshot.items()):
+            vals = sorted(vals)
+            pick = lambda q: vals[min(len(vals) - 1, int(round(q * (len(vals) - 1))))]
+            rows.append({"計測名": name, "件数": len(vals), "p50(ms)": pick(0.5), "p95(ms)": pick(0.95), "最大(ms)": vals[-1]})
+        return pd.DataFrame(rows, columns=["計測名", "件数", "p50(ms)", "p95(ms)", "最大(ms)"])
+
+    def to_jsonl(self):
+        with self.lock:
+            recs = sorted((r for v in self.spans.values() for r in v), key=lambda r: r['ts'])
+        return "\n".join(json.dumps(r, ensure_ascii=False, default=str) for r in recs)
+
+@st.cache_resource(show_spinner=False)
+def get_metrics_store():
+    return MetricsStore()
+
+@contextlib.contextmanager
+def timed_span(name, **attrs):
+    """with文で囲んだ処理の所要時間を記録する。yieldした辞書に属性を追加できる"""
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        get_metrics_store().record(name, time.perf_counter() - start, **attrs)
+
+def timed(name):
+    """関数全体の所要時間を記録するデコレータ"""
+    def deco(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return deco
+
+PAYLOAD_SAMPLE_ROWS = 20  # 送受信量の見積もりに使う先頭の行数
+
+def _payload_bytes(obj):
+    """送受信データのおおよその大きさ（先頭 PAYLOAD_SAMPLE_ROWS 行のセルの文字数から全体を見積もる）。
+    計測のためにデータ全体を変換しないよう、行数に比例させて推定する"""
+    if isinstance(obj, dict): obj = obj.get('values', [obj])
+    if not isinstance(obj, list) or not obj: return 0
+    sample = obj[:PAYLOAD_SAMPLE_ROWS]
+    cells = lambda row: row.values() if isinstance(row, dict) else (row if isinstance(row, (list, tuple)) else [row])
+    sampled = sum(len(str(v)) for row in sample for v in cells(row))
+    return sampled * len(obj) // len(sample)
+
+# --- API流量制御 ---
+# Sheets APIの1分あたりの上限に合わせて全ての読み書きをトークンバケットで制御し、
+# 429/5xxの場合はジッター付き指数バックオフで再試行する
+
+SHEETS_QUOTA_PER_MIN = 60   # 1分あたりのリクエスト上限
+WRITE_RESERVE = 5           # 書き込み用に常に残しておくトークン数
+API_MAX_RETRIES = 5
+API_BACKOFF_BASE = 1.0      # 秒
+API_BACKOFF_CAP = 32.0      # 秒
+
+class SheetsRateLimiter:
+    """プロセス共通のトークンバケット（スレッドセーフ、書き込み優先）"""
+
+    def __init__(self, per_minute, write_reserve=WRITE_RESERVE):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.write_reserve = write_reserve
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waiting_writes = 0
+        self.cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, kind="read"):
+        """トークンを1つ取得するまで待つ。読み込みは書き込み待ちがある間は譲る"""
+        is_write = (kind == "write")
+        with self.cond:
+            if is_write: self.waiting_writes += 1
+            try:
+                while True:
+                    self._refill()
+                    need = 1.0 if is_write else 1.0 + self.write_reserve
+                    if self.tokens >= need and (is_write or self.waiting_writes == 0):
+                        self.tokens -= 1.0
+                        return
+                    shortage = max(need - self.tokens, 0.0)
+                    self.cond.wait(timeout=max(shortage / self.rate, 0.05))
+            finally:
+                if is_write:
+                    self.waiting_writes -= 1
+                    self.cond.notify_all()
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter(quota_key=""):
+    """サービスアカウントごとのトークンバケット（同じアカウントを使うテナント同士で共有）"""
+    return SheetsRateLimiter(SHEETS_QUOTA_PER_MIN)
+
+def is_retryable_api_error(e, idempotent=True):
+    """429(レート制限)は再試行対象。5xx(サーバー側エラー)は、サーバー側で反映済みのこともあるので
+    何度実行しても結果が同じ呼び出し（読み込み・範囲を決めた上書き）だけ再試行する"""
+    code = getattr(getattr(e, 'response', None), 'status_code', None)
+    return code == 429 or (idempotent and code is not None and code >= 500)
+
+CONNECT_OPS = {"open_by_url", "worksheet", "add_worksheet"}
+
+def _span_sheet_name(func, args, kwargs):
+    """計測用に呼び出し対象のシート名を求める"""
+    op = func.__name__
+    if op == "open_by_url": return ""
+    if op == "add_worksheet": return kwargs.get('title', "")
+    if op in ("worksheet", "values_get"): return str(args[0]) if args else ""
+    return getattr(getattr(func, '__self__', None), 'title', "")
+
+def call_sheets_api(func, *args, kind="read", idempotent=None, **kwargs):
+    """Sheets APIの呼び出しは全てここを通す（流量制御 + リトライ + 計測）。
+    書き込みは idempotent=True（範囲を決めた上書き・消去）のときだけ 5xx でも再試行し、追記は 429 だけ再試行する"""
+    if idempotent is None: idempotent = kind != "write"
+    op = func.__name__
+    span = "storage.connect" if op in CONNECT_OPS else f"storage.{kind}"
+    limiter = get_rate_limiter(TENANT['quota_key'])
+    with timed_span(span, op=op, sheet=_span_sheet_name(func, args, kwargs), tenant=TENANT_ID) as attrs:
+        wait_start = time.perf_counter()
+        for attempt in range(API_MAX_RETRIES):
+            limiter.acquire(kind)
+            attrs['wait_ms'] = round((time.perf_counter() - wait_start) * 1000, 2)
+            attrs['attempts'] = attempt + 1
+            try:
+                result = func(*args, **kwargs)
+                if kind == "write": attrs['bytes'] = _payload_bytes(kwargs.get('values', args[-1] if args else None))
+                else: attrs['bytes'] = _payload_bytes(result)
+                return result
+            except gspread.exceptions.APIError as e:
+                if not is_retryable_api_error(e, idempotent) or attempt == API_MAX_RETRIES - 1: raise
+                # フルジッター: 同時に失敗したセッションの再試行タイミングを分散させる
+                time.sleep(random.uniform(0, min(API_BACKOFF_CAP, API_BACKOFF_BASE * 2 ** attempt)))
+
+@st.cache_resource(show_spinner=False)
+def get_spreadsheet(tenant_id):
+    """テナントのスプレッドシート本体を開く（プロセス内で使い回す）"""
+    client = get_gspread_client()
+    if not client: raise RuntimeError("認証エラー: secret_key.jsonまたはst.secretsの設定を確認してください")
+    return call_sheets_api(client.open_by_url, TENANTS[tenant_id]['sheet_url'])
+
+@st.cache_resource(show_spinner=False)
+def _worksheet_handles(tenant_id):
+    """接続済みワークシートの使い回し用（シート名 → (Worksheet, 見出し行を確認済みか)）"""
+    return {}
+
+def _ensure_headers(worksheet, headers):
+    """1行目が空なら見出し行を書く（A1からの上書きなので再試行しても重複しない）"""
+    if call_sheets_api(worksheet.row_values, 1): return
+    try:
+        call_sheets_api(worksheet.update, values=[headers], range_name='A1', kind="write", idempotent=True)
+    except TypeError:
+        call_sheets_api(worksheet.update, 'A1', [headers], kind="write", idempotent=True)
+
 def connect_sheet(sheet_name, headers=None):
-    """シートに接続、なければ作成する。リトライ処理付き"""
+    """シートに接続、なければ作成する。リトライ処理付き（接続済みのシートは再利用）。
+    headers を渡したときは、見出し行を確認してから使い回す"""
+    handles = _worksheet_handles(TENANT_ID)
+    worksheet, checked = handles.get(sheet_name, (None, False))
+    if worksheet is not None and (checked or not headers): return worksheet, None
+
     client = get_gspread_client()
     if not client: return None, "認証エラー: secret_key.jsonまたはst.secretsの設定を確認してください"
     
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            spreadsheet = client.open_by_url(URL_REQUEST_DB)
+    try:
+        if worksheet is None:
+            spreadsheet = get_spreadsheet(TENANT_ID)
             try:
-                worksheet = spreadsheet.worksheet(sheet_name)
-                if headers:
-                    first_row = worksheet.row_values(1)
-                    if not first_row: 
-                        worksheet.append_row(headers)
+                worksheet = call_sheets_api(spreadsheet.worksheet, sheet_name)
             except gspread.exceptions.WorksheetNotFound:
-                worksheet = spreadsheet.add_worksheet(title=sheet_name, rows=1000, cols=20)
-                if headers:
-                    worksheet.append_row(headers)
-            return worksheet, None
-        except gspread.exceptions.APIError as e:
-            if "429" in str(e):
-                time.sleep(2 ** attempt)
-                continue
-            else:
-                return None, str(e)
-        except Exception as e:
-            return None, str(e)
-    return None, "API制限により接続できませんでした。しばらく待って再試行してください。"
+                worksheet = call_sheets_api(spreadsheet.add_worksheet, title=sheet_name, rows=1000, cols=20, kind="write")
+        if headers: _ensure_headers(worksheet, headers)
+        # 見出し行の確認が済んでから（または確認不要なら）キャッシュする
+        handles[sheet_name] = (worksheet, checked or bool(headers))
+        return worksheet, None
+    except gspread.exceptions.APIError as e:
+        if is_retryable_api_error(e):
+            return None, "API制限により接続できませんでした。しばらく待って再試行してください。"
+        return None, str(e)
+    except Exception as e:
+        return None, str(e)
+
+# --- データバージョン管理 ---
+# 書き込みのたびにシートごとのバージョン番号を進め、読み込み側は
+# バージョンが変わったシートだけを再ダウンロードする
+
+VERSION_SHEET = "data_version"
+VERSION_HEADERS = ["sheet", "version"]
+VERSION_CHECK_TTL = 5  # バージョン確認の間隔(秒)
+VERSION_BUMP_ATTEMPTS = 3
+# シートごとに書き込む行を固定する（追記しないので、同時に初めて書き込んでも行が重複しない）
+VERSION_ROWS = ["スタッフマスタ", "公休マスタ", "ログ", "draft_schedule", "draft_requirements", "system_config",
+                "希望休", "変更申請", "申請イベント", "申請イベント_アーカイブ", "申請イベント#世代"]
+
+def parse_version_rows(rows):
+    """data_version の行を {シート名: バージョン} にする（同じ名前が複数行あれば最大の値を使う）"""
+    versions = {}
+    for r in rows:
+        if len(r) >= 2 and r[0]:
+            try: versions[r[0]] = max(versions.get(r[0], 0), int(r[1]))
+            except ValueError: pass
+    return versions
+
+@st.cache_resource(show_spinner=False)
+def _last_known_versions(tenant_id):
+    """最後に取得できたバージョン情報（取得失敗時の退避用）"""
+    return {}
+
+@st.cache_data(ttl=VERSION_CHECK_TTL, show_spinner=False)
+def fetch_data_versions(tenant_id):
+    """全シートのバージョン番号を1回の小さな読み込みで取得する"""
+    shared = shared_cache()
+    if shared and not shared.claim_version_check(tenant_id, VERSION_CHECK_TTL):
+        # 直近にほかのレプリカが確認した結果を使う
+        return shared.versions(tenant_id)
+    try:
+        res = call_sheets_api(get_spreadsheet(tenant_id).values_get, f"'{VERSION_SHEET}'!A:B")
+    except gspread.exceptions.APIError as e:
+        # バージョンシート未作成 (範囲指定エラー) の場合は全シート0扱い
+        if getattr(e.response, 'status_code', None) == 400: return {}
+        raise
+
+    versions = parse_version_rows(res.get('values', [])[1:])
+    if shared:
+        shared.publish_versions(tenant_id, versions)
+        return shared.versions(tenant_id)
+    return versions
+
+def get_data_versions():
+    """バージョン情報を返す。取得できない場合は最後に取得できた値を使う"""
+    known = _last_known_versions(TENANT_ID)
+    health = _backend_health(TENANT_ID)
+    if time.time() < health["down_until"]: return dict(known)
+    try:
+        versions = fetch_data_versions(TENANT_ID)
+    except Exception as e:
+        health.update(down_until=time.time() + BACKEND_RETRY_AFTER, last_error=str(e))
+        return dict(known)
+    shared = shared_cache()
+    if shared:
+        # ほかのレプリカが書き込んで公開したバージョンは、確認の間隔を待たずに反映する
+        versions = {**versions, **{k: v for k, v in shared.versions(TENANT_ID).items() if v > versions.get(k, 0)}}
+    known.clear()
+    known.update(versions)
+    return versions
+
+def refresh_data_versions():
+    """次回の読み込みで必ず最新のバージョンを確認させる（他のテナントのキャッシュには触れない）"""
+    fetch_data_versions.clear(TENANT_ID)
+
+def _version_row(ws, sheet_name):
+    """sheet_name のバージョンを書く行番号（固定の行がない名前は既存の行を探し、なければ固定行の後ろに追記する）"""
+    if sheet_name in VERSION_ROWS: return VERSION_ROWS.index(sheet_name) + 2
+    rows = call_sheets_api(ws.get_all_values)
+    for i, r in enumerate(rows[len(VERSION_ROWS) + 1:], start=len(VERSION_ROWS) + 2):
+        if r and r[0] == sheet_name: return i
+    return max(len(rows), len(VERSION_ROWS) + 1) + 1
+
+def _bump_once(ws, sheet_name):
+    row = _version_row(ws, sheet_name)
+    res = call_sheets_api(get_spreadsheet(TENANT_ID).values_get, f"'{VERSION_SHEET}'!A{row}:B{row}")
+    current = parse_version_rows(res.get('values', [])).get(sheet_name, 0)
+    # 別プロセスの書き込みとも順序が揃うよう時刻(μ秒)を基準に単調増加させる
+    new_ver = max(current + 1, time.time_ns() // 1000)
+    cell = f"A{row}:B{row}"
+    try:
+        call_sheets_api(ws.update, values=[[sheet_name, str(new_ver)]], range_name=cell, kind="write", idempotent=True)
+    except TypeError:
+        call_sheets_api(ws.update, cell, [[sheet_name, str(new_ver)]], kind="write", idempotent=True)
+    return current, new_ver
+
+def bump_data_version(sheet_name, with_previous=False):
+    """書き込み後にシートのバージョンを進め、新しいバージョン番号を返す（with_previous なら (直前の番号, 新しい番号)）。
+    数回試しても進められなければ、ほかの端末への反映が遅れることを画面に出して None を返す"""
+    try:
+        ws, err = connect_sheet(VERSION_SHEET, VERSION_HEADERS)
+        if err: raise RuntimeError(err)
+        for attempt in range(VERSION_BUMP_ATTEMPTS):
+            try:
+                previous, new_ver = _bump_once(ws, sheet_name)
+                break
+            except Exception:
+                if attempt == VERSION_BUMP_ATTEMPTS - 1: raise
+                time.sleep(API_BACKOFF_BASE * 2 ** attempt)
+        shared = shared_cache()
+        if shared: shared.publish_versions(TENANT_ID, {sheet_name: new_ver})
+        return (previous, new_ver) if with_previous else new_ver
+    except Exception as e:
+        get_metrics_store().record("storage.version_bump_failed", 0, sheet=sheet_name, tenant=TENANT_ID, error=str(e)[:200])
+        st.warning(f"⚠️ 「{sheet_name}」の更新通知に失敗しました。保存は完了していますが、ほかの端末への反映が遅れることがあります。({e})")
+        return None
+    finally:
+        refresh_data_versions()
+
+# --- ローカルスナップショット ---
+# 最後に取得できた各シートをバージョン番号付きでParquetに保存しておき、
+# 起動直後はバージョンが一致すればディスクから読み、障害時は読み取り専用で表示に使う
+
+SNAPSHOT_DIR = tenant_dir(".snapshots")
+BACKEND_RETRY_AFTER = 30  # 読み込み失敗後、バックエンドへの再接続を控える秒数
+READ_ONLY_MESSAGE = "📴 データベースに接続できないため読み取り専用モードです。復旧後にもう一度操作してください。"
+
+def _snapshot_path(sheet_name):
+    return os.path.join(SNAPSHOT_DIR, urllib.parse.quote(sheet_name, safe='') + ".parquet")
+
+def write_snapshot(sheet_name, df, version):
+    """シートの内容をバージョン番号付きで保存する（一時ファイル経由で置き換え）"""
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        table = pa.Table.from_pandas(df.astype(str), preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'data_version': str(version).encode()})
+        path = _snapshot_path(sheet_name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        pass
+
+def read_snapshot(sheet_name):
+    """保存済みスナップショットを (DataFrame, バージョン) で返す。なければ (None, None)"""
+    path = _snapshot_path(sheet_name)
+    if not os.path.exists(path): return None, None
+    try:
+        table = pq.read_table(path, memory_map=True)
+        version = int((table.schema.metadata or {}).get(b'data_version', b'0'))
+        return table.to_pandas().astype(str), version
+    except Exception:
+        return None, None
+
+# --- レプリカ間の共有キャッシュ ---
+# 複数のレプリカをロードバランサの後ろで動かすとき、読み込んだシートをバージョン付きで共有し、
+# 書き込んだレプリカは新しいバージョンを公開する（無効化の通知）。ほかのレプリカは次の実行でそれに気づき、
+# 共有済みの内容を使う。バックエンドから読み直すのは、そのバージョンを最初に必要としたレプリカ1つだけ。
+# secrets の shared_cache_path にSQLiteファイルを指定すると有効になる（未設定なら従来どおり）。
+# SQLite の WAL は共有メモリを使うため、同じホスト上のレプリカ（同じマシンのプロセスやコンテナ）の
+# ローカルディスクに置くこと。NFS/SMB などのネットワークファイルシステム上のパスは使わない（検出したら無効にする）
+
+SHARED_CACHE_PATH = st.secrets.get("shared_cache_path")
+SHARED_FILL_WAIT = 10.0   # ほかのレプリカが読み込み中のとき、共有されるのを待つ秒数
+SHARED_FILL_LEASE = 30.0  # 読み込み担当の有効期限(秒)。担当のレプリカが落ちてもこの時間で引き継ぐ
+SHARED_POLL = 0.2
+NETWORK_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "ceph", "glusterfs", "lustre", "afs", "fuse.sshfs",
+                       "fuse.s3fs", "fuse.gcsfuse", "fuse.rclone")
+
+def _filesystem_type(path):
+    """path を含むマウントのファイルシステム種別（/proc/mounts が読めなければ None）"""
+    try:
+        with open("/proc/mounts", encoding="utf-8") as f:
+            mounts = [line.split()[1:3] for line in f if len(line.split()) >= 3]
+    except OSError:
+        return None
+    path = os.path.realpath(os.path.dirname(os.path.abspath(path)))
+    best, fstype = "", None
+    for mount, kind in mounts:
+        mount = mount.replace("\\040", " ")
+        if (path == mount or path.startswith(mount.rstrip("/") + "/")) and len(mount) >= len(best):
+            best, fstype = mount, kind
+    return fstype
+
+class SharedCache:
+    """SQLiteによるレプリカ間の共有キャッシュ（スレッドセーフ。プロセス間の排他はSQLiteのロックに任せる）
+    versions: 公開済みのバージョン / snapshots: シートの内容(Parquet) / fills: 読み込み担当 /
+    request_events・request_event_marks: 申請イベントの行と、各バージョン時点の行数"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        fstype = _filesystem_type(path)
+        if fstype in NETWORK_FILESYSTEMS:
+            raise RuntimeError(f"{path} はネットワークファイルシステム ({fstype}) 上にあります。同じホストのローカルディスクを指定してください")
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        mode = self.conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if mode.lower() != "wal":
+            self.conn.close()
+            raise RuntimeError(f"{path} でWALを有効にできませんでした (journal_mode={mode})")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS versions (tenant TEXT, sheet TEXT, version INTEGER, PRIMARY KEY (tenant, sheet));
+            CREATE TABLE IF NOT EXISTS version_checks (tenant TEXT PRIMARY KEY, checked_at REAL);
+            CREATE TABLE IF NOT EXISTS snapshots (tenant TEXT, sheet TEXT, version INTEGER, data BLOB, PRIMARY KEY (tenant, sheet));
+            CREATE TABLE IF NOT EXISTS fills (tenant TEXT, sheet TEXT, version INTEGER, until REAL, PRIMARY KEY (tenant, sheet));
+            CREATE TABLE IF NOT EXISTS request_events (tenant TEXT, generation INTEGER, row_no INTEGER, data TEXT,
+                                                       PRIMARY KEY (tenant, generation, row_no));
+            CREATE TABLE IF NOT EXISTS request_event_marks (tenant TEXT, generation INTEGER, version INTEGER, rows INTEGER,
+                                                            PRIMARY KEY (tenant, generation, version));
+        """)
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def _write(self, sql, params=(), many=False):
+        """書き込みを1トランザクションで行い、変更した行数を返す"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self.conn.executemany(sql, params) if many else self.conn.execute(sql, params)
+                self.conn.execute("COMMIT")
+                return cur.rowcount
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    # バージョン
+    def versions(self, tenant):
+        return dict(self._query("SELECT sheet, version FROM versions WHERE tenant = ?", (tenant,)))
+
+    def publish_versions(self, tenant, versions):
+        """バージョンを公開する（既に大きい値が公開されていればそのまま）"""
+        if not versions: return
+        self._write("INSERT INTO versions VALUES (?, ?, ?) ON CONFLICT (tenant, sheet) "
+                    "DO UPDATE SET version = MAX(version, excluded.version)",
+                    [(tenant, k, int(v)) for k, v in versions.items()], many=True)
+
+    def claim_version_check(self, tenant, interval):
+        """前回の確認から interval 秒以上経っていれば、このレプリカがバージョンシートを確認する担当になる"""
+        now = time.time()
+        return self._write("INSERT INTO version_checks VALUES (?, ?) ON CONFLICT (tenant) "
+                           "DO UPDATE SET checked_at = excluded.checked_at WHERE checked_at <= ?",
+                           (tenant, now, now - interval)) == 1
+
+    # シートの内容
+    def get_snapshot(self, tenant, sheet, version):
+        rows = self._query("SELECT data FROM snapshots WHERE tenant = ? AND sheet = ? AND version = ?", (tenant, sheet, version))
+        if not rows: return None
+        return pq.read_table(pa.BufferReader(rows[0][0])).to_pandas().astype(str)
+
+    def put_snapshot(self, tenant, sheet, version, df):
+        """シートの内容を共有する（文字列のまま。古いバージョンで上書きはしない）"""
+        sink = pa.BufferOutputStream()
+        pq.write_table(pa.Table.from_pandas(df.astype(str), preserve_index=False), sink)
+        self._write("INSERT INTO snapshots VALUES (?, ?, ?, ?) ON CONFLICT (tenant, sheet) "
+                    "DO UPDATE SET version = excluded.version, data = excluded.data WHERE excluded.version >= version",
+                    (tenant, sheet, int(version), sink.getvalue().to_pybytes()))
+        self.release_fill(tenant, sheet)
+
+    def drop_snapshots(self, tenant):
+        self._write("DELETE FROM snapshots WHERE tenant = ?", (tenant,))
+
+    def claim_fill(self, tenant, sheet, version, lease):
+        """このバージョンをバックエンドから読む担当になる。ほかのレプリカが担当中なら False"""
+        now = time.time()
+        return self._write("INSERT INTO fills VALUES (?, ?, ?, ?) ON CONFLICT (tenant, sheet) "
+                           "DO UPDATE SET version = excluded.version, until = excluded.until "
+                           "WHERE version != excluded.version OR until < ?",
+                           (tenant, sheet, int(version), now + lease, now)) == 1
+
+    def release_fill(self, tenant, sheet):
+        self._write("DELETE FROM fills WHERE tenant = ? AND sheet = ?", (tenant, sheet))
+
+    def wait_snapshot(self, tenant, sheet, version, timeout):
+        """担当のレプリカが共有するのを待つ（時間内に共有されなければ None）"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            df = self.get_snapshot(tenant, sheet, version)
+            if df is not None: return df
+            time.sleep(SHARED_POLL)
+        return None
+
+    # 申請イベント（追記のみなので行番号で共有する）
+    def request_event_rows(self, tenant, generation, version):
+        """そのバージョン時点のイベント行数（未共有なら None）"""
+        rows = self._query("SELECT rows FROM request_event_marks WHERE tenant = ? AND generation = ? AND version = ?",
+                           (tenant, generation, version))
+        return rows[0][0] if rows else None
+
+    def get_request_events(self, tenant, generation, start, stop):
+        """start 行目から stop 行目の手前までのイベント（欠けがあれば None）"""
+        rows = self._query("SELECT data FROM request_events WHERE tenant = ? AND generation = ? AND row_no >= ? AND row_no < ? "
+                           "ORDER BY row_no", (tenant, generation, start, stop))
+        if len(rows) != stop - start: return None
+        return [json.loads(r[0]) for r in rows]
+
+    def put_request_events(self, tenant, generation, start, events, version):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany("INSERT OR IGNORE INTO request_events VALUES (?, ?, ?, ?)",
+                                      [(tenant, generation, start + i, json.dumps(ev, ensure_ascii=False)) for i, ev in enumerate(events)])
+                self.conn.execute("INSERT OR REPLACE INTO request_event_marks VALUES (?, ?, ?, ?)",
+                                  (tenant, generation, int(version), start + len(events)))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+@st.cache_resource(show_spinner=False)
+def get_shared_cache(path):
+    """共有キャッシュを開く（同じホストのローカルディスクで開けなければ共有せずに動かす）"""
+    try:
+        return SharedCache(path)
+    except Exception as e:
+        st.warning(f"⚠️ 共有キャッシュを使えないため、レプリカごとに読み込みます: {e}")
+        return None
+
+def shared_cache():
+    """共有キャッシュ（未設定なら None）"""
+    return get_shared_cache(SHARED_CACHE_PATH) if SHARED_CACHE_PATH else None
+
+@st.cache_resource(show_spinner=False)
+def _backend_health(tenant_id):
+    """読み込み失敗の記録（テナントごと）"""
+    return {"down_until": 0.0, "last_error": ""}
+
+def is_read_only():
+    return st.session_state.get('read_only_mode', False)
+
+def _fill_headers(df, expected_headers):
+    if expected_headers:
+        for col in expected_headers:
+            if col not in df.columns:
+                df[col] = ""
+    return df
+
+# --- シートの型定義 ---
+# 読み込み時に1回だけ型変換し、保存時に1回だけ文字列へ戻す。
+# 画面側は型付きのDataFrameをそのまま使う
+#   date: datetime64 / bool: TRUE/FALSE / int: 整数(空欄はNA) / shift: 0/1 (Int8, 空欄はNA。数値以外を含む列は文字列のまま)
+#   category: 値の種類が少ない文字列 / "*": 指定のない残りの列すべて
+# 画面で自由入力するマスタの名前・権限列はカテゴリにすると新しい値を入力できないため文字列のままにする
+
+SHEET_SCHEMAS = {
+    "スタッフマスタ": {"en": "bool", "jp": "bool", "vet": "bool", "holiday_target": ("int", 0)},
+    "公休マスタ": {"date": "date"},
+    "ログ": {"日付": "date", "曜日": "str", "*": "shift"},
+    "draft_schedule": {"名前": "str", "*": "shift"},
+    "draft_requirements": {"日付": "date", "必要人数": "int"},
+    "希望休": {"名前": "category", "日付": "date", "ステータス": "category"},
+    "変更申請": {"名前": "category", "日付": "date", "種別": "category", "ステータス": "category"},
+    "申請イベント_アーカイブ": {"対象": "category", "名前": "category", "日付": "date", "種別": "category", "イベント": "category"},
+}
+SHIFT_MARKS = {1: "●", 0: "-"}
+
+def _parse_column(col, kind):
+    kind, default = kind if isinstance(kind, tuple) else (kind, None)
+    if kind == "date":
+        return pd.to_datetime(col, errors='coerce', format='mixed')
+    if kind == "bool":
+        return col.astype(str).str.strip().str.upper() == 'TRUE'
+    if kind == "int":
+        parsed = pd.to_numeric(col, errors='coerce')
+        if default is not None: return parsed.fillna(default).astype('int64')
+        return parsed.astype('Int64')
+    if kind == "shift":
+        # 数値以外（手入力のメモなど）が1つでもある列は、保存し直しても消えないよう文字列のまま残す
+        parsed = pd.to_numeric(col, errors='coerce')
+        blank = col.isna() | (col.astype(str).str.strip() == "")
+        if not (parsed.notna() | blank).all() or not (parsed.dropna() % 1 == 0).all(): return col
+        return parsed.astype('Int8')
+    if kind == "category":
+        return col.astype('category')
+    return col
+
+def coerce_cell(dtype, val):
+    """編集されたセルの値を、読み込み時に決まった列の型に合わせる。
+    整数の列（勤務の0/1など）に整数として読めない値が入れば ValueError、文字列のまま残した列は文字列で返す"""
+    if val is None or pd.isna(val): return pd.NA
+    if not pd.api.types.is_integer_dtype(dtype): return str(val)
+    num = pd.to_numeric(str(val).strip())
+    info = np.iinfo(dtype.numpy_dtype if hasattr(dtype, 'numpy_dtype') else dtype)
+    if num % 1 != 0 or not info.min <= num <= info.max: raise ValueError(f"整数ではありません: {val}")
+    return int(num)
+
+def parse_sheet(sheet_name, raw_df):
+    """文字列のままのシートを型定義に従って変換する"""
+    schema = SHEET_SCHEMAS.get(sheet_name)
+    if not schema: return raw_df
+    df = raw_df.copy()
+    for col in df.columns:
+        kind = schema.get(col, schema.get("*"))
+        if kind: df[col] = _parse_column(df[col], kind)
+    return df
+
+def serialize_frame(df):
+    """型付きのDataFrameをシートに書き込む文字列に戻す（空欄は""）"""
+    out = pd.DataFrame(index=df.index)
+    for col in df.columns:
+        c = df[col]
+        if pd.api.types.is_datetime64_any_dtype(c):
+            out[col] = c.dt.strftime('%Y-%m-%d').fillna("")
+        elif pd.api.types.is_bool_dtype(c):
+            out[col] = c.map({True: 'TRUE', False: 'FALSE'}).fillna("")
+        elif pd.api.types.is_integer_dtype(c):
+            out[col] = c.astype('string').fillna("")
+        elif pd.api.types.is_float_dtype(c):
+            # 編集画面で整数列が小数になった場合も 1.0 ではなく 1 で保存する
+            out[col] = c.map(lambda v: "" if pd.isna(v) else (str(int(v)) if float(v).is_integer() else str(v)))
+        else:
+            out[col] = c.astype(object).where(c.notna(), "").map(str)
+    return out
+
+def to_shift_marks(df):
+    """0/1のシフトを ●/- 表示に変換する"""
+    return df.astype(object).replace(SHIFT_MARKS)
+
+def is_on(v):
+    """シフト値が出勤(1)かどうか（空欄は出勤扱いしない）"""
+    return not pd.isna(v) and v == 1
 
 # --- データ読み書き用 ---
 
-@st.cache_data(ttl=600, show_spinner=False)
 def load_data(sheet_name, expected_headers=None):
-    """スプレッドシートからデータを読み込みDataFrameで返す"""
-    ws, err = connect_sheet(sheet_name, expected_headers)
-    if err: return pd.DataFrame(columns=expected_headers or [])
-    
+    """スプレッドシートからデータを読み込みDataFrameで返す（バージョンが同じならキャッシュを返す）"""
+    health = _backend_health(TENANT_ID)
+    err = health["last_error"]
+    if time.time() >= health["down_until"]:
+        version = get_data_versions().get(sheet_name, 0)
+        try:
+            return _load_sheet(cache_namespace(), sheet_name, expected_headers, version)
+        except Exception as e:
+            # 失敗結果はキャッシュされないので、一定時間後の再実行で再取得される
+            err = str(e)
+            health.update(down_until=time.time() + BACKEND_RETRY_AFTER, last_error=err)
+
+    st.session_state.read_only_mode = True
+    snap, _ = read_snapshot(sheet_name)
+    if snap is not None:
+        return parse_sheet(sheet_name, _fill_headers(snap, expected_headers))
+    st.warning(f"⚠️ 「{sheet_name}」を読み込めませんでした。時間をおいて再読み込みしてください。({err})")
+    return pd.DataFrame(columns=expected_headers or [])
+
+# バージョンが変わればキャッシュキーが変わるため、TTLはシートを直接手編集された場合の保険
+@st.cache_data(ttl=600, max_entries=64, show_spinner=False)
+def _load_sheet(namespace, sheet_name, expected_headers, version):
+    """指定バージョンのシートを読み込み型変換して返す（namespace・versionはキャッシュキーとしてのみ使用）。失敗時は例外を送出する"""
+    # 再起動直後など、同じバージョンのスナップショットがあればダウンロードしない
+    if version:
+        snap, snap_version = read_snapshot(sheet_name)
+        if snap is not None and snap_version == version:
+            return parse_sheet(sheet_name, _fill_headers(snap, expected_headers))
+
+    # ほかのレプリカが読み込み済みならそれを使い、読み込み中なら共有されるのを待つ
+    shared = shared_cache() if version else None
+    if shared:
+        with timed_span("cache.shared", sheet=sheet_name) as attrs:
+            df = shared.get_snapshot(TENANT_ID, sheet_name, version)
+            attrs['result'] = "hit" if df is not None else "fill"
+            if df is None and not shared.claim_fill(TENANT_ID, sheet_name, version, SHARED_FILL_LEASE):
+                df = shared.wait_snapshot(TENANT_ID, sheet_name, version, SHARED_FILL_WAIT)
+                attrs['result'] = "wait" if df is not None else "timeout"
+        if df is not None:
+            write_snapshot(sheet_name, df, version)
+            return parse_sheet(sheet_name, _fill_headers(df, expected_headers))
+
     try:
-        data = ws.get_all_records()
-        if not data: return pd.DataFrame(columns=expected_headers or [])
-        df = pd.DataFrame(data).astype(str)
-        
-        if expected_headers:
-            for col in expected_headers:
-                if col not in df.columns:
-                    df[col] = ""
-        return df
-    except:
-        return pd.DataFrame(columns=expected_headers or [])
+        ws, err = connect_sheet(sheet_name, expected_headers)
+        if err: raise RuntimeError(err)
+
+        data = call_sheets_api(ws.get_all_records)
+    except Exception:
+        if shared: shared.release_fill(TENANT_ID, sheet_name)
+        raise
+    df = pd.DataFrame(data).astype(str) if data else pd.DataFrame(columns=expected_headers or [])
+    write_snapshot(sheet_name, df, version)
+    if shared: shared.put_snapshot(TENANT_ID, sheet_name, version, df)
+    return parse_sheet(sheet_name, _fill_headers(df, expected_headers))
+
+@st.cache_resource(show_spinner=False)
+def _cache_epochs():
+    """テナントごとのキャッシュ世代（プロセス共通）"""
+    return collections.Counter()
+
+def cache_namespace():
+    """シート・集計キャッシュのキーに含める名前空間（テナントID + 世代）"""
+    return f"{TENANT_ID}#{_cache_epochs()[TENANT_ID]}"
 
 def clear_data_cache():
-    """保存後にキャッシュをクリアして最新データを読み込めるようにする"""
-    load_data.clear()
+    """このテナントのキャッシュを全てクリアして最新データを読み込めるようにする（世代を進めて古いキーを使わなくする）"""
+    _worksheet_handles(TENANT_ID).clear()
+    _cache_epochs()[TENANT_ID] += 1
+    # 全件再取得のときは共有分も捨て、バックエンドから読み直す
+    shared = shared_cache()
+    if shared: shared.drop_snapshots(TENANT_ID)
+    reset_request_views()
+    refresh_data_versions()
 
 def save_data(sheet_name, df):
     """DataFrameの内容でスプレッドシートを全上書きする"""
+    if is_read_only(): return False, READ_ONLY_MESSAGE
     ws, err = connect_sheet(sheet_name)
     if err: return False, err
     
     try:
-        ws.clear()
-        upload_df = df.fillna("")
+        seen = get_data_versions().get(sheet_name, 0)
+        call_sheets_api(ws.clear, kind="write", idempotent=True)
+        upload_df = serialize_frame(df)
         upload_data = [upload_df.columns.tolist()] + upload_df.values.tolist()
         try:
-            ws.update(values=upload_data, range_name='A1')
+            call_sheets_api(ws.update, values=upload_data, range_name='A1', kind="write", idempotent=True)
         except TypeError:
-            ws.update('A1', upload_data)
+            call_sheets_api(ws.update, 'A1', upload_data, kind="write", idempotent=True)
         
-        clear_data_cache()
+        bumped = bump_data_version(sheet_name, with_previous=True)
+        # 書き込んだ内容はそのまま共有し、ほかのレプリカが読み直さなくて済むようにする。
+        # ただし書き込む前に見ていた番号から誰も進めていないときだけ（間にほかの保存が入っていれば、
+        # その内容の方が新しいかもしれないので共有せず、ほかのレプリカにはシートから読ませる）
+        shared = shared_cache()
+        if shared and bumped and bumped[0] == seen: shared.put_snapshot(TENANT_ID, sheet_name, bumped[1], upload_df)
         return True, "保存完了"
     except Exception as e:
         return False, str(e)
 
 def clear_sheet_data(sheet_name):
     """シートの中身を完全に消去する"""
+    if is_read_only(): return False
     ws, err = connect_sheet(sheet_name)
     if err: return False
     try:
-        ws.clear()
-        clear_data_cache()
+        call_sheets_api(ws.clear, kind="write", idempotent=True)
+        bump_data_version(sheet_name)
         return True
     except: return False
 
 def append_row_data(sheet_name, row_list):
     """リストデータを1行追記する"""
+    if is_read_only(): return False, READ_ONLY_MESSAGE
     ws, err = connect_sheet(sheet_name)
     if err: return False, err
     try:
-        ws.append_row(row_list)
-        clear_data_cache()
+        call_sheets_api(ws.append_row, row_list, kind="write")
+        bump_data_version(sheet_name)
         return True, "追加完了"
     except Exception as e:
         return False, str(e)
 
+def append_rows_data(sheet_name, rows):
+    """複数行をまとめて1回で追記する"""
+    if is_read_only(): return False, READ_ONLY_MESSAGE
+    if not rows: return False, "追加するデータがありません"
+    ws, err = connect_sheet(sheet_name)
+    if err: return False, err
+    try:
+        call_sheets_api(ws.append_rows, rows, kind="write")
+        bump_data_version(sheet_name)
+        return True, f"{len(rows)}件追加完了"
+    except Exception as e:
+        return False, str(e)
+
 def update_cell_value(sheet_name, row_idx, col_idx, value):
     """特定セルの更新"""
+    if is_read_only(): return False
     ws, err = connect_sheet(sheet_name)
     if err: return False
     try:
-        ws.update_cell(row_idx, col_idx, value)
-        clear_data_cache()
+        call_sheets_api(ws.update_cell, row_idx, col_idx, value, kind="write", idempotent=True)
+        bump_data_version(sheet_name)
         return True
     except: return False
 
-def update_log_sheet(new_df):
-    """ログシート更新"""
-    current_df = load_data("ログ", ['日付', '曜日'])
-    
-    if not current_df.empty:
-        current_df['日付'] = pd.to_datetime(current_df['日付'], errors='coerce').dt.date
-    if not new_df.empty:
-        new_df['日付'] = pd.to_datetime(new_df['日付'], errors='coerce').dt.date
-        
+def _replace_month_rows(current_df, new_df):
+    """current_dfのうちnew_dfと同じ年月の行をnew_dfで置き換え、日付順に並べる"""
+    new_df = new_df.copy()
+    new_df['日付'] = pd.to_datetime(new_df['日付'], errors='coerce')
     current_df = current_df.dropna(subset=['日付'])
     new_df = new_df.dropna(subset=['日付'])
     
     if not new_df.empty and not current_df.empty:
-        target_month = new_df.iloc[0]['日付'].month
-        target_year = new_df.iloc[0]['日付'].year
-        current_df = current_df[~current_df['日付'].apply(lambda x: x.year == target_year and x.month == target_month)]
+        first = new_df['日付'].iloc[0]
+        same_month = (current_df['日付'].dt.year == first.year) & (current_df['日付'].dt.month == first.month)
+        current_df = current_df[~same_month]
     
     combined = pd.concat([current_df, new_df], ignore_index=True)
-    combined.sort_values('日付', inplace=True)
-    combined['日付'] = combined['日付'].astype(str)
-    return save_data("ログ", combined)
+    return combined.sort_values('日付')
+
+def update_log_sheet(new_df):
+    """ログシート更新"""
+    current_df = load_data("ログ", ['日付', '曜日'])
+    return save_data("ログ", _replace_month_rows(current_df, new_df))
+
+def update_log_cells(changes):
+    """ログシートの変更されたセルだけを1回の書き込みで更新する。changes: {(日付文字列, 列名): 値}"""
+    if is_read_only(): return False, READ_ONLY_MESSAGE
+    refresh_data_versions()
+    current_df = load_data("ログ", ['日付', '曜日'])
+    row_by_date = {}
+    for i, d in enumerate(current_df['日付']):
+        if pd.notnull(d): row_by_date[str(d.date())] = i + 2
+    columns = list(current_df.columns)
+
+    updates = []
+    for (d_key, col), val in changes.items():
+        if d_key not in row_by_date or col not in columns: continue
+        updates.append({'range': gspread.utils.rowcol_to_a1(row_by_date[d_key], columns.index(col) + 1), 'values': [[val]]})
+    if not updates: return False, "更新対象のセルが見つかりません"
+
+    ws, err = connect_sheet("ログ")
+    if err: return False, err
+    try:
+        call_sheets_api(ws.batch_update, updates, kind="write", idempotent=True)
+        bump_data_version("ログ")
+        return True, f"{len(updates)}セルを保存しました"
+    except Exception as e:
+        return False, str(e)
 
 def update_requirements_sheet(new_df):
     """必要人数シート（draft_requirements）更新"""
     current_df = load_data("draft_requirements", ['日付', '曜日', '必要人数'])
-    
-    if not current_df.empty:
-        current_df['日付'] = pd.to_datetime(current_df['日付'], errors='coerce').dt.date
-        current_df = current_df.dropna(subset=['日付'])
-        
-    if not new_df.empty:
-        new_df['日付'] = pd.to_datetime(new_df['日付'], errors='coerce').dt.date
-        new_df = new_df.dropna(subset=['日付'])
-    
-    if not new_df.empty and not current_df.empty:
-        target_month = new_df.iloc[0]['日付'].month
-        target_year = new_df.iloc[0]['日付'].year
-        current_df = current_df[~current_df['日付'].apply(lambda x: x.year == target_year and x.month == target_month)]
-    
-    combined = pd.concat([current_df, new_df], ignore_index=True)
-    combined.sort_values('日付', inplace=True)
-    combined['日付'] = combined['日付'].astype(str)
-    return save_data("draft_requirements", combined)
+    return save_data("draft_requirements", _replace_month_rows(current_df, new_df))
+
+# --- 申請データ (イベント記録) ---
+# 希望休・変更申請は「申請・取り消し・承認・却下」のイベントを追記するだけで記録する。
+# 各申請の現在の状態はイベントを順に適用した表（ビュー）をプロセス内に持ち、
+# イベントシートのバージョンが変わったら前回以降に追記された行だけを読み込んで更新する。
+# 申請イベントシートには未確定の月の申請だけを置き、月の確定時にそれ以前の月の分は
+# アーカイブシートへ移す（通常の読み込み量は運用期間に関係なく一定）。アーカイブは必要な時だけ読む
+
+REQ_OFF_HEADERS = ["タイムスタンプ", "名前", "日付", "備考", "ステータス", "ID"]
+REQ_CHG_HEADERS = ["タイムスタンプ", "名前", "日付", "種別", "備考", "ステータス", "ID"]
+REQUEST_HEADERS = {"希望休": REQ_OFF_HEADERS, "変更申請": REQ_CHG_HEADERS}
+
+REQUEST_EVENT_SHEET = "申請イベント"
+REQUEST_EVENT_HEADERS = ["タイムスタンプ", "対象", "ID", "イベント", "名前", "日付", "種別", "備考", "操作者"]
+REQUEST_EVENTS = ("申請", "取り消し", "承認", "却下")
+# 状態ごとに次に取れる状態（「申請」以外からは動かさない）
+REQUEST_TRANSITIONS = {"申請": ("取り消し", "承認", "却下")}
+# 旧シートからの移行済みの印の行（「対象」列の値）。最初に印を書いたセッションだけが移行する
+REQUEST_MIGRATION_MARK = "#移行"
+REQUEST_ARCHIVE_SHEET = "申請イベント_アーカイブ"
+# 申請イベントシートを書き直したときに進める世代番号（data_version シート上のキー）
+REQUEST_GENERATION_KEY = "申請イベント#世代"
+
+def new_request_id():
+    """申請IDを発行する"""
+    return uuid.uuid4().hex[:12]
+
+def legacy_request_id(sheet_name, row_no, r):
+    """IDのない旧シートの行に、行の内容から毎回同じIDを付ける（移行をやり直しても重複しない）"""
+    key = "|".join([sheet_name, str(row_no)] + [str(r.get(h, "")) for h in REQUEST_HEADERS[sheet_name] if h not in ("ステータス", "ID")])
+    return "m" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:11]
+
+@st.cache_resource(show_spinner=False)
+def _request_views(tenant_id):
+    """申請ごとの現在の状態（テナントごと）。applied: 読み込んだイベント行数、
+    events: 反映したイベント（履歴表示用に値のタプルだけ持つ）、migrated: 最初の移行の印のID、
+    last: 最後に読んだ行の値（続きを読むときに行が詰められていないかの確認用）"""
+    return {"lock": threading.Lock(), "generation": None, "version": None, "applied": 0, "events": [],
+            "migrated": None, "last": None, "rows": {sheet_name: {} for sheet_name in REQUEST_HEADERS}}
+
+def _clear_view(view, generation=None):
+    view.update(generation=generation, version=None, applied=0, events=[], migrated=None, last=None,
+                rows={sheet_name: {} for sheet_name in REQUEST_HEADERS})
+
+def _event_values(ev):
+    return tuple(ev[h] for h in REQUEST_EVENT_HEADERS)
+
+def _apply_request_event(rows, ev):
+    """イベント1件をビューに反映し、反映したかを返す。
+    同じIDの「申請」が重複した場合は最初のものを使い、REQUEST_TRANSITIONS にない状態の変化は無視する"""
+    target = rows.get(ev['対象'])
+    rid = ev['ID']
+    if target is None or not rid or ev['イベント'] not in REQUEST_EVENTS: return False
+    if ev['イベント'] == "申請":
+        if rid in target: return False
+        target[rid] = {h: ev.get(h, "") for h in REQUEST_HEADERS[ev['対象']]}
+        target[rid]['ステータス'] = "申請"
+        return True
+    if rid not in target or ev['イベント'] not in REQUEST_TRANSITIONS.get(target[rid]['ステータス'], ()): return False
+    target[rid]['ステータス'] = ev['イベント']
+    return True
+
+def _fetch_request_events(start_row):
+    """イベントシートの start_row 行目以降を読む（シート未作成なら空）"""
+    try:
+        res = call_sheets_api(get_spreadsheet(TENANT_ID).values_get, f"'{REQUEST_EVENT_SHEET}'!A{start_row}:I")
+    except gspread.exceptions.APIError as e:
+        if getattr(e.response, 'status_code', None) == 400: return []
+        raise
+    width = len(REQUEST_EVENT_HEADERS)
+    return [dict(zip(REQUEST_EVENT_HEADERS, (list(r) + [""] * width)[:width])) for r in res.get('values', [])]
+
+def refresh_request_views():
+    """イベントシートのバージョンが変わっていれば、追記された行だけを読んでビューに適用する"""
+    view = _request_views(TENANT_ID)
+    health = _backend_health(TENANT_ID)
+    versions = get_data_versions()
+    version, generation = versions.get(REQUEST_EVENT_SHEET, 0), versions.get(REQUEST_GENERATION_KEY, 0)
+    with view['lock']:
+        # アーカイブで行が詰められた後は、追記分ではなく先頭から読み直す
+        if view['generation'] != generation: _clear_view(view, generation)
+        if view['version'] == version: return view
+        shared = shared_cache()
+        try:
+            events = None
+            # ほかのレプリカがこのバージョンまで読んでいれば、足りない行だけを共有キャッシュから取る
+            if shared and version:
+                rows = shared.request_event_rows(TENANT_ID, generation, version)
+                if rows is not None and rows >= view['applied']:
+                    events = shared.get_request_events(TENANT_ID, generation, view['applied'], rows)
+            if events is None:
+                if time.time() < health["down_until"]: raise RuntimeError(health["last_error"])
+                # 読み込み済みの最後の行も読み直し、同じ位置にあることを確かめてから続きを使う
+                events = _fetch_request_events(view['applied'] + 1 if view['applied'] else 2)
+                shifted = False
+                if view['applied']:
+                    if events and _event_values(events[0]) == view['last']:
+                        events = events[1:]
+                    else:
+                        # 世代の更新がまだ届いていないうちに行が詰められた。先頭から読み直し、ずれた行は共有しない
+                        _clear_view(view, generation)
+                        events = _fetch_request_events(2)
+                        shifted = True
+                if shared and version and not shifted:
+                    shared.put_request_events(TENANT_ID, generation, view['applied'], events, version)
+        except Exception as e:
+            if time.time() >= health["down_until"]:
+                health.update(down_until=time.time() + BACKEND_RETRY_AFTER, last_error=str(e))
+            # 読めなかった間は手元のビュー（古い可能性あり）で表示だけ行う
+            st.session_state.read_only_mode = True
+            return view
+        for ev in events:
+            if ev['対象'] == REQUEST_MIGRATION_MARK and view['migrated'] is None: view['migrated'] = ev['ID']
+            if _apply_request_event(view['rows'], ev):
+                view['events'].append(_event_values(ev))
+        if events: view['last'] = _event_values(events[-1])
+        view['applied'] += len(events)
+        view['version'] = version
+    return view
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def _request_frame(namespace, sheet_name, generation, applied, _view):
+    """ビューの現時点の内容を型付きのDataFrameにする（世代・適用済みイベント数ごとに1回）"""
+    with _view['lock']:
+        records = list(_view['rows'][sheet_name].values())
+    df = pd.DataFrame(records, columns=REQUEST_HEADERS[sheet_name]).astype(str)
+    write_snapshot(sheet_name, df, applied)
+    return parse_sheet(sheet_name, df)
+
+def load_requests(sheet_name):
+    """希望休・変更申請の現在の状態を返す。ビューを一度も読めていなければスナップショットを使う"""
+    view = refresh_request_views()
+    if view['version'] is None:
+        snap, _ = read_snapshot(sheet_name)
+        if snap is not None:
+            return parse_sheet(sheet_name, _fill_headers(snap, REQUEST_HEADERS[sheet_name]))
+        st.warning(f"⚠️ 「{sheet_name}」を読み込めませんでした。時間をおいて再読み込みしてください。({_backend_health(TENANT_ID)['last_error']})")
+        return pd.DataFrame(columns=REQUEST_HEADERS[sheet_name])
+    return _request_frame(cache_namespace(), sheet_name, view['generation'], view['applied'], view)
+
+def load_request_events(sheet_name=None):
+    """反映済みのイベント（操作の履歴）を古い順に返す"""
+    view = refresh_request_views()
+    target = REQUEST_EVENT_HEADERS.index('対象')
+    with view['lock']:
+        events = [ev for ev in view['events'] if sheet_name is None or ev[target] == sheet_name]
+    df = pd.DataFrame(events, columns=REQUEST_EVENT_HEADERS)
+    df['日付'] = pd.to_datetime(df['日付'], errors='coerce', format='mixed')
+    return df
+
+def reset_request_views():
+    """ビューを捨て、次回の読み込みでイベントを先頭から適用し直す"""
+    view = _request_views(TENANT_ID)
+    with view['lock']:
+        _clear_view(view)
+
+def append_request_events(events):
+    """イベントをまとめて1回で追記する（タイムスタンプと操作者はここで付ける）"""
+    if is_read_only(): return False, READ_ONLY_MESSAGE
+    _, err = connect_sheet(REQUEST_EVENT_SHEET, REQUEST_EVENT_HEADERS)
+    if err: return False, err
+    ts = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
+    operator = st.session_state.get('user_name') or ""
+    defaults = {"タイムスタンプ": ts, "操作者": operator}
+    rows = [[ev.get(h) or defaults.get(h, "") for h in REQUEST_EVENT_HEADERS] for ev in events]
+    return append_rows_data(REQUEST_EVENT_SHEET, rows)
+
+def submit_requests(sheet_name, records):
+    """新しい申請を「申請」イベントとして追記する。records: [{名前, 日付, (種別), (備考)}]"""
+    return append_request_events([{**rec, "対象": sheet_name, "ID": new_request_id(), "イベント": "申請"} for rec in records])
+
+def update_request_statuses(sheet_name, status_by_id):
+    """{申請ID: ステータス} をイベントとしてまとめて1回で追記する"""
+    if is_read_only(): return False, READ_ONLY_MESSAGE
+    if not status_by_id: return True, "更新対象なし"
+    refresh_data_versions()
+    view = refresh_request_views()
+    with view['lock']:
+        current = {rid: dict(view['rows'][sheet_name][rid]) for rid in status_by_id if rid in view['rows'][sheet_name]}
+    if not current: return False, "対象の申請が見つかりません"
+    # 最新の状態から移れないもの（取り消し済み・処理済みなど）は書かない
+    allowed = {rid: r for rid, r in current.items() if status_by_id[rid] in REQUEST_TRANSITIONS.get(r['ステータス'], ())}
+    if not allowed: return False, "すでに取り消し・処理済みのため変更できません"
+    events = [{"対象": sheet_name, "ID": rid, "イベント": status_by_id[rid],
+               "名前": r['名前'], "日付": r['日付'], "種別": r.get('種別', "")} for rid, r in allowed.items()]
+    res, msg = append_request_events(events)
+    if not res: return False, msg
+    skipped = len(status_by_id) - len(events)
+    return True, f"{len(events)}件更新しました" + (f"（{skipped}件は変更できない状態のため除外）" if skipped else "")
+
+def migrate_requests_to_events():
+    """イベント記録を始める前の希望休・変更申請シートの行を、イベントとして一度だけ取り込む。
+    先に移行の印の行を追記し、シート上で最初に印を書いたセッションだけが取り込む"""
+    if is_read_only(): return
+    view = refresh_request_views()
+    # 印がある、または印を使う前に移行・アーカイブ済みのシートなら何もしない
+    if view['version'] is None or view['migrated'] or view['applied'] or view['generation']: return
+    token = new_request_id()
+    res, _ = append_request_events([{"対象": REQUEST_MIGRATION_MARK, "ID": token, "イベント": "移行"}])
+    if not res: return
+    try:
+        marks = [ev['ID'] for ev in _fetch_request_events(2) if ev['対象'] == REQUEST_MIGRATION_MARK]
+    except Exception:
+        return
+    if marks[:1] != [token]: return
+    events = []
+    for sheet_name, headers in REQUEST_HEADERS.items():
+        df = load_data(sheet_name, headers)
+        if df.empty: continue
+        for row_no, r in enumerate(serialize_frame(df).to_dict('records'), start=2):
+            base = {"対象": sheet_name, "ID": r['ID'] or legacy_request_id(sheet_name, row_no, r), "名前": r['名前'], "日付": r['日付'],
+                    "種別": r.get('種別', ""), "備考": r['備考'], "タイムスタンプ": r['タイムスタンプ'], "操作者": "移行"}
+            events.append({**base, "イベント": "申請"})
+            if r['ステータス'] in REQUEST_EVENTS and r['ステータス'] != "申請":
+                events.append({**base, "イベント": r['ステータス'], "備考": ""})
+    if events: append_request_events(events)
+
+def archive_request_events(year, month):
+    """確定した月（以前）の申請イベントをアーカイブシートへ移し、申請イベントシートからはその行だけを消す。
+    読み込んだ後に追記された行は読み込んだ範囲より下にあるので、消さずに残る"""
+    if is_read_only(): return False, READ_ONLY_MESSAGE
+    cutoff = pd.Timestamp(year, month, 1) + pd.offsets.MonthBegin(1)
+    try:
+        events = _fetch_request_events(2)
+    except Exception as e:
+        return False, str(e)
+    months = pd.to_datetime(pd.Series([ev['日付'] for ev in events], dtype=object), errors='coerce', format='mixed')
+    closed = (months < cutoff).to_numpy()
+    if not closed.any(): return True, "アーカイブ対象なし"
+
+    # 詰めた後に旧シートを取り込み直さないよう、移行の印を先に残しておく（印の行は日付がないので消さない）
+    if not any(ev['対象'] == REQUEST_MIGRATION_MARK for ev in events):
+        res, msg = append_request_events([{"対象": REQUEST_MIGRATION_MARK, "ID": new_request_id(), "イベント": "移行"}])
+        if not res: return False, msg
+
+    # アーカイブ側は対象月ごとにまとまるよう並べる（同じ月の中は発生順のまま）
+    order = months[closed].dt.to_period('M').argsort(kind='stable')
+    closed_rows = [[ev[h] for h in REQUEST_EVENT_HEADERS] for ev, c in zip(events, closed) if c]
+    _, err = connect_sheet(REQUEST_ARCHIVE_SHEET, REQUEST_EVENT_HEADERS)
+    if err: return False, err
+    # 先にアーカイブへ書いてから消すので、途中で失敗してもイベントは失われない（再実行時の重複は読み込み時に無視される）
+    res, msg = append_rows_data(REQUEST_ARCHIVE_SHEET, [closed_rows[i] for i in order])
+    if not res: return False, msg
+
+    ws, err = connect_sheet(REQUEST_EVENT_SHEET)
+    if err: return False, err
+    # 行を詰める前に世代を進め、ほかの端末が古い世代のまま行番号で続きを読まないようにする（進められなければ消さない）。
+    # 世代の更新がまだ届いていない端末は、続きを読むときに最後に読んだ行の位置を確かめて読み直す
+    if bump_data_version(REQUEST_GENERATION_KEY) is None:
+        return False, "申請イベントの世代を更新できなかったため、行は消していません（アーカイブ済みの行は再実行時に重複として無視されます）"
+    # 連続した行をまとめ、下の範囲から消す（上の行番号がずれないように）
+    row_nos = np.flatnonzero(closed) + 2
+    breaks = np.flatnonzero(np.diff(row_nos) > 1)
+    ranges = list(zip(row_nos[np.r_[0, breaks + 1]], row_nos[np.r_[breaks, len(row_nos) - 1]]))
+    deleted, error = 0, None
+    for start, end in reversed(ranges):
+        try:
+            call_sheets_api(ws.delete_rows, int(start), int(end), kind="write")
+        except Exception as e:
+            error = str(e)
+            break
+        deleted += 1
+    # 詰めている途中に新しい世代で読んだ端末があれば読み直させるため、消し終えたらもう一度進める
+    if deleted and bump_data_version(REQUEST_GENERATION_KEY) is None:
+        reset_request_views()
+        return False, "申請イベントの世代を更新できませんでした。ほかの端末では再読み込みするまで申請の表示が崩れることがあります"
+    if error: return False, error
+    return True, f"{len(closed_rows)}件の申請イベントをアーカイブしました"
+
+def load_archived_requests(sheet_name, year=None, month=None):
+    """アーカイブ済みの申請の最終状態とイベントを (DataFrame, DataFrame) で返す（必要な時だけ呼ぶ）"""
+    events = load_data(REQUEST_ARCHIVE_SHEET, REQUEST_EVENT_HEADERS)
+    events = events[events['対象'] == sheet_name]
+    if year is not None:
+        events = events[(events['日付'].dt.year == year) & (events['日付'].dt.month == month)]
+    rows = {sheet_name: {}}
+    for ev in serialize_frame(events).to_dict('records'):
+        _apply_request_event(rows, ev)
+    df = pd.DataFrame(list(rows[sheet_name].values()), columns=REQUEST_HEADERS[sheet_name]).astype(str)
+    return parse_sheet(sheet_name, df), events
 
 # --- システム設定（フェーズ・年月）管理関数 ---
 
@@ -285,21 +1315,19 @@ def init_session_from_db():
 # =========================================================
 # 📦 データマネージャ & 共通ロジック
 # =========================================================
-def sync_all_data():
-    """全データを最新化"""
-    clear_data_cache()
+def sync_all_data(force=False):
+    """全データを最新化（通常はバージョンが変わったシートのみ再取得、forceで全件再取得）"""
+    if force: clear_data_cache()
+    else: refresh_data_versions()
     init_session_from_db()
     
     st.session_state.master_staff = load_data("スタッフマスタ", ['id', 'password', 'name', 'role', 'en', 'jp', 'vet', 'holiday_target'])
-    if not st.session_state.master_staff.empty:
-        for col in ['en','jp','vet']:
-            if col in st.session_state.master_staff.columns:
-                st.session_state.master_staff[col] = st.session_state.master_staff[col].apply(lambda x: str(x).upper()=='TRUE')
 
     st.session_state.master_ph = load_data("公休マスタ", ['date', 'name'])
     st.session_state.master_log = load_data("ログ", ['日付', '曜日'])
-    st.session_state.req_off_data = load_data("希望休", ["タイムスタンプ", "名前", "日付", "備考", "ステータス"])
-    st.session_state.req_chg_data = load_data("変更申請", ["タイムスタンプ", "名前", "日付", "種別", "備考", "ステータス"])
+    migrate_requests_to_events()
+    st.session_state.req_off_data = load_requests("希望休")
+    st.session_state.req_chg_data = load_requests("変更申請")
 
 # アプリ起動時に一回だけ設定をロード
 if st.session_state.master_staff is None:
@@ -308,23 +1336,93 @@ if st.session_state.master_staff is None:
 def get_staff_list():
     df = st.session_state.master_staff
     if df is None or df.empty: return []
-    active_staff_df = df[df['role'] == 'staff'].copy()
-    for col in ['en','jp','vet']:
-        if col in active_staff_df.columns:
-            active_staff_df[col] = active_staff_df[col].apply(lambda x: str(x).upper()=='TRUE')
-    return active_staff_df.to_dict('records')
+    return df[df['role'] == 'staff'].to_dict('records')
+
+def rows_in_month(df, year, month):
+    """日付列が指定年月の行だけを返す"""
+    if df is None or df.empty: return pd.DataFrame()
+    return df[(df['日付'].dt.year == year) & (df['日付'].dt.month == month)]
+
+def session_memo(name, source, key, compute):
+    """セッションのデータ(source)が同じオブジェクトで key も同じ間は、前回の compute() の結果を返す。
+    画面の一部だけを再実行するときに、ログ全体の集計をやり直さないために使う"""
+    memo = st.session_state.setdefault("_session_memo", {})
+    hit = memo.get(name)
+    if hit is not None and hit[0] is source and hit[1] == key: return hit[2]
+    value = compute()
+    memo[name] = (source, key, value)
+    return value
+
+# --- 処理月のカレンダー情報 ---
+
+WEEKDAY_JP = ["月","火","水","木","金","土","日"]
+DEFAULT_REQUIRED = 4
+
+class MonthContext:
+    """処理月の暦（日付・"M/D"ラベル・曜日・土日/公休マスク・日別必要人数）をまとめたもの。
+    キャッシュで共有されるため、作成後は変更しないこと"""
+
+    def __init__(self, year, month, ph_dates, required_by_date):
+        self.year, self.month = year, month
+        self.first_weekday, self.num_days = calendar.monthrange(year, month)
+        self.days = range(self.num_days)
+        self.dates = [datetime.date(year, month, d + 1) for d in self.days]
+        self.labels = [f"{month}/{d + 1}" for d in self.days]
+        self.weekday_labels = [WEEKDAY_JP[dt.weekday()] for dt in self.dates]
+        self._index_by_label = {lb: i for i, lb in enumerate(self.labels)}
+
+        self.weekend_mask = np.array([dt.weekday() >= 5 for dt in self.dates], dtype=bool)
+        self.holiday_mask = np.array([dt in ph_dates for dt in self.dates], dtype=bool)
+        self.requirements = np.array([required_by_date.get(dt, DEFAULT_REQUIRED) for dt in self.dates], dtype=np.int64)
+        for arr in (self.weekend_mask, self.holiday_mask, self.requirements):
+            arr.flags.writeable = False
+
+        self.ph_indices = frozenset(np.flatnonzero(self.holiday_mask).tolist())
+        # 公休を除いた土日（週末出勤の平準化対象）
+        self.weekend_idx = np.flatnonzero(self.weekend_mask & ~self.holiday_mask).tolist()
+        self.required_map = dict(enumerate(self.requirements.tolist()))
+
+    def index_of(self, label):
+        """"M/D" ラベルから日のインデックスを返す（この月のラベルでなければNone）"""
+        return self._index_by_label.get(label)
+
+    def date_of(self, label):
+        idx = self.index_of(label)
+        return None if idx is None else self.dates[idx]
+
+    def label_of(self, d):
+        """日付から "M/D" ラベルを返す"""
+        return self.labels[d.day - 1]
+
+@st.cache_resource(ttl=600, max_entries=24, show_spinner=False)
+def _build_month_context(namespace, year, month, ph_version, req_version, _ph_df, _req_df):
+    """(年, 月, 公休マスタ/必要人数のバージョン) ごとに1回だけ暦を組み立てる（_始まりの引数はキャッシュキーに含めない）"""
+    ph_dates = set()
+    if not _ph_df.empty:
+        ph_dates = set(_ph_df['date'].dropna().dt.date)
+    required_by_date = {}
+    if not _req_df.empty:
+        saved = _req_df.dropna(subset=['日付', '必要人数'])
+        required_by_date = dict(zip(saved['日付'].dt.date, saved['必要人数'].astype(int)))
+    return MonthContext(year, month, ph_dates, required_by_date)
+
+def get_month_context(year, month):
+    """処理月の MonthContext を返す（各画面・ソルバー・集計で共通）"""
+    ph_df = load_data("公休マスタ", ['date', 'name'])
+    req_df = load_data("draft_requirements", ['日付', '曜日', '必要人数'])
+    versions = get_data_versions()
+    return _build_month_context(cache_namespace(), int(year), int(month), versions.get("公休マスタ", 0),
+                                versions.get("draft_requirements", 0), ph_df, req_df)
 
 def check_daily_constraints(staffs_list, shift_column, required_count_map=None, current_day_idx=None):
     working_staffs = []
     for s in staffs_list:
-        nm = s['name']
-        val = str(shift_column.get(nm, '0'))
-        if val == '1':
+        if is_on(shift_column.get(s['name'], 0)):
             working_staffs.append(s)
     
-    required = 4
+    required = DEFAULT_REQUIRED
     if required_count_map and current_day_idx is not None:
-        required = required_count_map.get(current_day_idx, 4)
+        required = required_count_map.get(current_day_idx, DEFAULT_REQUIRED)
         
     if len(working_staffs) < required:
         return False, f"人数不足(必要{required}人 -> 現在{len(working_staffs)}人)"
@@ -334,11 +1432,789 @@ def check_daily_constraints(staffs_list, shift_column, required_count_map=None,
     
     return True, "OK"
 
+# --- Phase2 抽選の承認見込み ---
+# 抽選は申請をランダムな順に並べ、先頭から check_daily_constraints を満たすものを承認していく。
+# 日が違えば結果は互いに影響しないので、日ごとに「並び順 × 試行回数」を配列でまとめて再現する
+
+LOTTERY_TRIALS = 4000
+
+def simulate_lottery(on_matrix, flags, required, requests, trials=LOTTERY_TRIALS, seed=0):
+    """抽選を trials 回再現し、申請ごとの承認確率を返す
+    on_matrix: スタッフ×日 の出勤(bool)、flags: スタッフ×(jp, en, vet) のbool、
+    required: 日ごとの必要人数、requests: [(スタッフ番号, 日インデックス)]"""
+    rng = np.random.default_rng(seed)
+    flags = np.asarray(flags, dtype=np.int32)
+    probs = np.zeros(len(requests))
+    by_day = collections.defaultdict(list)
+    for i, (_, d) in enumerate(requests): by_day[d].append(i)
+    rows = np.arange(trials)
+    for d, idxs in by_day.items():
+        req_staff = np.array([requests[i][0] for i in idxs])
+        order = np.argsort(rng.random((trials, len(idxs))), axis=1)
+        on = np.tile(on_matrix[:, d], (trials, 1))
+        count = on.sum(axis=1)
+        skills = on.astype(np.int32) @ flags
+        approved = np.zeros((trials, len(idxs)), dtype=bool)
+        for pos in range(len(idxs)):
+            j = order[:, pos]
+            s = req_staff[j]
+            ok = on[rows, s] & (count - 1 >= required[d]) & np.all(skills - flags[s] >= 1, axis=1)
+            on[rows[ok], s[ok]] = False
+            count -= ok
+            skills -= flags[s] * ok[:, None]
+            approved[rows, j] = ok
+        probs[idxs] = approved.mean(axis=0)
+    return probs
+
+@st.cache_data(ttl=600, max_entries=256, show_spinner=False)
+def _approval_estimates(namespace, user_name, year, month, versions, _ctx, _draft_idx, _staffs, _pending):
+    """（申請・仮シフト・必要人数・スタッフのバージョンごとに1回）"""
+    names = [s['name'] for s in _staffs]
+    if user_name not in names: return pd.DataFrame(columns=["申請中(他の人)", "承認見込み"])
+    me = names.index(user_name)
+    on = _draft_idx.reindex(index=names, columns=_ctx.labels).eq(1).to_numpy(dtype=bool, na_value=False)
+    flags = np.array([[bool(s['jp']), bool(s['en']), bool(s['vet'])] for s in _staffs])
+
+    name_to_idx = {nm: i for i, nm in enumerate(names)}
+    requests = [(name_to_idx[nm], _ctx.index_of(lb)) for nm, lb in _pending if nm in name_to_idx]
+    mine = {d for s, d in requests if s == me}
+    # 自分がまだ申請していない出勤日は「今申請したら」の見込みとして加える
+    requests += [(me, d) for d in _ctx.days if on[me, d] and d not in mine]
+    probs = simulate_lottery(on, flags, _ctx.requirements, requests)
+
+    rows = {}
+    for (s, d), p in zip(requests, probs):
+        if s == me: rows[_ctx.labels[d]] = {"申請中(他の人)": sum(1 for s2, d2 in requests if d2 == d and s2 != me), "承認見込み": p}
+    return pd.DataFrame.from_dict(rows, orient='index').reindex([lb for lb in _ctx.labels if lb in rows])
+
+def approval_estimates(ctx, user_name, draft_idx, staffs, df_chg):
+    """Phase2の休み希望について、自分の出勤日ごとの承認確率（抽選を繰り返し再現した推定）を返す"""
+    pending = []
+    if df_chg is not None and not df_chg.empty:
+        mask = (df_chg['種別'] == '休み希望') & (df_chg['ステータス'] == '申請') & \
+               (df_chg['日付'].dt.year == ctx.year) & (df_chg['日付'].dt.month == ctx.month)
+        pending = sorted(zip(df_chg.loc[mask, '名前'].astype(str), df_chg.loc[mask, '日付'].map(ctx.label_of)))
+    versions = get_data_versions()
+    key = tuple(versions.get(nm, 0) for nm in (REQUEST_EVENT_SHEET, "draft_schedule", "draft_requirements", "スタッフマスタ"))
+    with timed_span("lottery.estimate", requests=len(pending)):
+        return _approval_estimates(cache_namespace(), user_name, ctx.year, ctx.month, key, ctx, draft_idx, staffs, tuple(pending))
+
+# =========================================================
+# 🧮 シフト計算（ソルバー呼び出し・シナリオ比較）
+# =========================================================
+# モデル本体は shift_solver.py。ここでは画面の状態から入力(problem)を組み立て、
+# 全テナント共通の実行キューから、1件ずつ shift_solver を子プロセスとして起動して解く。シナリオ比較では条件違いの problem を同時に投入する
+
+SCENARIO_MAX = 5
+SOLVER_SLOTS = max(1, min(SCENARIO_MAX, os.cpu_count() or 1))  # 全テナントで同時に解く数の上限
+
+SOLVER_DIR = os.path.dirname(os.path.abspath(shift_solver.__file__))
+
+def build_shift_problem(ctx, staffs, required_map, req_holidays, is_dec, prev_history, past_holidays, req_off_df):
+    """ソルバーに渡す入力を素の dict/list で組み立てる（子プロセスへ pickle で渡すため）"""
+    name_to_idx = {s['name']: i for i, s in enumerate(staffs)}
+    off_requests = []
+    if req_off_df is not None and not req_off_df.empty:
+        active = req_off_df[(req_off_df['ステータス'] != '取り消し') & req_off_df['名前'].isin(list(name_to_idx))].dropna(subset=['日付'])
+        active = active[(active['日付'].dt.year == ctx.year) & (active['日付'].dt.month == ctx.month)]
+        off_requests = sorted({(name_to_idx[nm], int(d) - 1) for nm, d in zip(active['名前'], active['日付'].dt.day)})
+    return {
+        "staff": [{"name": s['name'], "jp": bool(s['jp']), "en": bool(s['en']), "vet": bool(s['vet']),
+                   "holiday_target": int(s.get('holiday_target', 0))} for s in staffs],
+        "year": ctx.year,
+        "month": ctx.month,
+        "num_days": ctx.num_days,
+        "ph_indices": sorted(ctx.ph_indices),
+        "weekend_idx": list(ctx.weekend_idx),
+        "required": {int(d): int(n) for d, n in required_map.items()},
+        "req_holidays": int(req_holidays),
+        "is_dec": bool(is_dec),
+        "prev_history": dict(prev_history),
+        "past_holidays": dict(past_holidays),
+        "off_requests": off_requests,
+    }
+
+def apply_scenario(ctx, problem, spec):
+    """シナリオ（必要休日数・増員日・希望休を外すスタッフ）を problem に反映したコピーを返す"""
+    scenario = dict(problem, required=dict(problem['required']))
+    if not pd.isna(spec.get('必要休日数')):
+        scenario['req_holidays'] = int(spec['必要休日数'])
+
+    extra = 0 if pd.isna(spec.get('増員数')) else int(spec['増員数'])
+    days = spec.get('増員日')
+    days = str(days) if pd.notna(days) else ""
+    labels = [lb.strip() for lb in days.replace("、", ",").split(",") if lb.strip()]
+    for lb in labels:
+        d = ctx.index_of(lb)
+        if d is None: raise ValueError(f"増員日「{lb}」は{ctx.month}月の日付ではありません（例: {ctx.labels[0]}）")
+        # マイナスの増員数（減員）でも必要人数は0人より少なくしない
+        scenario['required'][d] = max(0, scenario['required'].get(d, DEFAULT_REQUIRED) + extra)
+
+    drop_name = spec.get('希望休を外す')
+    # 表の空欄は NaN になる（NaN は真として扱われるので、文字列として中身があるかで判定する）
+    if pd.notna(drop_name) and str(drop_name).strip():
+        drop_name = str(drop_name).strip()
+        drop_idx = [i for i, sv in enumerate(problem['staff']) if sv['name'] == drop_name]
+        scenario['off_requests'] = [r for r in problem['off_requests'] if r[0] not in drop_idx]
+    return scenario
+
+class SolverWorker:
+    """shift_solver を入口にした子プロセス（python -m shift_solver）1つ。
+    実行キューのスレッドごとに1つ起動して使い回し、モデルのひな形のキャッシュを子プロセス側に残す。
+    子プロセスはこのスクリプトも Streamlit も読み込まない"""
+
+    def __init__(self):
+        # 標準エラーはパイプにすると読み残しで詰まるため一時ファイルに受け、異常終了時だけ末尾を読む
+        self.log = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen([sys.executable, "-m", "shift_solver"], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=self.log, cwd=SOLVER_DIR)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def call(self, func, args):
+        try:
+            pickle.dump((func.__name__, args), self.proc.stdin)
+            self.proc.stdin.flush()
+            status, value = pickle.load(self.proc.stdout)
+        except (EOFError, OSError, pickle.UnpicklingError):
+            if self.proc.poll() is None: self.proc.kill()
+            self.proc.wait()
+            self.log.seek(0, os.SEEK_END)
+            self.log.seek(max(0, self.log.tell() - 300))
+            tail = self.log.read().decode(errors='replace')
+            self.close()
+            raise RuntimeError(f"ソルバーの子プロセスが異常終了しました (code {self.proc.returncode}) {tail}")
+        if status != "ok": raise RuntimeError(value)
+        return value
+
+    def close(self):
+        if self.proc.poll() is None: self.proc.kill()
+        self.proc.wait()
+        self.log.close()
+
+class FairSolverQueue:
+    """全テナント共通のソルバー実行キュー（スレッドセーフ）。
+    同時に解く数を slots に制限し、空きが出るたびにテナントを順番に回して次のジョブを選ぶ。
+    1つのテナントがシナリオをまとめて投入しても、他のテナントの計算は1つ分しか待たない"""
+
+    def __init__(self, slots, metrics):
+        self.slots = slots
+        self.metrics = metrics
+        # 各スレッドが子プロセスを1つ持って使い回す（落ちた子プロセスは次のジョブで起動し直す）
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=slots, thread_name_prefix="solver")
+        self.workers = threading.local()
+        self.queues = collections.OrderedDict()  # テナントID → 待ちジョブ (func, args, Future, 投入時刻)
+        self.running = 0
+        # 完了通知は投入と同じスレッドで即座に呼ばれることがあるため再入可能にする
+        self.lock = threading.RLock()
+
+    def submit(self, tenant_id, func, *args):
+        fut = concurrent.futures.Future()
+        with self.lock:
+            self.queues.setdefault(tenant_id, collections.deque()).append((func, args, fut, time.perf_counter()))
+            self._dispatch()
+        return fut
+
+    def pending(self):
+        """テナントごとの待ちジョブ数"""
+        with self.lock:
+            return {tid: len(q) for tid, q in self.queues.items()}
+
+    def _dispatch(self):
+        while self.running < self.slots and self.queues:
+            # 先頭のテナントから1件取り出し、そのテナントは列の最後に回す（ラウンドロビン）
+            tenant_id, q = self.queues.popitem(last=False)
+            func, args, fut, queued_at = q.popleft()
+            if q: self.queues[tenant_id] = q
+            if not fut.set_running_or_notify_cancel(): continue
+            self.metrics.record("solver.queue", time.perf_counter() - queued_at, tenant=tenant_id)
+            try:
+                inner = self.pool.submit(self._run, func, args)
+            except Exception as e:
+                fut.set_exception(e)
+                continue
+            self.running += 1
+            inner.add_done_callback(functools.partial(self._finish, fut))
+
+    def _run(self, func, args):
+        worker = getattr(self.workers, "worker", None)
+        if worker is None or not worker.alive():
+            worker = self.workers.worker = SolverWorker()
+        return worker.call(func, args)
+
+    def _finish(self, fut, inner):
+        with self.lock:
+            self.running -= 1
+            self._dispatch()
+        if inner.exception() is not None: fut.set_exception(inner.exception())
+        else: fut.set_result(inner.result())
+
+@st.cache_resource(show_spinner=False)
+def get_solver_queue():
+    return FairSolverQueue(SOLVER_SLOTS, get_metrics_store())
+
+def _solver_error(e):
+    return {"status": f"ERROR: {e}", "feasible": False, "schedule": None, "objective": None,
+            "breakdown": {}, "build_seconds": 0.0, "solve_seconds": 0.0}
+
+def _solver_cores():
+    # 全テナントの同時実行数ぶん、1つのソルバーが使うコア数を減らす
+    return max(1, (os.cpu_count() or 1) // SOLVER_SLOTS)
+
+def _solver_job(problem, decompose):
+    """1件解くための (関数, 引数)。decompose なら大人数向けの分割計算を人数に応じた制限時間で使う"""
+    if decompose:
+        limit = shift_solver.decomposed_time_limit(len(problem['staff']))
+        return shift_solver.solve_shift_decomposed, (problem, limit, _solver_cores())
+    return shift_solver.solve_shift, (problem, shift_solver.TIME_LIMIT, _solver_cores())
+
+def solve_in_queue(problem, k=1, min_distance=10, decompose=False):
+    """共通キューで1件解く。k>1 なら互いに異なる候補を k 件（リスト）、k=1 なら結果1件を返す。
+    decompose なら分割計算で解く（候補は1件のみ）"""
+    queue = get_solver_queue()
+    if k > 1 and not decompose: fut = queue.submit(TENANT_ID, shift_solver.solve_shift_pool, problem, k, min_distance, shift_solver.TIME_LIMIT, _solver_cores())
+    else:
+        fn, args = _solver_job(problem, decompose)
+        fut = queue.submit(TENANT_ID, fn, *args)
+    try:
+        result = fut.result()
+    except Exception as e:
+        return [_solver_error(e)] if k > 1 else _solver_error(e)
+    return [result] if k > 1 and decompose else result
+
+def run_scenarios(problems):
+    """[(シナリオ名, problem)] を共通キューに投入して解き、[(シナリオ名, result)] を返す。
+    DECOMPOSE_MIN_STAFF 人以上のシナリオは分割計算で解く"""
+    if not problems: return []
+    queue = get_solver_queue()
+    futures = []
+    for _, p in problems:
+        fn, args = _solver_job(p, len(p['staff']) >= shift_solver.DECOMPOSE_MIN_STAFF)
+        futures.append(queue.submit(TENANT_ID, fn, *args))
+    results = []
+    for (name, _), fut in zip(problems, futures):
+        try:
+            results.append((name, fut.result()))
+        except Exception as e:
+            results.append((name, _solver_error(e)))
+    return results
+
+def schedule_frame(ctx, problem, result):
+    """解をスタッフ×"M/D"の DataFrame にする"""
+    return pd.DataFrame(result['schedule'], index=[s['name'] for s in problem['staff']], columns=ctx.labels)
+
+def month_history(ctx, names):
+    """ログから 前月末(WINDOW-1)日の出勤（スタッフ×日, 1/0）と、今年のほかの月の休日数 を返す"""
+    ldf = st.session_state.master_log
+    return session_memo("month_history", ldf, (ctx.year, ctx.month, tuple(names)), lambda: _month_history(ctx, names, ldf))
+
+def _month_history(ctx, names, ldf):
+    lookback = shift_solver.WINDOW - 1
+    prev = np.zeros((len(names), lookback), dtype=np.int64)
+    prior_off = np.zeros(len(names), dtype=np.int64)
+    if ldf is None or ldf.empty: return prev, prior_off
+    first = pd.Timestamp(ctx.year, ctx.month, 1)
+    days = pd.date_range(first - pd.Timedelta(days=lookback), periods=lookback)
+    tail = ldf.drop_duplicates('日付', keep='last').set_index('日付').reindex(index=days, columns=names)
+    prev = tail.eq(1).to_numpy(dtype=bool, na_value=False).T.astype(np.int64)
+    p_logs = ldf[(ldf['日付'].dt.year == ctx.year) & (ldf['日付'].dt.month != ctx.month)]
+    prior_off = (p_logs.reindex(columns=names) == 0).sum().to_numpy()
+    return prev, prior_off
+
+# --- ルール検証 ---
+
+VIOLATION_COLUMNS = ["ルール", "名前", "日付", "内容"]
+
+def _staff_rule_info(names):
+    """ルール検証用のスタッフ情報。マスタにいない（退職した）人はスキル・休日のチェックを満たす扱いにする"""
+    master = {s['name']: s for s in get_staff_list()}
+    staff = [master.get(nm, {"name": nm, "jp": True, "en": True, "vet": True}) for nm in names]
+    off_limit = [float(master[nm]['holiday_target']) if nm in master else np.inf for nm in names]
+    return staff, off_limit
+
+def check_draft_rules(ctx, draft_df, names):
+    """仮シフト（スタッフ×"M/D"）を処理月の規則で点検し、違反をDataFrameで返す"""
+    mat = draft_df.reindex(index=names, columns=ctx.labels).to_numpy(dtype=float, na_value=np.nan)
+    fixed = np.zeros(ctx.num_days, dtype=bool)
+    if ctx.month == 1 and ctx.num_days >= 4: fixed[3] = True
+    staff, off_limit = _staff_rule_info(names)
+    prev, prior_off = month_history(ctx, names)
+    found = shift_solver.validate_schedule(mat, staff, ctx.labels, ctx.requirements, ctx.holiday_mask, fixed,
+                                           prev, prior_off, off_limit, year_end=(ctx.month == 12))
+    return pd.DataFrame(found, columns=VIOLATION_COLUMNS)
+
+def check_log_rules(log_df, years):
+    """確定ログの指定年を規則で点検する（必要人数はアーカイブにある日だけ確認）"""
+    found = []
+    if log_df is None or log_df.empty: return pd.DataFrame(columns=VIOLATION_COLUMNS)
+    log_df = log_df.dropna(subset=['日付']).drop_duplicates('日付', keep='last').sort_values('日付')
+    names = [c for c in log_df.columns if c not in ('日付', '曜日')]
+    # 文字列のまま残した列（手入力のメモなど）の数値以外のセルは空欄として扱う
+    shifts = log_df[names].apply(pd.to_numeric, errors='coerce')
+    staff, off_limit = _staff_rule_info(names)
+    ph_df = st.session_state.master_ph
+    ph_dates = set(ph_df['date'].dropna().dt.date) if ph_df is not None and not ph_df.empty else set()
+    reqs = query_archived_requirements(list(years))
+    req_by_date = {} if reqs is None else dict(zip(pd.to_datetime(reqs['日付']), reqs['必要人数']))
+    lookback = shift_solver.WINDOW - 1
+    for y in sorted(years):
+        in_year = log_df['日付'].dt.year == y
+        part = log_df[in_year]
+        if part.empty: continue
+        dts = part['日付']
+        before = log_df[log_df['日付'] < dts.iloc[0]].tail(lookback)
+        found += shift_solver.validate_schedule(
+            shifts[in_year].to_numpy(dtype=float, na_value=np.nan).T, staff, list(dts.dt.strftime('%Y-%m-%d')),
+            required=[req_by_date.get(d, np.nan) for d in dts],
+            holidays=dts.dt.date.isin(ph_dates).to_numpy(),
+            fixed=((dts.dt.month == 1) & (dts.dt.day == 4)).to_numpy(),
+            prev=shifts.loc[before.index].to_numpy(dtype=float, na_value=np.nan).T,
+            off_limit=off_limit,
+            year_end=(dts.iloc[-1].month == 12 and dts.iloc[-1].day == 31))
+    return pd.DataFrame(found, columns=VIOLATION_COLUMNS)
+
+def new_violations(before, after):
+    """変更後に新しく出た違反だけを返す"""
+    keys = ["ルール", "名前", "日付"]
+    merged = after.merge(before[keys].drop_duplicates(), on=keys, how='left', indicator=True)
+    return merged[merged['_merge'] == 'left_only'].drop(columns='_merge').reset_index(drop=True)
+
+def runs_for_month(runs, ctx, staffs):
+    """処理年月や人員が変わる前の古い計算結果を除く"""
+    names = [s['name'] for s in staffs]
+    return [r for r in runs if (r[1].get('year'), r[1]['month']) == (ctx.year, ctx.month) and r[1]['num_days'] == ctx.num_days
+            and [sv['name'] for sv in r[1]['staff']] == names]
+
+def compare_scenarios(ctx, runs):
+    """シナリオごとの 実行可否・目的関数の内訳・休日数/週末出勤の幅 と、スタッフ別の表を返す"""
+    rows = []
+    per_staff = {}
+    for name, problem, result in runs:
+        row = {"シナリオ": name, "結果": result['status'], "目的関数": result['objective']}
+        row.update({k: result['breakdown'].get(k) for k in ("人数ズレ", "休日超過", "3連休", "週末偏り")})
+        if result['feasible']:
+            df = schedule_frame(ctx, problem, result)
+            off = (df == 0).sum(axis=1)
+            weekend = df.iloc[:, problem['weekend_idx']].sum(axis=1)
+            row["休日数"] = f"{off.min()}〜{off.max()}"
+            row["週末出勤"] = f"{weekend.min()}〜{weekend.max()}"
+            per_staff[f"{name}:休日"] = off
+            per_staff[f"{name}:週末"] = weekend
+        row["計算時間(秒)"] = round(result['build_seconds'] + result['solve_seconds'], 1)
+        rows.append(row)
+    return pd.DataFrame(rows), pd.DataFrame(per_staff)
+
+# =========================================================
+# 📚 確定シフトのアーカイブ (長期集計用)
+# =========================================================
+# 確定した月を 年/月 で分割したParquetデータセットに書き出し、
+# 複数年の集計はライブのシートに触れずにここから計算する。
+# シフトは1日1行のビット列（スタッフ番号ごとに1ビット）で持つので、人が増えても過去の行は伸びず、
+# 日ごとの人数・スキル別人数は AND と popcount だけで数えられる
+
+ARCHIVE_DIR = tenant_dir("archive")
+ARCHIVE_SHIFTS = os.path.join(ARCHIVE_DIR, "shift_bits")
+ARCHIVE_REQS = os.path.join(ARCHIVE_DIR, "requirements")
+STAFF_INDEX_PATH = os.path.join(ARCHIVE_DIR, "staff_index.json")
+STAFF_INDEX_LOCK = STAFF_INDEX_PATH + ".lock"
+STAFF_INDEX_LOCK_WAIT = 10.0   # ほかのプロセスが番号を付けている間に待つ秒数
+STAFF_INDEX_LOCK_STALE = 60.0  # これより古いロックファイルは落ちたプロセスの残りとみなして消す
+# 1日1行。出勤/記録 は スタッフ番号(ビット位置)ごとの 1/0 をリトルエンディアンで詰めたビット列
+# （記録が0のビットは 在籍前・退職後などの空欄）。スタッフが増えても過去の行は書き換えない。
+# en/jp/vet は書き出した時点のマスタでそのスキルを持つ人、スキル記録 はスキルが分かっている人（マスタにいた人）のビット列。
+# これらがない古い行は、今のマスタで数える
+SHIFT_SCHEMA = pa.schema([("日付", pa.date32()), ("出勤", pa.binary()), ("記録", pa.binary()),
+                          ("スキル記録", pa.binary()), ("en", pa.binary()), ("jp", pa.binary()), ("vet", pa.binary())])
+REQ_SCHEMA = pa.schema([("日付", pa.date32()), ("必要人数", pa.int16())])
+ARCHIVE_PARTITIONING = pads.partitioning(pa.schema([("year", pa.int32()), ("month", pa.int32())]), flavor="hive")
+SKILL_LABELS = {"en": "English", "jp": "Japanese", "vet": "Veterans"}
+
+def log_to_long(log_df):
+    """横持ちのログ(日付・曜日・スタッフ名の列)を 日付/名前/勤務 の縦持ちに変換する"""
+    if log_df is None or log_df.empty: return pd.DataFrame(columns=["日付", "名前", "勤務"])
+    df = log_df.copy()
+    df['日付'] = pd.to_datetime(df['日付'], errors='coerce')
+    df = df.dropna(subset=['日付'])
+    staff_cols = [c for c in df.columns if c not in ('日付', '曜日')]
+    long_df = df.melt(id_vars=['日付'], value_vars=staff_cols, var_name='名前', value_name='勤務')
+    long_df['勤務'] = pd.to_numeric(long_df['勤務'], errors='coerce')
+    # 空欄（在籍前・退職後の日）は記録しない
+    long_df = long_df.dropna(subset=['勤務'])
+    long_df['勤務'] = long_df['勤務'].astype('int8')
+    long_df['日付'] = long_df['日付'].dt.date
+    return long_df.reset_index(drop=True)
+
+# --- ビット詰めの確定シフト ---
+
+@st.cache_resource
+def _staff_index_lock(tenant_id):
+    return threading.Lock()
+
+@contextlib.contextmanager
+def _staff_index_file_lock():
+    """ほかのプロセス（レプリカ）とのスタッフ番号の排他。ロックファイルを排他的に作れた方が番号を付ける"""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    deadline = time.monotonic() + STAFF_INDEX_LOCK_WAIT
+    while True:
+        try:
+            fd = os.open(STAFF_INDEX_LOCK, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(STAFF_INDEX_LOCK) > STAFF_INDEX_LOCK_STALE:
+                    os.remove(STAFF_INDEX_LOCK)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"スタッフ番号のロックを取得できませんでした: {STAFF_INDEX_LOCK}")
+            time.sleep(0.05)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield
+    finally:
+        try: os.remove(STAFF_INDEX_LOCK)
+        except FileNotFoundError: pass
+
+def load_staff_index():
+    """アーカイブのスタッフ番号 {名前: ビット位置}（番号は追加のみで、一度付けたら変えない）"""
+    try:
+        with open(STAFF_INDEX_PATH, encoding="utf-8") as f: names = json.load(f)
+    except FileNotFoundError:
+        names = []
+    return {nm: i for i, nm in enumerate(names)}
+
+def ensure_staff_index(names):
+    """names のうち番号のない人に新しい番号を付けて保存し、全体の {名前: ビット位置} を返す"""
+    index = load_staff_index()
+    if all(nm in index for nm in names): return index
+    with _staff_index_lock(TENANT_ID), _staff_index_file_lock():
+        # ロックを取る間にほかのプロセスが付けた番号を読み直してから追加する
+        index = load_staff_index()
+        added = [nm for nm in dict.fromkeys(names) if nm not in index]
+        if added:
+            for nm in added: index[nm] = len(index)
+            os.makedirs(ARCHIVE_DIR, exist_ok=True)
+            tmp_path = f"{STAFF_INDEX_PATH}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f: json.dump(list(index), f, ensure_ascii=False)
+            os.replace(tmp_path, STAFF_INDEX_PATH)
+        return index
+
+def _skill_bits(staff_df, index, width):
+    """マスタから {"スキル記録"/スキル: 1行分のビット列} を作る（index にいる人だけ）"""
+    master = staff_df if staff_df is not None else pd.DataFrame(columns=['name', *SKILL_LABELS])
+    rows = master[master['name'].isin(list(index))]
+    out = {}
+    skills = ((k, rows[k].astype(bool) if k in rows.columns else pd.Series(False, index=rows.index)) for k in SKILL_LABELS)
+    for col, flags in (("スキル記録", pd.Series(True, index=rows.index)), *skills):
+        bits = np.zeros(width, dtype=bool)
+        bits[[index[nm] for nm in rows.loc[flags, 'name']]] = True
+        out[col] = np.packbits(bits, bitorder='little').tobytes()
+    return out
+
+def pack_log(log_df, index, staff_df=None):
+    """横持ちのログを 日付/出勤/記録 の1日1行に詰める（同じ日付は後の行を使う）。index: {名前: ビット位置}。
+    staff_df を渡すと、その時点のスキルも各行に残す"""
+    if log_df is None or log_df.empty: return pd.DataFrame(columns=SHIFT_SCHEMA.names)
+    df = log_df.assign(日付=pd.to_datetime(log_df['日付'], errors='coerce')).dropna(subset=['日付'])
+    df = df.drop_duplicates('日付', keep='last').sort_values('日付')
+    names = [c for c in df.columns if c not in ('日付', '曜日')]
+    vals = df[names].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    bits = np.array([index[nm] for nm in names], dtype=np.int64)
+    width = (len(index) + 7) // 8 * 8
+    on = np.zeros((len(df), width), dtype=bool)
+    known = np.zeros((len(df), width), dtype=bool)
+    on[:, bits] = vals == 1
+    known[:, bits] = ~np.isnan(vals)
+    on_bytes = np.packbits(on, axis=1, bitorder='little')
+    known_bytes = np.packbits(known, axis=1, bitorder='little')
+    skills = _skill_bits(staff_df, index, width) if staff_df is not None else dict.fromkeys(SHIFT_SCHEMA.names[3:])
+    return pd.DataFrame({"日付": df['日付'].dt.date.to_numpy(),
+                         "出勤": [r.tobytes() for r in on_bytes], "記録": [r.tobytes() for r in known_bytes],
+                         **{col: [b] * len(df) for col, b in skills.items()}})
+
+def _bit_words(col, n_words):
+    """ビット列の列を 日数×n_words の uint64 行列にする（短い行は0で埋める）"""
+    out = np.zeros((len(col), n_words * 8), dtype=np.uint8)
+    for i, b in enumerate(col):
+        out[i, :len(b)] = np.frombuffer(b, dtype=np.uint8)
+    return out.view('<u8')
+
+def _n_words(packed_df, index):
+    longest = max((len(b) for b in packed_df['記録']), default=0)
+    return max(-(-len(index) // 64), -(-longest // 8), 1)
+
+def unpack_log(packed_df, index, names=None):
+    """詰めたシフトを今のログと同じ横持ち（日付・曜日・スタッフ名の列, Int8, 記録のない日は空欄）に戻す"""
+    names = list(index) if names is None else [nm for nm in names if nm in index]
+    n_words = _n_words(packed_df, index)
+    on = np.unpackbits(_bit_words(packed_df['出勤'], n_words).view(np.uint8), axis=1, bitorder='little')
+    known = np.unpackbits(_bit_words(packed_df['記録'], n_words).view(np.uint8), axis=1, bitorder='little')
+    bits = [index[nm] for nm in names]
+    dates = pd.to_datetime(packed_df['日付']).reset_index(drop=True)
+    values = pd.DataFrame(on[:, bits], columns=names).astype('Int8').where(known[:, bits].astype(bool))
+    out = pd.concat([pd.DataFrame({"日付": dates, "曜日": [WEEKDAY_JP[d.weekday()] for d in dates]}), values], axis=1)
+    # 期間中に記録が1日もない人（期間外に在籍）の列は落とす
+    return out.drop(columns=[nm for nm, k in zip(names, known[:, bits].any(axis=0)) if not k])
+
+def daily_skill_counts(packed_df, index, staff_df):
+    """詰めたシフトから日ごとの 勤務人数 と スキル別の人数 をビット演算(AND + popcount)で数える。
+    スキルは行に残したもの（なければ今のマスタ）を使い、スキルの分からない人が出勤した日のスキル別人数は空欄にする"""
+    cols = ["勤務人数", *SKILL_LABELS.values()]
+    if packed_df.empty: return pd.DataFrame(columns=cols)
+    n_words = _n_words(packed_df, index)
+    on = _bit_words(packed_df['出勤'], n_words)
+    out = pd.DataFrame(index=pd.to_datetime(packed_df['日付']).rename('日付'))
+    out['勤務人数'] = np.bitwise_count(on).sum(axis=1).astype('int64')
+    # スキルを残していない行は、今のマスタのビット列で置き換える
+    current = _skill_bits(staff_df, index, n_words * 64)
+    def words(col):
+        stored = packed_df[col] if col in packed_df.columns else pd.Series(None, index=packed_df.index, dtype=object)
+        return _bit_words([current[col] if b is None else b for b in stored], n_words)
+    unknown = np.bitwise_count(on & ~words("スキル記録")).sum(axis=1) > 0
+    for key, label in SKILL_LABELS.items():
+        counts = pd.array(np.bitwise_count(on & words(key)).sum(axis=1), dtype='Int64')
+        counts[unknown] = pd.NA
+        out[label] = counts
+    return out
+
+def _write_partition(root, df, schema, year, month):
+    """year=/month= のパーティションを丸ごと置き換える"""
+    part_dir = os.path.join(root, f"year={year}", f"month={month}")
+    os.makedirs(part_dir, exist_ok=True)
+    table = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+    # 先頭が'.'のファイルはデータセットの読み込み対象外なので書きかけが読まれることはない
+    tmp_path = os.path.join(part_dir, f".part-0.{os.getpid()}.tmp")
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, os.path.join(part_dir, "part-0.parquet"))
+
+def archive_month(log_df, requirements_df=None, staff_df=None):
+    """確定ログ（横持ち）を月ごとのパーティションに詰めて書き出し、書き出した日数を返す。
+    staff_df: 書き出す時点のスタッフマスタ（スキルを一緒に残す）"""
+    if log_df is None or log_df.empty: return 0
+    index = ensure_staff_index([c for c in log_df.columns if c not in ('日付', '曜日')])
+    packed = pack_log(log_df, index, staff_df)
+    if packed.empty: return 0
+    dts = pd.to_datetime(packed['日付'])
+    for (y, m), part in packed.groupby([dts.dt.year, dts.dt.month]):
+        _write_partition(ARCHIVE_SHIFTS, part, SHIFT_SCHEMA, y, m)
+
+    if requirements_df is not None and not requirements_df.empty:
+        req = requirements_df[['日付', '必要人数']].copy()
+        req['日付'] = pd.to_datetime(req['日付'], errors='coerce')
+        req['必要人数'] = pd.to_numeric(req['必要人数'], errors='coerce')
+        req = req.dropna()
+        for (y, m), part in req.groupby([req['日付'].dt.year, req['日付'].dt.month]):
+            part = part.assign(日付=part['日付'].dt.date, 必要人数=part['必要人数'].astype('int16'))
+            _write_partition(ARCHIVE_REQS, part, REQ_SCHEMA, y, m)
+    return len(packed)
+
+def _open_archive(root, schema):
+    """パーティション分割したアーカイブを開く（列の足りない古いファイルはその列を空として読む）"""
+    if not os.path.isdir(root): return None
+    return pads.dataset(root, schema=pa.unify_schemas([schema, ARCHIVE_PARTITIONING.schema]), format="parquet",
+                        partitioning=ARCHIVE_PARTITIONING, filesystem=pafs.LocalFileSystem(use_mmap=True))
+
+def archive_years():
+    """アーカイブに含まれる年の一覧"""
+    if not os.path.isdir(ARCHIVE_SHIFTS): return []
+    return sorted(int(d.split('=')[1]) for d in os.listdir(ARCHIVE_SHIFTS) if d.startswith('year='))
+
+def query_packed(years=None):
+    """アーカイブから詰めたままのシフト（日付/出勤/記録）を読む（メモリマップ + 年パーティションの絞り込み）"""
+    dataset = _open_archive(ARCHIVE_SHIFTS, SHIFT_SCHEMA)
+    if dataset is None: return pd.DataFrame(columns=SHIFT_SCHEMA.names)
+    flt = pads.field('year').isin(list(years)) if years else None
+    return dataset.to_table(columns=SHIFT_SCHEMA.names, filter=flt).to_pandas().sort_values('日付', ignore_index=True)
+
+def query_archive(years=None, staff=None):
+    """アーカイブから条件に合う縦持ちデータ（日付/名前/勤務/year/month）を読む"""
+    cols = ["日付", "名前", "勤務", "year", "month"]
+    packed = query_packed(years)
+    if packed.empty: return pd.DataFrame(columns=cols)
+    wide = unpack_log(packed, load_staff_index(), staff)
+    long_df = log_to_long(wide)
+    long_df['日付'] = pd.to_datetime(long_df['日付'])
+    return long_df.assign(year=long_df['日付'].dt.year, month=long_df['日付'].dt.month)[cols]
+
+def query_archived_requirements(years=None):
+    """アーカイブから日別の必要人数を読む（アーカイブがなければNone）"""
+    req_ds = _open_archive(ARCHIVE_REQS, REQ_SCHEMA)
+    if req_ds is None: return None
+    flt = pads.field('year').isin(list(years)) if years else None
+    return req_ds.to_table(columns=["日付", "必要人数"], filter=flt).to_pandas(date_as_object=False)
+
+@timed("stats.archive_staff_summary")
+def archive_staff_summary(years=None, staff=None):
+    """スタッフ×年ごとの出勤日数・休日数・土日出勤数"""
+    df = query_archive(years, staff)
+    cols = ["年", "名前", "出勤日数", "休日数", "土日出勤"]
+    if df.empty: return pd.DataFrame(columns=cols)
+    df['休日'] = (df['勤務'] == 0).astype('int16')
+    df['土日出勤'] = ((df['勤務'] == 1) & (df['日付'].dt.dayofweek >= 5)).astype('int16')
+    out = df.groupby(['year', '名前'], sort=True).agg(出勤日数=('勤務', 'sum'), 休日数=('休日', 'sum'), 土日出勤=('土日出勤', 'sum'))
+    return out.reset_index().rename(columns={'year': '年'})[cols]
+
+@timed("stats.archive_daily_summary")
+def archive_daily_summary(years=None):
+    """日ごとの勤務人数・スキル別の人数と必要人数（人数不足日の抽出用）"""
+    packed = query_packed(years)
+    daily = daily_skill_counts(packed, load_staff_index(), st.session_state.master_staff)
+    if daily.empty: return pd.DataFrame(columns=["勤務人数", *SKILL_LABELS.values(), "必要人数", "不足"])
+    reqs = query_archived_requirements(years)
+    if reqs is not None:
+        daily = daily.join(reqs.set_index('日付')['必要人数'], how='left')
+    else:
+        daily['必要人数'] = pd.NA
+    needed = daily['必要人数'].fillna(0)
+    daily['不足'] = (daily['勤務人数'] < needed) | ((needed > 0) & (daily[list(SKILL_LABELS.values())] == 0).any(axis=1))
+    return daily
+
+# =========================================================
+# 📡 確定シフトの配信 (静的ファイル)
+# =========================================================
+# 月の確定時とログの修正時に、スタッフごとの iCalendar/JSON と月ごとの一覧JSONを
+# static/feed に書き出す。.streamlit/config.toml の enableStaticServing により
+# /app/static/feed/... でそのまま配信されるので、閲覧だけならアプリもシートも使わない。
+# ファイル名は推測できないトークンにする（URLを知っている人だけが見られる）。
+# トークンの鍵は専用の feed_secret だけを使い、未設定なら配信しない。
+# feed_secret を変えて「作り直す」と、古いリンクのファイルは消える（漏れたリンクの失効に使う）
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+FEED_SUBDIR = "feed" if TENANT_ID == DEFAULT_TENANT else f"feed/{TENANT_ID}"
+FEED_DIR = os.path.join(STATIC_DIR, *FEED_SUBDIR.split("/"))
+FEED_URL_PATH = f"app/static/{FEED_SUBDIR}"
+FEED_MONTHS = 13  # 個人別ファイルに含める直近の月数
+FEED_SECRET = TENANT['feed_secret']
+FEED_BASE_URL = TENANT['public_base_url'].rstrip("/")
+FEED_EXTS = (".json", ".ics")
+
+def feed_token(kind, key):
+    """配信ファイル名に使うトークン（秘密鍵とスタッフ名/年月から作る）"""
+    return hmac.new(FEED_SECRET.encode(), f"{kind}:{key}".encode(), hashlib.sha256).hexdigest()[:24]
+
+def feed_url(file_name):
+    """配信ファイルのURL（public_base_url が未設定ならアプリのURLからの相対パス）"""
+    path = f"{FEED_URL_PATH}/{file_name}"
+    return f"{FEED_BASE_URL}/{path}" if FEED_BASE_URL else path
+
+def staff_feed_urls(name):
+    return {ext: feed_url(f"{feed_token('staff', name)}.{ext}") for ext in ("ics", "json")}
+
+def month_feed_url(year, month):
+    return feed_url(f"month-{feed_token('month', f'{year}-{month:02d}')}.json")
+
+def _write_feed_file(file_name, text):
+    path = os.path.join(FEED_DIR, file_name)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    return file_name
+
+def _remove_orphan_feeds(keep):
+    """作り直しで書かなかった配信ファイル（退職者・鍵の変更前のトークンなど）を消し、消した数を返す"""
+    removed = 0
+    for file_name in os.listdir(FEED_DIR):
+        if file_name in keep or not file_name.endswith(FEED_EXTS): continue
+        path = os.path.join(FEED_DIR, file_name)
+        if not os.path.isfile(path): continue
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+def _ical_fold(line):
+    """iCalendarの1行を75バイトごとに折り返す（マルチバイト文字の途中では切らない）"""
+    out, cur = [], ""
+    for ch in line:
+        if len((cur + ch).encode()) > (75 if not out else 74):
+            out.append(cur); cur = ""
+        cur += ch
+    out.append(cur)
+    return "\r\n ".join(out)
+
+def _ical(name, work_dates, stamp):
+    """出勤日を終日の予定にした iCalendar（行末はCRLF）"""
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//kclinic//shift//JA", "CALSCALE:GREGORIAN",
+             f"X-WR-CALNAME:確定シフト ({name})"]
+    for d in work_dates:
+        lines += ["BEGIN:VEVENT", f"UID:{d:%Y%m%d}-{feed_token('staff', name)}@kclinic-shift", f"DTSTAMP:{stamp}",
+                  f"DTSTART;VALUE=DATE:{d:%Y%m%d}", f"DTEND;VALUE=DATE:{d + datetime.timedelta(days=1):%Y%m%d}",
+                  "SUMMARY:出勤", "TRANSP:TRANSPARENT", "END:VEVENT"]
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(_ical_fold(l) for l in lines) + "\r\n"
+
+@timed("feed.publish")
+def publish_feeds(log_df, staff_df, months=None):
+    """確定ログから配信ファイルを書き出し、書き出したファイル数を返す。
+    months: 一覧JSONを作り直す (年, 月)（Noneならログにある全ての月を作り直し、書かなかったファイルは消す）"""
+    if not FEED_SECRET: return 0
+    long_df = log_to_long(log_df)
+    if long_df.empty: return 0
+    os.makedirs(FEED_DIR, exist_ok=True)
+    long_df['日付'] = pd.to_datetime(long_df['日付'])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    stamp = now.strftime('%Y%m%dT%H%M%SZ')
+    updated = now.isoformat(timespec='seconds')
+    written = set()
+
+    # スタッフごと: 直近 FEED_MONTHS か月の勤務と、今年の休日の消化状況
+    latest = long_df['日付'].max()
+    since = (latest - pd.offsets.MonthBegin(FEED_MONTHS)).normalize()
+    targets = {}
+    if staff_df is not None and not staff_df.empty:
+        targets = dict(zip(staff_df['name'], pd.to_numeric(staff_df['holiday_target'], errors='coerce').fillna(0).astype(int)))
+    for name, rows in long_df[long_df['日付'] >= since].groupby('名前', sort=False):
+        rows = rows.sort_values('日付')
+        this_year = long_df[(long_df['名前'] == name) & (long_df['日付'].dt.year == latest.year)]
+        taken = int((this_year['勤務'] == 0).sum())
+        target = int(targets.get(name, 0))
+        doc = {"name": name, "updated": updated,
+               "holidays": {"year": int(latest.year), "付与": target, "消化": taken, "残": target - taken},
+               "days": [{"date": f"{d:%Y-%m-%d}", "work": int(w)} for d, w in zip(rows['日付'], rows['勤務'])]}
+        token = feed_token('staff', name)
+        written.add(_write_feed_file(f"{token}.json", json.dumps(doc, ensure_ascii=False, separators=(',', ':'))))
+        written.add(_write_feed_file(f"{token}.ics", _ical(name, [d.date() for d in rows.loc[rows['勤務'] == 1, '日付']], stamp)))
+
+    # 月ごとの一覧: 日付の並びと、スタッフごとの "1"(出勤)/"0"(休み)/"-"(在籍なし) の文字列
+    for (y, m), part in long_df.groupby([long_df['日付'].dt.year, long_df['日付'].dt.month]):
+        if months is not None and (y, m) not in months: continue
+        grid = part.pivot_table(index='名前', columns='日付', values='勤務', aggfunc='last', sort=True)
+        doc = {"year": int(y), "month": int(m), "updated": updated,
+               "dates": [f"{d:%Y-%m-%d}" for d in grid.columns],
+               "weekdays": [WEEKDAY_JP[d.weekday()] for d in grid.columns],
+               "staff": {nm: "".join("-" if pd.isna(v) else str(int(v)) for v in row) for nm, row in grid.iterrows()}}
+        written.add(_write_feed_file(f"month-{feed_token('month', f'{y}-{m:02d}')}.json", json.dumps(doc, ensure_ascii=False, separators=(',', ':'))))
+    if months is None: _remove_orphan_feeds(written)
+    return len(written)
+
 # =========================================================
 # 🚪 ログイン画面
 # =========================================================
+TENANT_SESSION_KEYS = ["master_staff", "master_ph", "master_log", "req_off_data", "req_chg_data", "schedule_df"]
+
+def switch_tenant():
+    """ログイン画面でテナントを切り替えたら、前のテナントのデータをセッションから外す（次の実行で読み直される）"""
+    tenant_id = st.session_state.login_tenant
+    if tenant_id == st.session_state.tenant_id: return
+    st.session_state.tenant_id = tenant_id
+    st.query_params["tenant"] = tenant_id
+    for key in TENANT_SESSION_KEYS: st.session_state[key] = None
+    st.session_state.daily_reqs = {}
+    st.session_state.scenario_runs = []
+    st.session_state.solution_pool = []
+    st.session_state.pop("_session_memo", None)
+
 def login_screen():
     st.title("🏥 シフト管理システム")
+    if len(TENANTS) > 1:
+        st.selectbox("病院・病棟", list(TENANTS), index=list(TENANTS).index(TENANT_ID), key="login_tenant",
+                     format_func=lambda tid: TENANTS[tid]['label'], on_change=switch_tenant)
     st.markdown("IDとパスワードを入力してログインしてください。")
 
     with st.form("login_form"):
@@ -350,7 +2226,7 @@ def login_screen():
             input_id = user_id.strip()
             input_pass = password.strip()
 
-            if input_id == DEFAULT_SUPER_ADMIN_ID and input_pass == DEFAULT_SUPER_ADMIN_PASS:
+            if input_id == DEFAULT_SUPER_ADMIN_ID and input_pass == TENANT['super_admin_pass']:
                 st.session_state.user_role = "admin"
                 st.session_state.user_name = "Super Admin"
                 with st.spinner("データ同期中..."):
@@ -398,6 +2274,7 @@ def staff_screen():
     default_date = datetime.date(target_y, target_m, 1)
     
     st.sidebar.title(f"👤 {user_name}")
+    if TENANT['label']: st.sidebar.caption(f"🏥 {TENANT['label']}")
     
     phase_colors = {
         "0_通常": "blue",
@@ -428,28 +2305,16 @@ def staff_screen():
     staffs = get_staff_list()
     
     # 変更申請データのロード（履歴表示と重複防止用）
-    df_chg = load_data("変更申請", ["タイムスタンプ", "名前", "日付", "種別", "備考", "ステータス"])
+    df_chg = load_requests("変更申請")
     my_active_reqs = pd.DataFrame()
     if not df_chg.empty:
-        df_chg['dt'] = pd.to_datetime(df_chg['日付'], errors='coerce')
         mask = (df_chg['名前'] == user_name) & \
                (df_chg['ステータス'] != '取り消し') & \
-               (df_chg['dt'].dt.year == target_y) & \
-               (df_chg['dt'].dt.month == target_m)
+               (df_chg['日付'].dt.year == target_y) & \
+               (df_chg['日付'].dt.month == target_m)
         my_active_reqs = df_chg[mask].copy()
-        
-        if not my_active_reqs.empty:
-            my_active_reqs['original_idx'] = my_active_reqs.index + 2 
 
-    req_map = {}
-    req_df = load_data("draft_requirements")
-    if not req_df.empty:
-        for _, r in req_df.iterrows():
-            try:
-                d = pd.to_datetime(r['日付'])
-                if d.year == target_y and d.month == target_m:
-                    req_map[d.day - 1] = int(r['必要人数'])
-            except: pass
+    ctx = get_month_context(target_y, target_m)
 
     # ----------------------------------------------------------------
     # 📝 希望休(初期)
@@ -461,35 +2326,59 @@ def staff_screen():
         else:
             st.info("希望休申請です。2か月前10日までに申請してください。それ以降に申請されたものはは反映されません。2ヶ月後以降先の予定も申請可能です。")
         
+        df_req = load_requests("希望休")
+        requested_off_dates = set()
+        if not df_req.empty:
+            mine = df_req[(df_req['名前'] == user_name) & (df_req['ステータス'] != '取り消し')]
+            requested_off_dates = set(mine['日付'].dropna().dt.date)
+
         with st.form("req_form"):
-            d = st.date_input("日付", value=default_date)
+            picked = st.date_input("日付（期間を選ぶとまとめて申請できます）", value=(default_date, default_date))
             # 備考欄削除
             if st.form_submit_button("送信"):
-                ts = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
-                res, msg = append_row_data("希望休", [ts, user_name, str(d), "", "申請"])
-                if res: st.success("申請しました"); st.rerun()
-                else: st.error(msg)
+                # 期間を1日ずつに展開し、申請済みの日は送信前に除外する
+                if isinstance(picked, (tuple, list)):
+                    start = picked[0]
+                    end = picked[-1] if len(picked) > 1 else picked[0]
+                else:
+                    start = end = picked
+                dates = [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+                new_dates = [d for d in dates if d not in requested_off_dates]
+
+                if not new_dates:
+                    st.warning("選択した日はすべて申請済みです")
+                else:
+                    res, msg = submit_requests("希望休", [{"名前": user_name, "日付": str(d)} for d in new_dates])
+                    if res:
+                        skipped = len(dates) - len(new_dates)
+                        st.success(f"{len(new_dates)}日分を申請しました" + (f"（申請済み{skipped}日は除外）" if skipped else ""))
+                        st.rerun()
+                    else: st.error(msg)
 
         st.subheader("▼ 申請済みリスト")
-        df_req = load_data("希望休", ["タイムスタンプ", "名前", "日付", "備考", "ステータス"])
         if not df_req.empty:
-            valid_recs = []
-            for i, r in enumerate(df_req.to_dict('records')):
-                if r['名前'] == user_name:
-                    r['_row_idx'] = i + 2
-                    valid_recs.append(r)
-            valid_recs = [r for r in valid_recs if r.get('ステータス') != '取り消し']
-            valid_recs = sorted(valid_recs, key=lambda x: x['日付'])
+            mine = df_req[(df_req['名前'] == user_name) & (df_req['ステータス'] != '取り消し')].dropna(subset=['日付'])
+            valid_recs = mine.sort_values('日付').to_dict('records')
 
             if valid_recs:
+                if len(valid_recs) > 1:
+                    with st.form("bulk_cancel_form"):
+                        label_by_id = {r['ID']: f"{r['日付']:%Y-%m-%d}" for r in valid_recs if r['ID']}
+                        cancel_ids = st.multiselect("まとめて取り消す申請", list(label_by_id), format_func=lambda rid: label_by_id[rid])
+                        if st.form_submit_button("選択した申請を取り消す"):
+                            res, msg = update_request_statuses("希望休", {rid: "取り消し" for rid in cancel_ids})
+                            if res: st.success("取り消しました"); st.rerun()
+                            else: st.error(msg)
+
                 for i, r in enumerate(valid_recs):
                     with st.container():
                         ca, cb = st.columns([4, 2])
-                        with ca: st.write(f"📅 **{r['日付']}**")
+                        with ca: st.write(f"📅 **{r['日付']:%Y-%m-%d}**")
                         with cb:
                             if st.button("取り消し", key=f"can_req_{i}"):
-                                update_cell_value("希望休", r['_row_idx'], 5, "取り消し")
-                                st.success("取り消しました"); st.rerun()
+                                res, msg = update_request_statuses("希望休", {r['ID']: "取り消し"})
+                                if res: st.success("取り消しました"); st.rerun()
+                                else: st.error(msg)
                         st.markdown("---")
             else: st.info("有効な申請はありません")
         else: st.info("申請はありません")
@@ -509,22 +2398,16 @@ def staff_screen():
             
             if user_name in df_draft_idx.index:
                 my_row = df_draft_idx.loc[user_name]
-                st.dataframe(pd.DataFrame([my_row.replace({'1':'●','0':'-'})]), use_container_width=True)
+                st.dataframe(to_shift_marks(pd.DataFrame([my_row])), use_container_width=True)
 
                 requested_add_dates = set()
                 if not my_active_reqs.empty:
                     add_reqs = my_active_reqs[my_active_reqs['種別'] == '出勤希望']
-                    for _, r in add_reqs.iterrows():
-                        requested_add_dates.add(r['dt'].date())
+                    requested_add_dates = set(add_reqs['日付'].dropna().dt.date)
 
-                rest_days = []
-                for col in df_draft_idx.columns:
-                    if str(my_row[col]) == '0':
-                        try:
-                            d_obj = pd.to_datetime(f"{target_y}/{col}").date()
-                            if d_obj not in requested_add_dates:
-                                rest_days.append(col)
-                        except: pass
+                rest_days = [col for col in df_draft_idx.columns
+                             if my_row[col] == 0 and ctx.index_of(col) is not None
+                             and ctx.date_of(col) not in requested_add_dates]
                 
                 st.divider()
                 st.markdown("##### 申請フォーム")
@@ -532,27 +2415,31 @@ def staff_screen():
                     st.success("追加申請可能な日（休み、かつ未申請の日）はありません。")
                 else:
                     with st.form("add_work_form"):
-                        target_day_str = st.selectbox("出勤に変更したい日", rest_days)
+                        target_day_strs = st.multiselect("出勤に変更したい日（複数選択可）", rest_days)
                         # 備考欄削除
                         if st.form_submit_button("出勤申請を送る"):
-                            d_obj = pd.to_datetime(f"{target_y}/{target_day_str}").date()
-                            ts = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
-                            res, msg = append_row_data("変更申請", [ts, user_name, str(d_obj), "出勤希望", "", "申請"])
-                            if res: st.success("出勤申請を送りました"); st.rerun()
-                            else: st.error(msg)
+                            if not target_day_strs:
+                                st.warning("日付を選択してください")
+                            else:
+                                rows = [{"名前": user_name, "日付": str(ctx.date_of(day_str)), "種別": "出勤希望"}
+                                        for day_str in target_day_strs]
+                                res, msg = submit_requests("変更申請", rows)
+                                if res: st.success(f"出勤申請を{len(rows)}件送りました"); st.rerun()
+                                else: st.error(msg)
                 
                 # --- 履歴と取り消し ---
                 st.markdown("##### ▼ 申請中の出勤希望")
                 if not my_active_reqs.empty:
-                    adds = my_active_reqs[my_active_reqs['種別'] == '出勤希望'].sort_values('dt')
+                    adds = my_active_reqs[my_active_reqs['種別'] == '出勤希望'].sort_values('日付')
                     if not adds.empty:
                         for i, row in adds.iterrows():
                             with st.container():
                                 c1, c2 = st.columns([4, 2])
-                                c1.write(f"📅 **{row['日付']}**")
+                                c1.write(f"📅 **{row['日付']:%Y-%m-%d}**")
                                 if c2.button("取り消し", key=f"cnl_add_{i}"):
-                                    update_cell_value("変更申請", row['original_idx'], 6, "取り消し")
-                                    st.success("取り消しました"); st.rerun()
+                                    res, msg = update_request_statuses("変更申請", {row['ID']: "取り消し"})
+                                    if res: st.success("取り消しました"); st.rerun()
+                                    else: st.error(msg)
                                 st.markdown("---")
                     else: st.info("申請中のものはありません")
                 else: st.info("申請中のものはありません")
@@ -577,54 +2464,61 @@ def staff_screen():
             else:
                 my_row = df_draft_idx.loc[user_name]
                 st.markdown("##### ▼ あなたの仮シフト")
-                st.dataframe(pd.DataFrame([my_row.replace({'1':'●','0':'-'})]), use_container_width=True)
+                st.dataframe(to_shift_marks(pd.DataFrame([my_row])), use_container_width=True)
 
                 requested_reduce_dates = set()
                 if not my_active_reqs.empty:
                     red_reqs = my_active_reqs[my_active_reqs['種別'] == '休み希望']
-                    for _, r in red_reqs.iterrows():
-                        requested_reduce_dates.add(r['dt'].date())
+                    requested_reduce_dates = set(red_reqs['日付'].dropna().dt.date)
 
                 available_rest_options = []
                 for col in df_draft_idx.columns:
-                    if str(df_draft_idx.at[user_name, col]) == '0': continue
-                    try:
-                        d_obj = pd.to_datetime(f"{target_y}/{col}").date()
-                        if d_obj in requested_reduce_dates: continue
-                        day_idx = d_obj.day - 1
-                        col_data = df_draft_idx[col].to_dict()
-                        col_data[user_name] = '0'
-                        is_ok, reason = check_daily_constraints(staffs, col_data, req_map, day_idx)
-                        if is_ok:
-                            available_rest_options.append(col)
-                    except: pass
+                    if not is_on(df_draft_idx.at[user_name, col]): continue
+                    day_idx = ctx.index_of(col)
+                    if day_idx is None or ctx.dates[day_idx] in requested_reduce_dates: continue
+                    col_data = df_draft_idx[col].to_dict()
+                    col_data[user_name] = 0
+                    is_ok, reason = check_daily_constraints(staffs, col_data, ctx.required_map, day_idx)
+                    if is_ok:
+                        available_rest_options.append(col)
                 
+                # 他の人の申請も含めた抽選を繰り返し再現した承認見込み
+                estimates = approval_estimates(ctx, user_name, df_draft_idx, staffs, df_chg)
+
                 st.divider()
                 st.markdown("##### 申請フォーム")
                 if not available_rest_options:
                     st.warning("現在、申請可能な日（出勤、かつ未申請、かつ人員余裕あり）はありません。")
                 else:
+                    with st.expander("🎲 日ごとの承認見込み（抽選を繰り返し再現した推定）", expanded=True):
+                        st.caption("現在の申請がすべて抽選にかけられた場合に、その日の休み希望が承認される確率です。申請が増えると変わります。")
+                        st.dataframe(estimates.style.format({"承認見込み": "{:.0%}"}), use_container_width=True)
                     with st.form("reduce_work_form"):
-                        target_day_str = st.selectbox("休みに変更したい日", available_rest_options)
+                        target_day_strs = st.multiselect("休みに変更したい日（複数選択可）", available_rest_options)
                         # 備考欄削除
                         if st.form_submit_button("休み申請を送る（抽選対象）"):
-                            d_obj = pd.to_datetime(f"{target_y}/{target_day_str}").date()
-                            ts = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
-                            res, msg = append_row_data("変更申請", [ts, user_name, str(d_obj), "休み希望", "", "申請"])
-                            if res: st.success("休み申請を送りました（抽選待ち）"); st.rerun()
+                            if not target_day_strs:
+                                st.warning("日付を選択してください")
+                            else:
+                                rows = [{"名前": user_name, "日付": str(ctx.date_of(day_str)), "種別": "休み希望"}
+                                        for day_str in target_day_strs]
+                                res, msg = submit_requests("変更申請", rows)
+                                if res: st.success(f"休み申請を{len(rows)}件送りました（抽選待ち）"); st.rerun()
+                                else: st.error(msg)
 
                 # --- 履歴と取り消し ---
                 st.markdown("##### ▼ 申請中の休み希望")
                 if not my_active_reqs.empty:
-                    reds = my_active_reqs[my_active_reqs['種別'] == '休み希望'].sort_values('dt')
+                    reds = my_active_reqs[my_active_reqs['種別'] == '休み希望'].sort_values('日付')
                     if not reds.empty:
                         for i, row in reds.iterrows():
                             with st.container():
                                 c1, c2 = st.columns([4, 2])
-                                c1.write(f"📅 **{row['日付']}**")
+                                c1.write(f"📅 **{row['日付']:%Y-%m-%d}**")
                                 if c2.button("取り消し", key=f"cnl_red_{i}"):
-                                    update_cell_value("変更申請", row['original_idx'], 6, "取り消し")
-                                    st.success("取り消しました"); st.rerun()
+                                    res, msg = update_request_statuses("変更申請", {row['ID']: "取り消し"})
+                                    if res: st.success("取り消しました"); st.rerun()
+                                    else: st.error(msg)
                                 st.markdown("---")
                     else: st.info("申請中のものはありません")
                 else: st.info("申請中のものはありません")
@@ -642,21 +2536,18 @@ def staff_screen():
         if staff_master is not None and not staff_master.empty:
             my_info = staff_master[staff_master['name'] == user_name]
             if not my_info.empty:
-                try: target_holidays = int(my_info.iloc[0]['holiday_target'])
-                except: target_holidays = 0
+                target_holidays = int(my_info.iloc[0]['holiday_target'])
         
         # 2. ログから今年度の消化休日数を計算
         taken_holidays = 0
         df_log = load_data("ログ", ['日付', '曜日'])
         
         if not df_log.empty and user_name in df_log.columns:
-            # 日付型に変換
-            df_log['dt_obj'] = pd.to_datetime(df_log['日付'], errors='coerce')
             # 今年のデータのみ抽出
-            current_year_logs = df_log[df_log['dt_obj'].dt.year == target_y]
+            current_year_logs = df_log[df_log['日付'].dt.year == target_y]
             
-            # '0' が休日なのでカウントする
-            taken_holidays = current_year_logs[user_name].apply(lambda x: 1 if str(x)=='0' else 0).sum()
+            # 0 が休日なのでカウントする
+            taken_holidays = int((current_year_logs[user_name] == 0).sum())
         
         remaining_holidays = target_holidays - taken_holidays
         
@@ -673,27 +2564,36 @@ def staff_screen():
         if not df_log.empty and user_name in df_log.columns:
             my_log = df_log[['日付', '曜日', user_name]].copy()
             my_log.columns = ['日付', '曜日', '勤務']
-            my_log['勤務'] = my_log['勤務'].apply(lambda x: "✅ 出勤" if str(x)=='1' else "🛌 休み")
+            my_log['勤務'] = my_log['勤務'].eq(1).fillna(False).map({True: "✅ 出勤", False: "🛌 休み"})
             
             # 最新の日付が上に来るようにソート
-            my_log['dt_sort'] = pd.to_datetime(my_log['日付'], errors='coerce')
-            my_log = my_log.sort_values('dt_sort', ascending=False).drop(columns=['dt_sort'])
+            my_log = my_log.sort_values('日付', ascending=False)
+            my_log['日付'] = my_log['日付'].dt.date
             
             st.dataframe(my_log, use_container_width=True)
         else: st.info("履歴はありません")
 
+        if FEED_SECRET and not df_log.empty and df_log['日付'].notna().any():
+            with st.expander("📡 カレンダー連携・共有リンク"):
+                feeds = staff_feed_urls(user_name)
+                latest = df_log['日付'].max()
+                st.caption("アプリにログインしなくても見られるリンクです。他の人には教えないでください。")
+                st.markdown(f"- カレンダー登録用 (iCal): `{feeds['ics']}`\n- 確定シフト・休日数 (JSON): `{feeds['json']}`")
+                st.markdown(f"- {latest.year}年{latest.month}月（最新の確定月）の全員のシフト表 (JSON): `{month_feed_url(latest.year, latest.month)}`")
+
 # =========================================================
 # 🔧 管理者画面
 # =========================================================
 def admin_screen():
     st.sidebar.header("管理者メニュー")
+    if TENANT['label']: st.sidebar.caption(f"🏥 {TENANT['label']}")
     if st.sidebar.button("ログアウト"):
         st.session_state.user_role = None
         st.rerun()
     
     if st.sidebar.button("🔄 全データ最新化"):
         with st.spinner("同期中..."):
-            sync_all_data()
+            sync_all_data(force=True)
         st.success("完了")
         st.rerun()
 
@@ -735,6 +2635,18 @@ def admin_screen():
             st.success(f"フェーズを {new_phase} に変更しました")
             st.rerun()
 
+    # -----------------------------------------------------
+    # ⏱️ パフォーマンス計測
+    # -----------------------------------------------------
+    st.sidebar.divider()
+    with st.sidebar.expander("⏱️ パフォーマンス計測"):
+        metrics = get_metrics_store()
+        st.dataframe(metrics.summary(), hide_index=True, use_container_width=True)
+        st.download_button("JSON Linesで書き出す", metrics.to_jsonl(), file_name="metrics.jsonl", mime="application/json")
+        if st.button("計測値をリセット"):
+            metrics.clear()
+            st.rerun()
+
     year = st.session_state.proc_year
     month = st.session_state.proc_month
 
@@ -744,24 +2656,20 @@ def admin_screen():
     # -----------------------------------------------------
     # ヘルパー関数群 (Admin内)
     # -----------------------------------------------------
+    @timed("stats.get_past_week_log_display")
     def get_past_week_log_display(year, month, staff_order):
         df = st.session_state.master_log
         if df is None or df.empty: return None
-        try:
-            df['日付'] = pd.to_datetime(df['日付']).dt.date
-            target_first = datetime.date(year, month, 1)
-            target_start = target_first - datetime.timedelta(days=7)
-            target_end = target_first - datetime.timedelta(days=1)
-            mask = (df['日付'] >= target_start) & (df['日付'] <= target_end)
-            past_df = df.loc[mask].copy()
-            past_df.sort_values('日付', inplace=True)
-            display_past = past_df.set_index('日付').transpose()
-            ordered_index = [s['name'] for s in staff_order if s['name'] in display_past.index]
-            display_past = display_past.reindex(ordered_index)
-            display_past = display_past.applymap(lambda x: "●" if str(x)=='1' else ("-" if str(x)=='0' else x))
-            return display_past
-        except: return None
-
+        def build():
+            target_first = pd.Timestamp(year, month, 1)
+            mask = (df['日付'] >= target_first - pd.Timedelta(days=7)) & (df['日付'] < target_first)
+            past_df = df.loc[mask].sort_values('日付')
+            staff_cols = [s['name'] for s in staff_order if s['name'] in past_df.columns]
+            display_past = past_df.set_index(past_df['日付'].dt.date)[staff_cols].transpose()
+            return to_shift_marks(display_past)
+        return session_memo("past_week_log", df, (year, month, tuple(s['name'] for s in staff_order)), build)
+
+    @timed("stats.calculate_log_summary")
     def calculate_log_summary(staffs_list, target_year):
         df_log = st.session_state.master_log
         summary = []
@@ -770,38 +2678,34 @@ def admin_screen():
                 tgt = int(s.get('holiday_target', 0))
                 summary.append({"名前": s['name'], "付与休日": tgt, "消化休日": 0, "残休日": tgt})
             return pd.DataFrame(summary).set_index("名前")
-        try:
-            df_log['日付'] = pd.to_datetime(df_log['日付']).dt.date
-            current_year_logs = df_log[df_log['日付'].apply(lambda x: x.year == target_year)]
-            for s in staffs_list:
-                nm = s['name']
-                tgt = int(s.get('holiday_target', 0))
-                used = 0
-                if nm in current_year_logs.columns:
-                    used = current_year_logs[nm].apply(lambda x: 1 if str(x)=='0' else 0).sum()
-                summary.append({"名前": nm, "付与休日": tgt, "消化休日": used, "残休日": tgt - used})
-        except: pass
+        current_year_logs = df_log[df_log['日付'].dt.year == target_year]
+        used_by_name = (current_year_logs.drop(columns=['日付', '曜日']) == 0).sum()
+        for s in staffs_list:
+            nm = s['name']
+            tgt = int(s.get('holiday_target', 0))
+            used = int(used_by_name.get(nm, 0))
+            summary.append({"名前": nm, "付与休日": tgt, "消化休日": used, "残休日": tgt - used})
         return pd.DataFrame(summary).set_index("名前")
 
+    @timed("stats.calculate_detailed_stats")
     def calculate_detailed_stats(current_df, staffs_list, year, month):
-        past_holidays = {s['name']: 0 for s in staffs_list}
         ldf = st.session_state.master_log
-        if ldf is not None and not ldf.empty:
-            try:
-                ldf['日付'] = pd.to_datetime(ldf['日付']).dt.date
-                start_of_target = datetime.date(year, month, 1)
-                past_logs = ldf[(ldf['日付'] < start_of_target) & (ldf['日付'].apply(lambda x: x.year == year))]
+        def count_past_holidays():
+            past_holidays = {s['name']: 0 for s in staffs_list}
+            if ldf is not None and not ldf.empty:
+                start_of_target = pd.Timestamp(year, month, 1)
+                past_logs = ldf[(ldf['日付'] < start_of_target) & (ldf['日付'].dt.year == year)]
+                off_by_name = (past_logs.drop(columns=['日付', '曜日']) == 0).sum()
                 for s in staffs_list:
-                    nm = s['name']
-                    if nm in past_logs.columns:
-                        past_holidays[nm] = past_logs[nm].apply(lambda x: 1 if str(x)=='0' else 0).sum()
-            except: pass
+                    past_holidays[s['name']] = int(off_by_name.get(s['name'], 0))
+            return past_holidays
+        past_holidays = session_memo("past_holidays", ldf, (year, month, tuple(s['name'] for s in staffs_list)), count_past_holidays)
+        month_off_by_name = (current_df == 0).sum(axis=1)
         stats_data = []
         for s in staffs_list:
             nm = s['name']
             if nm not in current_df.index: stats_data.append({}); continue
-            shifts = current_df.loc[nm].values
-            month_off = sum(1 for v in shifts if str(v) == '0')
+            month_off = int(month_off_by_name[nm])
             target = int(s.get('holiday_target', 0))
             p_off = past_holidays.get(nm, 0)
             total_off = p_off + month_off
@@ -809,22 +2713,16 @@ def admin_screen():
             stats_data.append({"名前": nm, "付与休日": target, "消化休日": total_off, "残休日": remaining})
         return pd.DataFrame(stats_data).set_index("名前")
 
-    def calculate_daily_stats(schedule_df, staff_list, year, month, required_map=None):
+    @timed("stats.calculate_daily_stats")
+    def calculate_daily_stats(schedule_df, staff_list, ctx, required_map=None):
         staff_map = {s['name']: s for s in staff_list}
         daily_matrix = {col: [] for col in schedule_df.columns}
-        wd_jp = ["月","火","水","木","金","土","日"]
+        if required_map is None: required_map = ctx.required_map
         for col in schedule_df.columns:
-            try:
-                d_obj = pd.to_datetime(f"{year}/{col}").date()
-                w_str = wd_jp[d_obj.weekday()]
-                day_idx = d_obj.day - 1
-            except:
-                w_str = "-"
-                day_idx = -1
-            req_num = 4
-            if required_map and day_idx in required_map:
-                req_num = required_map[day_idx]
-            working_people = schedule_df.index[schedule_df[col].astype(str) == '1'].tolist()
+            day_idx = ctx.index_of(col)
+            w_str = "-" if day_idx is None else ctx.weekday_labels[day_idx]
+            req_num = required_map.get(day_idx, DEFAULT_REQUIRED)
+            working_people = schedule_df.index[schedule_df[col].eq(1).fillna(False)].tolist()
             c_total = len(working_people)
             c_en = sum(1 for name in working_people if name in staff_map and staff_map[name]['en'])
             c_jp = sum(1 for name in working_people if name in staff_map and staff_map[name]['jp'])
@@ -842,36 +2740,32 @@ def admin_screen():
         "📜 ⑤履歴・ログ"
     ])
 
-    first_weekday, num_days = calendar.monthrange(year, month)
-    all_days = range(num_days)
+    ctx = get_month_context(year, month)
+    num_days = ctx.num_days
+    all_days = ctx.days
 
     staff_df = st.session_state.master_staff
     if staff_df is None: staff_df = pd.DataFrame(columns=['id','password','name','role','en','jp','vet','holiday_target'])
     
     active_staff_df = staff_df[staff_df['role'] == 'staff']
     staffs = active_staff_df.to_dict('records')
-    staff_name_to_index = {s['name']: i for i, s in enumerate(staffs)}
-    all_staff = range(len(staffs))
 
-    ph_indices = set()
-    ph_df = st.session_state.master_ph
-    if ph_df is not None and not ph_df.empty:
-        try:
-            ph_df['date'] = pd.to_datetime(ph_df['date']).dt.date
-            for _, r in ph_df.iterrows():
-                if r['date'].year == year and r['date'].month == month:
-                    ph_indices.add(r['date'].day - 1)
-        except: pass
+    ph_indices = ctx.ph_indices
+
+    # 各タブはフラグメントにして、タブ内の操作ではそのタブだけを再実行する。
+    # データを書き換えるボタンは従来どおり st.rerun() で画面全体を更新する
 
     # --- Tab1: 準備 ---
-    with tab_input:
+    @st.fragment
+    def render_input_tab():
         st.markdown("### 1. 準備フェーズ")
         
         with st.expander("🔗 スプレッドシートを開く", expanded=True):
-            st.markdown(f"- [データ管理シート (Google Sheets)]({URL_REQUEST_DB})")
+            st.markdown(f"- [データ管理シート (Google Sheets)]({TENANT['sheet_url']})")
 
         st.caption("※ id, password, role 列がスタッフマスタに必要です")
 
+        ph_df = st.session_state.master_ph
         c1, c2 = st.columns(2)
         with c1:
             st.subheader("👥 スタッフマスタ")
@@ -884,7 +2778,8 @@ def admin_screen():
         with c2:
             st.subheader("㊗️ 公休マスタ")
             if ph_df is None: ph_df = pd.DataFrame(columns=['date','name'])
-            edited_p = st.data_editor(ph_df, num_rows="dynamic", key="p_ed")
+            edited_p = st.data_editor(ph_df, num_rows="dynamic", key="p_ed",
+                                      column_config={"date": st.column_config.DateColumn(format="YYYY-MM-DD")})
             if st.button("公休情報をクラウドに保存"):
                 save_data("公休マスタ", edited_p)
                 st.session_state.master_ph = edited_p
@@ -893,18 +2788,17 @@ def admin_screen():
         st.divider()
         st.subheader(f"📥 申請状況 ({year}年{month}月)")
         
-        req_off_filtered = pd.DataFrame()
-        req_chg_filtered = pd.DataFrame()
-
-        if st.session_state.req_off_data is not None and not st.session_state.req_off_data.empty:
-            temp = st.session_state.req_off_data.copy()
-            temp['dt'] = pd.to_datetime(temp['日付'], errors='coerce')
-            req_off_filtered = temp[temp['dt'].apply(lambda x: x.year == year and x.month == month if pd.notnull(x) else False)].drop(columns=['dt'])
-
-        if st.session_state.req_chg_data is not None and not st.session_state.req_chg_data.empty:
-            temp = st.session_state.req_chg_data.copy()
-            temp['dt'] = pd.to_datetime(temp['日付'], errors='coerce')
-            req_chg_filtered = temp[temp['dt'].apply(lambda x: x.year == year and x.month == month if pd.notnull(x) else False)].drop(columns=['dt'])
+        req_off_filtered = rows_in_month(st.session_state.req_off_data, year, month)
+        req_chg_filtered = rows_in_month(st.session_state.req_chg_data, year, month)
+
+        # 確定済みの月の申請はアーカイブにあるので、指定された時だけ読み込む
+        archived_events = pd.DataFrame(columns=REQUEST_EVENT_HEADERS)
+        if st.toggle("確定済み（アーカイブ）の申請も表示", key="show_archived_requests"):
+            off_arc, off_ev = load_archived_requests("希望休", year, month)
+            chg_arc, chg_ev = load_archived_requests("変更申請", year, month)
+            req_off_filtered = pd.concat([off_arc, req_off_filtered]) if not req_off_filtered.empty else off_arc
+            req_chg_filtered = pd.concat([chg_arc, req_chg_filtered]) if not req_chg_filtered.empty else chg_arc
+            archived_events = pd.concat([off_ev, chg_ev]).sort_values('タイムスタンプ', kind='stable')
 
         c_r, c_c = st.columns(2)
         with c_r:
@@ -916,8 +2810,19 @@ def admin_screen():
             if not req_chg_filtered.empty: st.dataframe(req_chg_filtered, use_container_width=True)
             else: st.info(f"{month}月の変更申請はありません")
 
+        with st.expander("🧾 申請の操作履歴"):
+            events = load_request_events()
+            events = events[(events['日付'].dt.year == year) & (events['日付'].dt.month == month)]
+            if not archived_events.empty:
+                events = pd.concat([archived_events.astype(object), events.astype(object)], ignore_index=True)
+            if not events.empty: st.dataframe(events.iloc[::-1], hide_index=True, use_container_width=True)
+            else: st.info(f"{month}月の操作履歴はありません")
+
+    with tab_input: render_input_tab()
+
     # --- Tab2: 作成 ---
-    with tab_create:
+    @st.fragment
+    def render_create_tab():
         data_key = f"data_req_{year}_{month}"
         
         st.markdown(f"### 2. {year}年{month}月 仮シフト作成")
@@ -925,27 +2830,7 @@ def admin_screen():
         
         # ① 初期ロード修正対応: 即座にデータを読み込む
         if data_key not in st.session_state:
-            req_sheet_data = load_data("draft_requirements")
-            init_data = []
-            wd_jp = ["月","火","水","木","金","土","日"]
-            
-            saved_map = {}
-            if not req_sheet_data.empty:
-                for _, row in req_sheet_data.iterrows():
-                    try:
-                        # 日付文字列をパースして比較
-                        d_obj = pd.to_datetime(row['日付']).date()
-                        if d_obj.year == year and d_obj.month == month:
-                            count = int(row['必要人数'])
-                            saved_map[str(d_obj)] = count
-                    except: pass
-
-            for d in all_days:
-                date_obj = datetime.date(year, month, d+1)
-                w = wd_jp[date_obj.weekday()]
-                val = saved_map.get(str(date_obj), 4)
-                init_data.append({"日付": date_obj, "曜日": w, "必要人数": val})
-            st.session_state[data_key] = pd.DataFrame(init_data, columns=["日付", "曜日", "必要人数"])
+            st.session_state[data_key] = pd.DataFrame({"日付": ctx.dates, "曜日": ctx.weekday_labels, "必要人数": ctx.requirements.copy()})
 
         edited_req_df = st.data_editor(
             st.session_state[data_key],
@@ -962,9 +2847,7 @@ def admin_screen():
         if st.button("☁️ 必要人数をクラウド保存", type="secondary"):
             if edited_req_df is not None and not edited_req_df.empty:
                 st.session_state[data_key] = edited_req_df
-                save_df = edited_req_df.copy()
-                save_df['日付'] = save_df['日付'].astype(str)
-                res, msg = update_requirements_sheet(save_df)
+                res, msg = update_requirements_sheet(edited_req_df)
                 if res: st.success(msg)
                 else: st.error(f"保存エラー: {msg}")
 
@@ -978,27 +2861,18 @@ def admin_screen():
         is_dec = (month == 12)
         req_holidays = 0 if is_dec else st.number_input("必要休日数", 8, 20, 11)
 
-        prev_month_history = {}
-        past_holidays_count = {s['name']: 0 for s in staffs}
-        ldf = st.session_state.master_log
-        if ldf is not None and not ldf.empty:
-            try:
-                ldf['日付'] = pd.to_datetime(ldf['日付']).dt.date
-                first_date = datetime.date(year, month, 1)
-                for i in reversed(range(1, 5)):
-                    td = first_date - datetime.timedelta(days=i)
-                    r = ldf[ldf['日付'] == td]
-                    if not r.empty:
-                        for idx, s in enumerate(staffs):
-                            prev_month_history[(idx, -i)] = int(r.iloc[0][s['name']]) if s['name'] in r.columns else 0
-                    else:
-                        for idx, _ in enumerate(staffs): prev_month_history[(idx, -i)] = 0
-                y_logs = ldf[ldf['日付'].apply(lambda x: x.year) == year]
-                p_logs = y_logs[y_logs['日付'].apply(lambda x: x.month) != month]
-                for s in staffs:
-                    if s['name'] in p_logs.columns:
-                        past_holidays_count[s['name']] = (p_logs[s['name']].astype(str) == '0').sum()
-            except: pass
+        staff_names = [s['name'] for s in staffs]
+        prev_work, prior_off = month_history(ctx, staff_names)
+        lookback = prev_work.shape[1]
+        prev_month_history = {(idx, j - lookback): int(prev_work[idx, j]) for idx in range(len(staffs)) for j in range(lookback)}
+        past_holidays_count = {nm: int(n) for nm, n in zip(staff_names, prior_off)}
+
+        decompose = st.checkbox("👥 大人数向けの分割計算", value=len(staffs) >= shift_solver.DECOMPOSE_MIN_STAFF,
+                                help=f"スタッフをグループに分けて解きます（{shift_solver.DECOMPOSE_MIN_STAFF}人以上で既定ON）。"
+                                     f"制限時間はグループ数に比例し、今の人数で約{shift_solver.decomposed_time_limit(len(staffs)):.0f}秒です。候補は1件になります")
+        c_k, c_dist = st.columns(2)
+        pool_k = c_k.number_input("候補数（2以上で、互いに異なる候補を並べて比較）", 1, 5, 1, disabled=decompose)
+        min_dist = c_dist.number_input("候補どうしの最低差分（セル数）", 1, 200, 10, disabled=(pool_k == 1 or decompose))
 
         if st.button("🚀 計算実行", type="primary"):
             st.session_state.daily_reqs = current_req_map
@@ -1006,107 +2880,117 @@ def admin_screen():
             if not staffs: st.error("スタッフがいません")
             else:
                 with st.spinner("AI計算中..."):
-                    model = cp_model.CpModel()
-                    shifts = {}
-                    obj_terms = []
-
-                    for s in all_staff:
-                        for d in all_days: shifts[(s, d)] = model.NewBoolVar(f's{s}d{d}')
-                    
-                    for d in ph_indices:
-                        for s in all_staff: model.Add(shifts[(s, d)] == 0)
-
-                    if req_off_filtered is not None and not req_off_filtered.empty:
-                        for _, r in req_off_filtered.iterrows():
-                            if r.get('ステータス') == '取り消し': continue
-                            try:
-                                do = pd.to_datetime(r['日付']).date()
-                                if do.year==year and do.month==month and r['名前'] in staff_name_to_index:
-                                    model.Add(shifts[(staff_name_to_index[r['名前']], do.day-1)] == 0)
-                            except: continue
-
-                    if month==1 and num_days>=4:
-                        if 3 not in ph_indices:
-                            for s in all_staff: model.Add(shifts[(s, 3)] == 1)
-
-                    weekend_idx = [d for d in all_days if d not in ph_indices and (first_weekday+d)%7 >= 5]
-
-                    for d in all_days:
-                        if d in ph_indices: continue
-                        if month==1 and d==3: continue
-                        dw = sum(shifts[(s, d)] for s in all_staff)
-                        min_req = current_req_map.get(d, 4)
-                        model.Add(dw >= min_req)
-                        model.Add(dw <= min_req + 2)
-                        is_perfect = model.NewBoolVar(f'perf_{d}')
-                        model.Add(dw == min_req).OnlyEnforceIf(is_perfect)
-                        model.Add(dw != min_req).OnlyEnforceIf(is_perfect.Not())
-                        obj_terms.append(is_perfect.Not() * 50)
-                        model.Add(sum(shifts[(s,d)] for s in all_staff if staffs[s]['jp']) >= 1)
-                        model.Add(sum(shifts[(s,d)] for s in all_staff if staffs[s]['en']) >= 1)
-                        model.Add(sum(shifts[(s,d)] for s in all_staff if staffs[s]['vet']) >= 1)
-
-                    for si, sv in enumerate(staffs):
-                        off = sum(1 - shifts[(si, d)] for d in all_days)
-                        # 12月ロジックの修正: 「ちょうど使い切る」ように制約強化
-                        if is_dec:
-                            tgt = int(sv.get('holiday_target', 139))
-                            pst = past_holidays_count.get(sv['name'], 0)
-                            # 必要な休日数を計算（マイナスにならないよう0以上、月日数を超えないよう上限設定）
-                            ned = min(num_days, max(0, tgt - pst))
-                            
-                            # 制約: 必要数以上とる (実質、必要数に近づける)
-                            model.Add(off >= ned)
-                            # 目的関数: 超過分を最小化する（＝必要数ピッタリに近づける）
-                            obj_terms.append((off - ned) * 200) 
-                        else:
-                            model.Add(off >= req_holidays)
-                            model.Add(off <= req_holidays + 1)
-                            obj_terms.append((off - req_holidays) * 100)
-                        
-                        def gsv(s_i, d_i):
-                            if d_i < 0: return prev_month_history.get((s_i, d_i), 0)
-                            elif d_i < num_days: return shifts[(s_i, d_i)]
-                            return 0
-                        
-                        for start in range(-4, num_days - 4):
-                            w_v = [gsv(si, start+i) for i in range(5)]
-                            if any(isinstance(v, cp_model.IntVar) for v in w_v):
-                                model.Add(sum(w_v) <= 4)
-                        
-                        if month != 1:
-                            for d in range(num_days - 2):
-                                is3off = model.NewBoolVar(f'o3_{si}_{d}')
-                                model.Add(sum(shifts[(si, d+i)] for i in range(3))==0).OnlyEnforceIf(is3off)
-                                model.Add(sum(shifts[(si, d+i)] for i in range(3))>0).OnlyEnforceIf(is3off.Not())
-                                obj_terms.append(is3off * 50)
-                        
-                        for d in range(1, num_days-1):
-                            if month==1 and d==3: continue
-                            model.AddBoolOr([shifts[(si, d-1)], shifts[(si, d+1)]]).OnlyEnforceIf(shifts[(si, d)])
-
-                        if weekend_idx:
-                             wc = model.NewIntVar(0, len(weekend_idx), f'wc_{si}')
-                             model.Add(wc == sum(shifts[(si, d)] for d in weekend_idx))
-                             sq = model.NewIntVar(0, len(weekend_idx)**2, f'sq_{si}')
-                             model.AddMultiplicationEquality(sq, [wc, wc])
-                             obj_terms.append(sq * 200)
-
-                    model.Minimize(sum(obj_terms))
-                    solver = cp_model.CpSolver()
-                    solver.parameters.max_time_in_seconds = 15.0
-                    status = solver.Solve(model)
-
-                    if status in [cp_model.OPTIMAL, cp_model.FEASIBLE]:
-                        res = {}
-                        for d in all_days:
-                            res[f"{month}/{d+1}"] = [solver.Value(shifts[(s,d)]) for s in all_staff]
-                        df_res = pd.DataFrame(res, index=[s['name'] for s in staffs])
-                        st.session_state.schedule_df = df_res
-                        st.success("計算完了。下のボタンで保存してください")
+                    problem = build_shift_problem(ctx, staffs, current_req_map, req_holidays, is_dec,
+                                                  prev_month_history, past_holidays_count, st.session_state.req_off_data)
+                    if decompose:
+                        results = []
+                        result = solve_in_queue(problem, decompose=True)
+                    elif pool_k > 1:
+                        results = solve_in_queue(problem, pool_k, min_dist)
+                        result = results[0] if results else {"status": "INFEASIBLE", "feasible": False, "build_seconds": 0.0, "solve_seconds": 0.0}
+                    else:
+                        results = []
+                        result = solve_in_queue(problem)
+                    metrics = get_metrics_store()
+                    metrics.record("solver.build", result['build_seconds'], staff=len(staffs), days=num_days)
+                    metrics.record("solver.solve", result['solve_seconds'], staff=len(staffs), days=num_days, status=result['status'], candidates=len(results), decomposed=decompose)
+                    st.session_state.solution_pool = [(f"候補{i+1}", problem, r) for i, r in enumerate(results) if r['feasible']]
+
+                    if result['feasible']:
+                        st.session_state.schedule_df = schedule_frame(ctx, problem, result)
+                        st.success("計算完了。下のボタンで保存してください"
+                                   + (f"（候補{len(results)}件。下の比較から差し替えできます）" if len(results) > 1 else ""))
+                    elif result['status'].startswith("ERROR"):
+                        st.error(f"計算中にエラーが発生しました：{result['status']}")
+                    elif result['status'] == "UNKNOWN":
+                        st.error("作成失敗：制限時間内に条件を満たす解が見つかりませんでした（解がないとは限りません）。もう一度実行するか、条件を見直してください")
                     else:
                         st.error("作成失敗：条件を見直してください")
 
+        pool_runs = runs_for_month(st.session_state.solution_pool, ctx, staffs)
+        if len(pool_runs) > 1:
+            with st.expander(f"🔀 候補の比較 ({len(pool_runs)}件)", expanded=True):
+                summary_df, per_staff_df = compare_scenarios(ctx, pool_runs)
+                summary_df.insert(3, "候補1との差分", [r['distance'] for _, _, r in pool_runs])
+                summary_df = summary_df.rename(columns={"シナリオ": "候補"})
+                st.dataframe(summary_df, hide_index=True, use_container_width=True)
+                st.dataframe(per_staff_df, use_container_width=True)
+                for (nm, problem, res), col in zip(pool_runs, st.columns(len(pool_runs))):
+                    with col:
+                        st.caption(f"{nm}（目的関数 {res['objective']}）")
+                        st.dataframe(to_shift_marks(schedule_frame(ctx, problem, res)))
+                c_pick, c_btn = st.columns([2, 1])
+                picked = c_pick.selectbox("仮シフトにする候補", [r[0] for r in pool_runs])
+                if c_btn.button("🔀 この候補に差し替え"):
+                    nm, problem, res = next(r for r in pool_runs if r[0] == picked)
+                    st.session_state.schedule_df = schedule_frame(ctx, problem, res)
+                    st.success(f"{picked}を仮シフトにしました。下のボタンで保存してください")
+                    st.rerun()
+
+        with st.expander("🧪 シナリオ比較（条件違いをまとめて計算）"):
+            st.caption(f"最大{SCENARIO_MAX}件の条件を同時に計算して比較します。増員日は「{ctx.labels[0]}, {ctx.labels[1]}」のように指定してください。"
+                       + ("（12月は必要休日数の代わりに年間休日から計算します）" if is_dec else ""))
+            scenario_key = f"scenario_specs_{year}_{month}"
+            if scenario_key not in st.session_state:
+                st.session_state[scenario_key] = pd.DataFrame([{"名前": "基準", "必要休日数": req_holidays, "増員日": "", "増員数": 1, "希望休を外す": None}])
+            specs_df = st.data_editor(
+                st.session_state[scenario_key],
+                num_rows="dynamic",
+                use_container_width=True,
+                hide_index=True,
+                column_config={
+                    "名前": st.column_config.TextColumn(required=True),
+                    "必要休日数": st.column_config.NumberColumn(min_value=0, max_value=31, step=1, format="%d"),
+                    "増員日": st.column_config.TextColumn(),
+                    "増員数": st.column_config.NumberColumn(min_value=-5, max_value=10, step=1, format="%d"),
+                    "希望休を外す": st.column_config.SelectboxColumn(options=[s['name'] for s in staffs]),
+                },
+                key=f"scenario_editor_{year}_{month}"
+            )
+
+            if st.button("🧪 シナリオを同時に計算"):
+                specs = specs_df.dropna(subset=['名前']).to_dict('records')
+                if len(specs) > SCENARIO_MAX:
+                    st.warning(f"先頭の{SCENARIO_MAX}件のみ計算します")
+                    specs = specs[:SCENARIO_MAX]
+                if not staffs: st.error("スタッフがいません")
+                elif specs:
+                    base = build_shift_problem(ctx, staffs, current_req_map, req_holidays, is_dec,
+                                               prev_month_history, past_holidays_count, st.session_state.req_off_data)
+                    try:
+                        problems = [(str(sp['名前']), apply_scenario(ctx, base, sp)) for sp in specs]
+                    except ValueError as e:
+                        st.error(str(e)); problems = []
+                    if problems:
+                        with st.spinner(f"{len(problems)}件を同時に計算中..."):
+                            with timed_span("solver.scenarios", scenarios=len(problems), staff=len(staffs), days=num_days):
+                                results = run_scenarios(problems)
+                        by_name = dict(problems)
+                        st.session_state.scenario_runs = [(nm, by_name[nm], res) for nm, res in results]
+
+            runs = runs_for_month(st.session_state.scenario_runs, ctx, staffs)
+            if runs:
+                summary_df, per_staff_df = compare_scenarios(ctx, runs)
+                st.markdown("##### ▼ 比較結果")
+                st.dataframe(summary_df, hide_index=True, use_container_width=True)
+                if not per_staff_df.empty:
+                    st.markdown("##### ▼ スタッフ別 休日数・週末出勤")
+                    st.dataframe(per_staff_df, use_container_width=True)
+
+                feasible = [nm for nm, _, res in runs if res['feasible']]
+                if feasible:
+                    c_pick, c_btn = st.columns([2, 1])
+                    picked = c_pick.selectbox("仮シフトに採用するシナリオ", feasible)
+                    if c_btn.button("⬆️ このシナリオを採用"):
+                        nm, problem, res = next(r for r in runs if r[0] == picked)
+                        st.session_state.schedule_df = schedule_frame(ctx, problem, res)
+                        # 増員した必要人数も引き継ぐ
+                        st.session_state[data_key] = pd.DataFrame({"日付": ctx.dates, "曜日": ctx.weekday_labels,
+                                                                   "必要人数": [problem['required'].get(d, DEFAULT_REQUIRED) for d in all_days]})
+                        st.session_state.daily_reqs = problem['required']
+                        st.success(f"「{picked}」を仮シフトに採用しました。下のボタンで保存してください")
+                        st.rerun()
+
         display_df = None
         is_unsaved = False
 
@@ -1132,6 +3016,7 @@ def admin_screen():
                     
                     st.success("仮シフトを保存し、フェーズを「1_追加申請」に変更しました！")
                     st.session_state.schedule_df = None
+                    st.session_state.solution_pool = []
                     st.rerun()
 
             c_past, c_curr = st.columns([1, 3])
@@ -1145,10 +3030,10 @@ def admin_screen():
 
             with c_curr:
                 st.caption(f"{month}月 仮シフト")
-                st.dataframe(display_df.replace({1:"●",0:"-"}))
+                st.dataframe(to_shift_marks(display_df))
             
             st.markdown("##### ▼ 日別スタッフ配置数")
-            st.dataframe(calculate_daily_stats(display_df, staffs, year, month, current_req_map))
+            st.dataframe(calculate_daily_stats(display_df, staffs, ctx, current_req_map))
 
             st.markdown("##### ▼ 休日取得状況 (予測)")
             stats_df = calculate_detailed_stats(display_df, staffs, year, month)
@@ -1156,17 +3041,19 @@ def admin_screen():
         else:
             st.info("仮シフトデータはありません")
 
+    with tab_create: render_create_tab()
+
     # --- Tab3: 追加申請処理 (Phase 1) ---
-    with tab_phase1:
+    @st.fragment
+    def render_phase1_tab():
         st.markdown(f"### 3. 追加申請の反映 ({year}年{month}月)")
         st.info("「出勤希望」の申請を処理します。原則すべて受け入れます。")
         
         if current_phase == "1_追加申請":
-            req_chg = load_data("変更申請")
+            req_chg = load_requests("変更申請")
             target_reqs = []
             if not req_chg.empty:
-                req_chg['dt'] = pd.to_datetime(req_chg['日付'], errors='coerce')
-                mask = (req_chg['dt'].dt.year == year) & (req_chg['dt'].dt.month == month) & \
+                mask = (req_chg['日付'].dt.year == year) & (req_chg['日付'].dt.month == month) & \
                        (req_chg['種別'] == '出勤希望') & (req_chg['ステータス'] == '申請')
                 target_reqs = req_chg[mask].to_dict('records')
             
@@ -1177,36 +3064,44 @@ def admin_screen():
                 disp_cols = ['名前','日付']
                 if '備考' in pd.DataFrame(target_reqs).columns: disp_cols.append('備考')
                 st.dataframe(pd.DataFrame(target_reqs)[disp_cols], use_container_width=True)
-                
+
+            # 反映後の仮シフトを作り、ソルバーと同じ規則で点検する（新たに出る違反だけ表示）
+            df_draft = load_data("draft_schedule")
+            proposed, cnt, added_violations = None, 0, pd.DataFrame(columns=VIOLATION_COLUMNS)
+            if not df_draft.empty:
+                current = df_draft.set_index(df_draft.columns[0])
+                proposed = current.copy()
+                for r in target_reqs:
+                    nm = r['名前']
+                    d_str = ctx.label_of(r['日付'])
+                    if nm in proposed.index and d_str in proposed.columns:
+                        proposed.at[nm, d_str] = 1
+                        cnt += 1
+                if cnt:
+                    names = list(current.index)
+                    with timed_span("rules.phase1", cells=proposed.size):
+                        added_violations = new_violations(check_draft_rules(ctx, current, names), check_draft_rules(ctx, proposed, names))
+
+            force_apply = False
+            if not added_violations.empty:
+                st.warning(f"⚠️ 反映するとルール違反が{len(added_violations)}件発生します")
+                st.dataframe(added_violations, hide_index=True, use_container_width=True)
+                force_apply = st.checkbox("違反を確認した上で反映する", key="phase1_force")
+
             st.markdown("---")
             if st.button("追加申請を反映（あれば）して、Phase2へ移行", type="primary"):
-                df_draft = load_data("draft_schedule")
-                
-                if df_draft.empty:
+                if proposed is None:
                     st.error("仮シフトがありません")
+                elif not added_violations.empty and not force_apply:
+                    st.error("ルール違反があります。内容を確認し、チェックを入れてから実行してください")
                 else:
-                    df_draft = df_draft.set_index(df_draft.columns[0])
-                    cnt = 0
+                    df_draft = proposed
                     if target_reqs:
-                        for r in target_reqs:
-                            nm = r['名前']
-                            d_str = f"{r['dt'].month}/{r['dt'].day}"
-                            if nm in df_draft.index and d_str in df_draft.columns:
-                                df_draft.at[nm, d_str] = '1'
-                                cnt += 1
-                        
                         save_df = df_draft.copy()
                         save_df.insert(0, "名前", save_df.index)
                         save_data("draft_schedule", save_df)
                         
-                        for idx in req_chg.index:
-                            row = req_chg.loc[idx]
-                            if row['dt'].year == year and row['dt'].month == month and \
-                               row['種別'] == '出勤希望' and row['ステータス'] == '申請':
-                                req_chg.at[idx, 'ステータス'] = '承認'
-                        
-                        if 'dt' in req_chg.columns: del req_chg['dt']
-                        save_data("変更申請", req_chg)
+                        update_request_statuses("変更申請", {r['ID']: '承認' for r in target_reqs})
                     
                     update_single_config("current_phase", "2_削減申請")
                     st.success(f"{cnt}件を反映し、フェーズを「2_削減申請」に変更しました！")
@@ -1214,17 +3109,19 @@ def admin_screen():
         else:
             st.info(f"現在は「{current_phase}」のため、この機能は使用できません。")
 
+    with tab_phase1: render_phase1_tab()
+
     # --- Tab4: 削減申請処理 (Phase 2) ---
-    with tab_phase2:
+    @st.fragment
+    def render_phase2_tab():
         st.markdown(f"### 4. 削減申請の処理 ({year}年{month}月)")
         st.info("「休み希望」の申請を処理します。重複や条件割れは抽選で却下されます。")
         
         if current_phase == "2_削減申請":
-            req_chg = load_data("変更申請")
+            req_chg = load_requests("変更申請")
             reduce_reqs = []
             if not req_chg.empty:
-                req_chg['dt'] = pd.to_datetime(req_chg['日付'], errors='coerce')
-                mask = (req_chg['dt'].dt.year == year) & (req_chg['dt'].dt.month == month) & \
+                mask = (req_chg['日付'].dt.year == year) & (req_chg['日付'].dt.month == month) & \
                        (req_chg['種別'] == '休み希望') & (req_chg['ステータス'] == '申請')
                 reduce_reqs = req_chg[mask].to_dict('records')
                 
@@ -1246,60 +3143,58 @@ def admin_screen():
                 logs = []
                 approved_count = 0
                 rejected_count = 0
+                decisions = {}
                 
                 if reduce_reqs:
                     random.shuffle(reduce_reqs)
-                    req_map = {}
-                    req_df = load_data("draft_requirements")
-                    if not req_df.empty:
-                        for _, r in req_df.iterrows():
-                            try:
-                                d = pd.to_datetime(r['日付'])
-                                if d.year == year and d.month == month:
-                                    req_map[d.day - 1] = int(r['必要人数'])
-                            except: pass
                     
                     for r in reduce_reqs:
                         nm = r['名前']
-                        d_str = f"{r['dt'].month}/{r['dt'].day}"
-                        day_idx = r['dt'].day - 1
-                        ts_key = r['タイムスタンプ']
+                        d_str = ctx.label_of(r['日付'])
+                        day_idx = ctx.index_of(d_str)
                         
                         if nm not in df_draft.index or d_str not in df_draft.columns: continue
-                        if str(df_draft.at[nm, d_str]) == '0': continue
+                        if not is_on(df_draft.at[nm, d_str]): continue
                             
                         current_col = df_draft[d_str].to_dict()
-                        current_col[nm] = '0'
-                        is_ok, reason = check_daily_constraints(staffs, current_col, req_map, day_idx)
-                        row_idx_in_df = req_chg[req_chg['タイムスタンプ'] == ts_key].index
+                        current_col[nm] = 0
+                        is_ok, reason = check_daily_constraints(staffs, current_col, ctx.required_map, day_idx)
                         
                         if is_ok:
-                            df_draft.at[nm, d_str] = '0'
+                            df_draft.at[nm, d_str] = 0
                             approved_count += 1
                             logs.append(f"✅ 承認: {nm} {d_str}")
-                            if not row_idx_in_df.empty: req_chg.at[row_idx_in_df[0], 'ステータス'] = '承認'
+                            decisions[r['ID']] = '承認'
                         else:
                             rejected_count += 1
                             logs.append(f"❌ 却下: {nm} {d_str} ({reason})")
-                            if not row_idx_in_df.empty: req_chg.at[row_idx_in_df[0], 'ステータス'] = '却下'
+                            decisions[r['ID']] = '却下'
                     
-                    if 'dt' in req_chg.columns: del req_chg['dt']
-                    save_data("変更申請", req_chg)
+                    update_request_statuses("変更申請", decisions)
                 
                 # --- 2. 確定ログ保存処理 ---
                 new_logs = []
                 for c in df_draft.columns:
-                    try:
-                        dt = pd.to_datetime(f"{year}/{c}").date()
-                        wd = ["月","火","水","木","金","土","日"][dt.weekday()]
-                        row_dict = {"日付": dt, "曜日": wd}
-                        for nm in df_draft.index:
-                            row_dict[nm] = df_draft.at[nm, c]
-                        new_logs.append(row_dict)
-                    except: pass
+                    d = ctx.index_of(c)
+                    if d is None: continue
+                    row_dict = {"日付": ctx.dates[d], "曜日": ctx.weekday_labels[d]}
+                    for nm in df_draft.index:
+                        row_dict[nm] = df_draft.at[nm, c]
+                    new_logs.append(row_dict)
                 
                 if new_logs:
                     update_log_sheet(pd.DataFrame(new_logs))
+
+                    # 長期集計用アーカイブへ書き出し（必要人数はシートを消す前に控える）
+                    month_reqs = load_data("draft_requirements", ['日付', '曜日', '必要人数'])
+                    if not month_reqs.empty:
+                        month_reqs = month_reqs[(month_reqs['日付'].dt.year == year) & (month_reqs['日付'].dt.month == month)]
+                    try: archive_month(pd.DataFrame(new_logs), month_reqs, st.session_state.master_staff)
+                    except Exception as e: st.warning(f"アーカイブの書き出しに失敗しました: {e}")
+                    # この月までの申請は申請イベントシートから外し、アーカイブシートへ移す
+                    res, msg = archive_request_events(year, month)
+                    if not res: st.warning(f"申請のアーカイブに失敗しました: {msg}")
+
                     clear_sheet_data("draft_schedule")
                     clear_sheet_data("draft_requirements")
                     
@@ -1310,6 +3205,8 @@ def admin_screen():
                     st.balloons()
                     st.session_state.schedule_df = None
                     sync_all_data()
+                    try: publish_feeds(st.session_state.master_log, st.session_state.master_staff, months={(year, month)})
+                    except Exception as e: st.warning(f"配信ファイルの書き出しに失敗しました: {e}")
                     
                     with st.expander("詳細ログ", expanded=True):
                         for l in logs: st.write(l)
@@ -1319,44 +3216,148 @@ def admin_screen():
         else:
             st.info(f"現在は「{current_phase}」のため、この機能は使用できません。")
 
+    with tab_phase2: render_phase2_tab()
+
     # --- Tab5: ログ・最終確定 (編集機能追加・全期間表示) ---
-    with tab_log:
-        st.subheader("📊 確定シフト (全期間)")
+    @st.fragment
+    def render_log_tab():
+        st.subheader("📊 確定シフト")
         
         df_log = st.session_state.master_log
-        if df_log is not None and not df_log.empty:
+        # 日付を読み取れる行が1つもなければ、年月の選択肢が作れないので一覧は出さない
+        if df_log is not None and not df_log.empty and df_log['日付'].isna().all():
+            st.warning("ログの日付を読み取れませんでした。ログシートの日付列（YYYY-MM-DD）を確認してください")
+        elif df_log is not None and not df_log.empty:
+            log_dt = df_log['日付']
+            
+            # 表示・編集する範囲を絞る（履歴が何年分あっても1か月分の表示で済むように）
+            month_keys = sorted({(d.year, d.month) for d in log_dt.dropna()}, reverse=True)
+            c_mode, c_sel = st.columns([1, 2])
+            window_mode = c_mode.radio("表示範囲", ["月を選択", "期間を指定"], horizontal=True, key="log_window_mode")
+            if window_mode == "月を選択":
+                sel_y, sel_m = c_sel.selectbox("年月", month_keys, format_func=lambda ym: f"{ym[0]}年{ym[1]}月", key="log_window_month")
+                in_window = (log_dt.dt.year == sel_y) & (log_dt.dt.month == sel_m)
+                window_label = f"{sel_y}_{sel_m}"
+            else:
+                latest = log_dt.max().date()
+                picked = c_sel.date_input("期間", value=(latest - datetime.timedelta(days=30), latest), key="log_window_range")
+                w_start = picked[0]
+                w_end = picked[-1] if len(picked) > 1 else picked[0]
+                in_window = (log_dt.dt.date >= w_start) & (log_dt.dt.date <= w_end)
+                window_label = f"{w_start}_{w_end}"
+
             # 日付で降順ソート
-            df_log['dt'] = pd.to_datetime(df_log['日付'], errors='coerce')
-            df_sorted = df_log.sort_values('dt', ascending=False).drop(columns=['dt'])
+            window_df = df_log[in_window].sort_values('日付', ascending=False).reset_index(drop=True)
             
             st.markdown("##### ▼ 編集モード")
             st.info("日付と曜日以外は編集可能です。修正後は必ず「修正内容を保存」ボタンを押してください。")
             
-            # data_editorで全期間表示・編集可能に
-            edited_log = st.data_editor(
-                df_sorted,
+            editor_key = f"log_editor_{window_label}"
+            st.data_editor(
+                window_df,
                 use_container_width=True,
                 disabled=["日付", "曜日"],
-                key="log_editor_full"
+                column_config={"日付": st.column_config.DateColumn(format="YYYY-MM-DD")},
+                key=editor_key
             )
             
+            # 変更されたセル
+            edited_rows = st.session_state.get(editor_key, {}).get("edited_rows", {})
+            changes = {}
+            bad_cells = []
+            for pos, cols in edited_rows.items():
+                d_key = str(window_df.at[int(pos), '日付'].date())
+                for col, val in cols.items():
+                    try: changes[(d_key, col)] = coerce_cell(df_log[col].dtype, val)
+                    except ValueError: bad_cells.append(f"{d_key} {col}: {val}")
+            if bad_cells:
+                st.error("勤務の列には 0/1 などの整数を入力してください: " + "、".join(bad_cells))
+
+            # 変更後のログを規則で点検し、新たに出る違反を保存前に示す
+            row_pos = {str(d.date()): i for i, d in enumerate(log_dt) if pd.notnull(d)}
+            edited_log = df_log.copy()
+            for (d_key, col), val in changes.items():
+                if d_key in row_pos: edited_log.iat[row_pos[d_key], edited_log.columns.get_loc(col)] = val
+            force_save = False
+            added_violations = None
+            if changes:
+                touched_years = {int(d_key[:4]) for d_key, _ in changes}
+                with timed_span("rules.log_edit", years=len(touched_years)):
+                    added_violations = new_violations(check_log_rules(df_log, touched_years), check_log_rules(edited_log, touched_years))
+                if not added_violations.empty:
+                    st.warning(f"⚠️ この修正でルール違反が{len(added_violations)}件発生します")
+                    st.dataframe(added_violations, hide_index=True, use_container_width=True)
+                    force_save = st.checkbox("違反を確認した上で保存する", key=f"log_force_{window_label}")
+                else:
+                    added_violations = None
+
             if st.button("修正内容を保存する"):
-                # 編集されたデータ全体を保存（save_dataで全上書き）
-                save_target = edited_log.copy()
-                # 日付昇順に戻してから保存した方が綺麗
-                save_target['dt'] = pd.to_datetime(save_target['日付'], errors='coerce')
-                save_target = save_target.sort_values('dt', ascending=True).drop(columns=['dt'])
-                
-                res, msg = save_data("ログ", save_target)
-                if res:
-                    st.success("全期間の修正内容を保存しました！")
-                    time.sleep(1)
-                    st.rerun()
+                # 変更されたセルだけを書き込む
+                if bad_cells:
+                    st.error("整数として読めない値があるため保存できません。入力を直してください")
+                elif not changes:
+                    st.info("変更はありません")
+                elif added_violations is not None and not force_save:
+                    st.error("ルール違反があります。内容を確認し、チェックを入れてから保存してください")
                 else:
-                    st.error(f"保存エラー: {msg}")
+                    res, msg = update_log_cells({k: "" if pd.isna(v) else str(v) for k, v in changes.items()})
+                    if res:
+                        # 手元のログにも反映し、変更した月のアーカイブを作り直す
+                        df_log = st.session_state.master_log = edited_log
+                        touched = {d_key[:7] for d_key, _ in changes}
+                        try: archive_month(df_log[log_dt.dt.strftime('%Y-%m').isin(touched)], staff_df=st.session_state.master_staff)
+                        except Exception as e: st.warning(f"アーカイブの更新に失敗しました: {e}")
+                        try: publish_feeds(df_log, st.session_state.master_staff, months={(int(t[:4]), int(t[5:])) for t in touched})
+                        except Exception as e: st.warning(f"配信ファイルの更新に失敗しました: {e}")
+                        st.success(msg)
+                        time.sleep(1)
+                        st.rerun()
+                    else:
+                        st.error(f"保存エラー: {msg}")
         else:
             st.info("ログはありません")
 
-if st.session_state.user_role == "admin": admin_screen()
-elif st.session_state.user_role == "staff": staff_screen()
-else: login_screen()
+        st.divider()
+        with st.expander("📈 長期集計（アーカイブ）"):
+            st.caption("確定済みの月は年/月ごとのParquetアーカイブにも保存され、ここではシートを読まずに集計します。")
+            years_available = archive_years()
+            if not years_available:
+                st.info("アーカイブはまだありません。下のボタンで既存のログから作成できます。")
+            else:
+                sel_years = st.multiselect("対象年", years_available, default=years_available[-1:])
+                st.markdown("##### ▼ スタッフ別 年間集計")
+                st.dataframe(archive_staff_summary(sel_years), hide_index=True, use_container_width=True)
+                daily_sum = archive_daily_summary(sel_years)
+                short_days = daily_sum[daily_sum['不足']]
+                st.markdown(f"##### ▼ 人数・スキル不足日 ({len(short_days)}日)")
+                if not short_days.empty: st.dataframe(short_days, use_container_width=True)
+
+            if st.button("ログ全体からアーカイブを再構築"):
+                n = archive_month(st.session_state.master_log, staff_df=st.session_state.master_staff)
+                st.success(f"{n}日分をアーカイブに書き出しました")
+
+        with st.expander("📡 確定シフトの配信ファイル"):
+            st.caption("月の確定時とログの修正時に自動で書き出されます。スタッフは確定シフト画面のリンクから、アプリを開かずに閲覧・カレンダー登録できます。")
+            if not FEED_SECRET:
+                st.info("secrets に feed_secret が設定されていないため、配信ファイルは書き出しません。")
+            else:
+                if not FEED_BASE_URL:
+                    st.caption("secrets に public_base_url（アプリの公開URL）を設定すると、スタッフに完全なURLを表示できます。")
+                st.caption("作り直すと、今のログに対応しないファイル（退職者や鍵を変える前のリンク）は削除されます。")
+                if st.button("ログ全体から配信ファイルを作り直す"):
+                    n = publish_feeds(st.session_state.master_log, st.session_state.master_staff)
+                    st.success(f"{n}ファイルを書き出しました")
+
+    with tab_log: render_log_tab()
+
+read_only_banner = st.empty()
+
+if st.session_state.user_role == "admin":
+    with timed_span("screen.admin"): admin_screen()
+elif st.session_state.user_role == "staff":
+    with timed_span("screen.staff"): staff_screen()
+else:
+    with timed_span("screen.login"): login_screen()
+
+if is_read_only():
+    read_only_banner.error(READ_ONLY_MESSAGE + "（表示中のデータは最後に取得できた時点のものです）")
@@ -0,0 +1,495 @@
+# 負荷試験ハーネス
+# Streamlit の AppTest で app.py をヘッドレスに動かし、N人のスタッフが同時に
+# 希望休・変更申請の送信/取り消しを行う状況を再現する。
+# Google Sheets の代わりにプロセス内の偽バックエンド（遅延・429注入あり）を使うので、
+# 本番のシートや認証情報は不要。
+#
+#   python loadtest.py --users 20 --rounds 3 --latency 0.15 --error-rate 0.02
+#
+# 出力: 操作ごとの再実行レイテンシ(p50/p95/最大)、操作あたりのバックエンド呼び出し数、
+#       セッションあたりのメモリ。--json で結果をファイルにも書き出す。
+#
+# 同時実行には Streamlit の内部（Runtime のシングルトンと ScriptCache）への差し込みが要るため、
+# 動作を確かめた Streamlit のバージョン（TESTED_STREAMLIT）でだけ行う。
+#   pip install "streamlit>=1.37,<1.67"
+# それ以外のバージョンや --serial のときは公開APIの AppTest だけで1セッションずつ順に動かす。
+
+import argparse
+import calendar
+import collections
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import gspread
+from google.oauth2.service_account import Credentials
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+SESSION_TAG = "_loadtest_user"   # 偽バックエンドが呼び出し元のユーザーを識別するためのキー
+TESTED_STREAMLIT = ((1, 37), (1, 66))   # 同時実行の差し込みを確かめた Streamlit の範囲（両端を含む）
+
+
+# =========================================================
+# 🧪 偽バックエンド（gspread の必要な部分だけを実装）
+# =========================================================
+
+class _Response:
+    def __init__(self, code):
+        self.status_code = code
+        self.text = str(code)
+
+    def json(self):
+        return {"error": {"code": self.status_code, "message": "injected by loadtest", "status": "RESOURCE_EXHAUSTED"}}
+
+
+def _a1_to_rowcol(a1):
+    m = re.match(r"([A-Z]+)(\d+)", a1)
+    col = 0
+    for ch in m.group(1): col = col * 26 + ord(ch) - 64
+    return int(m.group(2)), col
+
+
+class FakeBackend:
+    """シート全体の状態・遅延・429注入・呼び出し回数の集計を持つ"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.sheets = {}
+        self.calls = collections.Counter()            # (ユーザー, メソッド) → 回数
+        self.injected = 0
+
+    def call(self, method):
+        """1回のAPI呼び出し: 遅延を入れ、一定確率で429を返す"""
+        user = _current_user()
+        with self.lock:
+            self.calls[(user, method)] += 1
+            fail = self.rng.random() < self.error_rate
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            if fail: self.injected += 1
+        if delay: time.sleep(delay)
+        if fail: raise gspread.exceptions.APIError(_Response(429))
+
+    def user_calls(self, user):
+        with self.lock:
+            return sum(n for (u, _), n in self.calls.items() if u == user)
+
+
+def _current_user():
+    """呼び出し中のスクリプトのセッションに付けたユーザー名（なければ"-"）"""
+    try:
+        import streamlit as st
+        return st.session_state.get(SESSION_TAG, "-")
+    except Exception:
+        return "-"
+
+
+class FakeWorksheet:
+    def __init__(self, backend, title):
+        self.backend = backend
+        self.title = title
+        self.rows = []
+
+    def _pad(self, r, c):
+        while len(self.rows) < r: self.rows.append([])
+        row = self.rows[r - 1]
+        while len(row) < c: row.append("")
+
+    def row_values(self, i):
+        self.backend.call("row_values")
+        with self.backend.lock:
+            return list(self.rows[i - 1]) if len(self.rows) >= i else []
+
+    def get_all_values(self, *args, **kwargs):
+        self.backend.call("get_all_values")
+        with self.backend.lock:
+            return [list(r) for r in self.rows]
+
+    def get_all_records(self, *args, **kwargs):
+        self.backend.call("get_all_records")
+        with self.backend.lock:
+            if not self.rows: return []
+            header = self.rows[0]
+            out = []
+            for r in self.rows[1:]:
+                r = list(r) + [""] * (len(header) - len(r))
+                out.append({header[i]: r[i] for i in range(len(header))})
+            return out
+
+    def append_row(self, row, **kwargs):
+        self.backend.call("append_row")
+        with self.backend.lock:
+            self.rows.append(["" if v is None else str(v) for v in row])
+
+    def append_rows(self, rows, **kwargs):
+        self.backend.call("append_rows")
+        with self.backend.lock:
+            self.rows.extend(["" if v is None else str(v) for v in row] for row in rows)
+
+    def clear(self):
+        self.backend.call("clear")
+        with self.backend.lock:
+            self.rows = []
+
+    def _write(self, range_name, values):
+        r0, c0 = _a1_to_rowcol((range_name or "A1").split(":")[0])
+        for i, row in enumerate(values):
+            for j, v in enumerate(row):
+                self._pad(r0 + i, c0 + j)
+                self.rows[r0 + i - 1][c0 + j - 1] = "" if v is None else str(v)
+
+    def update(self, *args, values=None, range_name=None, **kwargs):
+        self.backend.call("update")
+        if values is None: range_name, values = args[0], args[1]
+        with self.backend.lock:
+            self._write(range_name, values)
+
+    def update_cell(self, row, col, value):
+        self.backend.call("update_cell")
+        with self.backend.lock:
+            self._pad(row, col)
+            self.rows[row - 1][col - 1] = str(value)
+
+    def batch_update(self, data, **kwargs):
+        self.backend.call("batch_update")
+        with self.backend.lock:
+            for d in data: self._write(d['range'], d['values'])
+
+
+class FakeSpreadsheet:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def worksheet(self, title):
+        self.backend.call("worksheet")
+        if title not in self.backend.sheets: raise gspread.exceptions.WorksheetNotFound(title)
+        return self.backend.sheets[title]
+
+    def add_worksheet(self, title, rows=0, cols=0):
+        self.backend.call("add_worksheet")
+        with self.backend.lock:
+            return self.backend.sheets.setdefault(title, FakeWorksheet(self.backend, title))
+
+    def values_get(self, range_name, *args, **kwargs):
+        self.backend.call("values_get")
+        title = range_name.split("!")[0].strip("'")
+        if title not in self.backend.sheets: raise gspread.exceptions.APIError(_Response(400))
+        # 'シート'!A5:I のような開始行指定に対応する（列の指定は無視）
+        m = re.search(r"![A-Z]+(\d+)", range_name)
+        start = int(m.group(1)) - 1 if m else 0
+        with self.backend.lock:
+            return {"range": range_name, "values": [list(r) for r in self.backend.sheets[title].rows[start:]]}
+
+
+class FakeClient:
+    def __init__(self, backend):
+        self.spreadsheet = FakeSpreadsheet(backend)
+
+    def open_by_url(self, url):
+        self.spreadsheet.backend.call("open_by_url")
+        return self.spreadsheet
+
+
+def install_fake_backend(backend):
+    """gspread の認証と接続を偽バックエンドに差し替える（app.py は無変更のまま）"""
+    gspread.authorize = lambda creds: FakeClient(backend)
+    Credentials.from_service_account_info = staticmethod(lambda *args, **kwargs: object())
+
+
+def seed_backend(backend, users, year, month, phase):
+    """スタッフマスタ・システム設定・仮シフトを用意する"""
+    def sheet(title, rows):
+        ws = FakeWorksheet(backend, title)
+        ws.rows = [list(map(str, r)) for r in rows]
+        backend.sheets[title] = ws
+
+    staff_rows = [['id', 'password', 'name', 'role', 'en', 'jp', 'vet', 'holiday_target']]
+    for i in range(users):
+        staff_rows.append([f"u{i}", "p", f"S{i}", "staff", i % 2 == 1, i % 2 == 0, i % 4 < 2, 120])
+    staff_rows = [[str(v).upper() if isinstance(v, bool) else v for v in r] for r in staff_rows]
+    sheet("スタッフマスタ", staff_rows)
+    sheet("system_config", [["key", "value"], ["current_phase", phase], ["proc_year", year], ["proc_month", month]])
+
+    num_days = calendar.monthrange(year, month)[1]
+    labels = [f"{month}/{d + 1}" for d in range(num_days)]
+    # 2日出勤・1日休みの繰り返し（人によってずらす）
+    draft = [["名前"] + labels] + [[f"S{i}"] + [0 if (d + i) % 3 == 2 else 1 for d in range(num_days)] for i in range(users)]
+    sheet("draft_schedule", draft)
+
+
+# =========================================================
+# 👥 セッションの操作
+# =========================================================
+
+def streamlit_version():
+    import streamlit
+    return tuple(int(p) for p in re.findall(r"\d+", streamlit.__version__)[:2])
+
+
+def allow_concurrent_apptests():
+    """AppTest は実行のたびに Runtime のシングルトンを差し替えて最後に None に戻すため、
+    複数スレッドで同時に動かすと他のセッションの実行中に Runtime が消える。
+    最後に作られた Runtime を参照し続けるようにして同時実行できるようにする。
+    Streamlit の内部に依存するので TESTED_STREAMLIT の範囲外では何もせず False を返す"""
+    lo, hi = TESTED_STREAMLIT
+    if not lo <= streamlit_version() <= hi: return False
+    from streamlit.runtime import Runtime
+    last = {}
+    original = Runtime.instance.__func__
+
+    def instance(cls):
+        if cls._instance is not None:
+            last["runtime"] = cls._instance
+            return cls._instance
+        if "runtime" in last: return last["runtime"]
+        return original(cls)
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or "runtime" in last)
+
+    # Python 3.11 の ast.parse はスレッドから同時に呼ぶと SystemError になることがあるため、
+    # セッションごとのスクリプトのコンパイルは1つずつ行う
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    compile_lock = threading.Lock()
+    get_bytecode = ScriptCache.get_bytecode
+
+    def locked_get_bytecode(self, script_path):
+        with compile_lock:
+            return get_bytecode(self, script_path)
+
+    ScriptCache.get_bytecode = locked_get_bytecode
+    return True
+
+
+def new_session(secrets_timeout):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(APP_PATH, default_timeout=secrets_timeout)
+    at.secrets["admin_password"] = "loadtest"
+    at.secrets["super_admin_pass"] = "loadtest"
+    at.secrets["sheet_url"] = "https://example.invalid/loadtest"
+    at.secrets["gcp_service_account"] = {"type": "service_account"}
+    return at
+
+
+def _button(at, key_prefix=None, label=None):
+    for b in at.button:
+        if key_prefix and (b.key or "").startswith(key_prefix): return b
+        if label and label in b.label: return b
+    return None
+
+
+class SessionDriver:
+    """1人分のセッションを操作し、操作ごとの時間とバックエンド呼び出し数を記録する"""
+
+    def __init__(self, idx, backend, results, year, month, phase, timeout):
+        self.user = f"S{idx}"
+        self.uid = f"u{idx}"
+        self.backend = backend
+        self.results = results
+        self.year, self.month, self.phase = year, month, phase
+        self.rng = random.Random(idx)
+        self.at = new_session(timeout)
+        self.at.session_state[SESSION_TAG] = self.user
+
+    def _action(self, name, prepare=None):
+        if prepare is not None and prepare() is False:
+            self.results.skip(name)
+            return
+        before = self.backend.user_calls(self.user)
+        t0 = time.perf_counter()
+        self.at.run()
+        elapsed = time.perf_counter() - t0
+        errors = [str(e.value)[:200] for e in self.at.exception]
+        self.results.record(name, elapsed, self.backend.user_calls(self.user) - before, errors)
+
+    def login(self):
+        self._action("open", None)
+        def fill():
+            self.at.text_input[0].input(self.uid)
+            self.at.text_input[1].input("p")
+            self.at.button[0].click()
+        self._action("login", fill)
+
+    def _open_tab(self, action, tab):
+        if self.at.radio and self.at.radio[0].value != tab:
+            self._action(action, lambda: self.at.radio[0].set_value(tab))
+
+    def submit_day_off(self):
+        self._open_tab("希望休.タブ表示", "📝 希望休(初期)")
+        day = datetime.date(self.year, self.month, self.rng.randint(1, calendar.monthrange(self.year, self.month)[1]))
+        def fill():
+            self.at.date_input[0].set_value((day, day))
+            _button(self.at, label="送信").click()
+        self._action("希望休.送信", fill)
+
+    def cancel_day_off(self):
+        def fill():
+            b = _button(self.at, key_prefix="can_req_")
+            if b is None: return False
+            b.click()
+        self._action("希望休.取り消し", fill)
+
+    def _change_tab(self):
+        return "➕ 出勤追加申請" if self.phase.startswith("1") else "➖ 休日追加申請"
+
+    def submit_change(self):
+        self._open_tab("変更申請.タブ表示", self._change_tab())
+        def fill():
+            if not self.at.multiselect: return False
+            ms = self.at.multiselect[0]
+            if not ms.options: return False
+            ms.set_value([self.rng.choice(ms.options)])
+            label = "出勤申請を送る" if self.phase.startswith("1") else "休み申請を送る"
+            _button(self.at, label=label).click()
+        self._action("変更申請.送信", fill)
+
+    def cancel_change(self):
+        prefix = "cnl_add_" if self.phase.startswith("1") else "cnl_red_"
+        def fill():
+            b = _button(self.at, key_prefix=prefix)
+            if b is None: return False
+            b.click()
+        self._action("変更申請.取り消し", fill)
+
+    def data_bytes(self):
+        """セッションが保持しているDataFrameのおおよそのサイズ"""
+        total = 0
+        for key in ("master_staff", "master_ph", "master_log", "req_off_data", "req_chg_data", "schedule_df"):
+            try:
+                df = self.at.session_state[key]
+            except KeyError:
+                continue
+            if df is not None and hasattr(df, "memory_usage"):
+                total += int(df.memory_usage(deep=True).sum())
+        return total
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = collections.defaultdict(list)
+        self.calls = collections.defaultdict(list)
+        self.skipped = collections.Counter()
+        self.errors = []
+
+    def record(self, name, seconds, calls, errors):
+        with self.lock:
+            self.latency[name].append(seconds)
+            self.calls[name].append(calls)
+            self.errors.extend((name, e) for e in errors)
+
+    def skip(self, name):
+        with self.lock:
+            self.skipped[name] += 1
+
+    def table(self):
+        def pct(vals, q):
+            vals = sorted(vals)
+            return vals[min(len(vals) - 1, int(round(q * (len(vals) - 1))))]
+        rows = []
+        for name, vals in self.latency.items():
+            calls = self.calls[name]
+            rows.append({
+                "操作": name, "件数": len(vals),
+                "p50(ms)": round(pct(vals, 0.5) * 1000, 1), "p95(ms)": round(pct(vals, 0.95) * 1000, 1),
+                "最大(ms)": round(max(vals) * 1000, 1),
+                "API呼び出し/操作": round(sum(calls) / len(calls), 2), "スキップ": self.skipped[name],
+            })
+        return rows
+
+
+def run_user(driver, rounds):
+    driver.login()
+    for _ in range(rounds):
+        driver.submit_day_off()
+        driver.cancel_day_off()
+        driver.submit_change()
+        driver.cancel_change()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="スタッフ画面の同時アクセス負荷試験（偽バックエンド使用）")
+    parser.add_argument("--users", type=int, default=10, help="同時セッション数")
+    parser.add_argument("--rounds", type=int, default=2, help="1人あたりの 送信/取り消し の繰り返し回数")
+    parser.add_argument("--latency", type=float, default=0.1, help="API呼び出し1回の遅延(秒)")
+    parser.add_argument("--jitter", type=float, default=0.05, help="遅延に加えるランダム幅(秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="429を返す確率")
+    parser.add_argument("--phase", choices=["1_追加申請", "2_削減申請"], default="1_追加申請")
+    parser.add_argument("--timeout", type=float, default=120.0, help="1回の再実行のタイムアウト(秒)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="結果をJSONで書き出すパス")
+    parser.add_argument("--serial", action="store_true", help="Streamlit の内部に手を入れず、1セッションずつ順に動かす")
+    args = parser.parse_args(argv)
+
+    # 非推奨警告などのStreamlitのログは結果の表を埋もれさせるので抑える
+    # （AppTest が実行のたびにログレベルを設定し直すので、ロガー単位ではなく全体で止める）
+    logging.disable(logging.WARNING)
+    if args.json: args.json = os.path.abspath(args.json)
+    # スナップショットやアーカイブは一時ディレクトリに書かせる
+    os.chdir(tempfile.mkdtemp(prefix="kclinic_loadtest_"))
+    today = datetime.date.today()
+    year, month = (today.year + (today.month // 12), today.month % 12 + 1)
+
+    backend = FakeBackend(args.latency, args.jitter, args.error_rate, args.seed)
+    seed_backend(backend, args.users, year, month, args.phase)
+    install_fake_backend(backend)
+    concurrent_ok = not args.serial and allow_concurrent_apptests()
+    if not args.serial and not concurrent_ok:
+        lo, hi = TESTED_STREAMLIT
+        print(f"⚠️ Streamlit {'.'.join(map(str, streamlit_version()))} は同時実行を未確認"
+              f"（確認済み {lo[0]}.{lo[1]}〜{hi[0]}.{hi[1]}）のため、1セッションずつ順に実行します")
+
+    results = Results()
+    tracemalloc.start()
+    mem_before = tracemalloc.get_traced_memory()[0]
+    drivers = [SessionDriver(i, backend, results, year, month, args.phase, args.timeout) for i in range(args.users)]
+
+    t0 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.users if concurrent_ok else 1) as pool:
+        futures = [pool.submit(run_user, d, args.rounds) for d in drivers]
+        for f in futures: f.result()
+    wall = time.perf_counter() - t0
+    mem_after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    report = {
+        "users": args.users, "rounds": args.rounds, "concurrent": concurrent_ok, "latency": args.latency, "error_rate": args.error_rate,
+        "wall_seconds": round(wall, 2),
+        "backend_calls": sum(backend.calls.values()), "injected_429": backend.injected,
+        "memory_per_session_mb": round((mem_after - mem_before) / args.users / 2**20, 2),
+        "session_data_kb": round(sum(d.data_bytes() for d in drivers) / args.users / 1024, 1),
+        "actions": results.table(),
+        "errors": results.errors[:20],
+    }
+
+    print(f"\n同時{args.users}人 x {args.rounds}回  所要 {report['wall_seconds']}秒  "
+          f"API呼び出し {report['backend_calls']}回 (429注入 {report['injected_429']}回)")
+    print(f"セッションあたりメモリ {report['memory_per_session_mb']}MB (うちデータ {report['session_data_kb']}KB)\n")
+    cols = ["操作", "件数", "p50(ms)", "p95(ms)", "最大(ms)", "API呼び出し/操作", "スキップ"]
+    print("\t".join(cols))
+    for row in report["actions"]:
+        print("\t".join(str(row[c]) for c in cols))
+    if results.errors:
+        print(f"\n⚠️ 例外 {len(results.errors)}件:")
+        for name, e in results.errors[:5]: print(f"  [{name}] {e}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if results.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,768 @@
+# シフト作成モデル（CP-SAT）
+# app.py から切り出し、子プロセス（python -m shift_solver）で単独で動くよう Streamlit に依存しない形にしている。
+# 入力の problem は素の dict/list だけで組み立てる（pickle でそのまま子プロセスへ渡すため）
+#
+# problem のキー:
+#   staff            : [{"name", "jp", "en", "vet", "holiday_target"}, ...]
+#   year, month      : 処理年月（モデルは month だけを使い、year は計算結果の取り違え防止用）
+#   num_days         : 日数
+#   ph_indices       : 公休日の日インデックス
+#   weekend_idx      : 公休を除いた土日の日インデックス
+#   required         : {日インデックス: 必要人数}
+#   req_holidays     : 必要休日数（12月以外）
+#   is_dec           : 12月（年間休日の使い切り調整）かどうか
+#   prev_history     : {(スタッフ番号, -i): 前月末i日前の出勤(1/0)}
+#   past_holidays    : {名前: 今年これまでの休日数}
+#   off_requests     : [(スタッフ番号, 日インデックス), ...] 希望休
+
+import concurrent.futures
+import functools
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+from ortools.sat.python import cp_model
+
+DEFAULT_REQUIRED = 4
+TIME_LIMIT = 15.0
+STAFF_CAP_MARGIN = 2     # 必要人数 + この人数 まで
+WINDOW = 5               # 連続 WINDOW 日のうち
+MAX_WORK_IN_WINDOW = 4   # 出勤は MAX_WORK_IN_WINDOW 日まで
+
+# 目的関数の重み
+W_HEADCOUNT = 50
+W_OFF_EXCESS = 100
+W_OFF_EXCESS_DEC = 200
+W_THREE_OFF = 50
+W_WEEKEND = 200
+
+
+def _december_need(problem, sv):
+    tgt = int(sv.get('holiday_target', 139))
+    pst = problem['past_holidays'].get(sv['name'], 0)
+    # 必要な休日数を計算（マイナスにならないよう0以上、月日数を超えないよう上限設定）
+    return min(problem['num_days'], max(0, tgt - pst))
+
+
+# --- 前処理（値の決まっているセルと入れ替え可能なスタッフ） ---
+
+def fixed_cells(problem):
+    """モデルに入れる前に値が決まるセル {(スタッフ番号, 日インデックス): 0/1} と、
+    矛盾して解なしになるセルの一覧を返す（公休・希望休は休み、1月4日は全員出勤）"""
+    n_staff, num_days = len(problem['staff']), problem['num_days']
+    ph_indices = set(problem['ph_indices'])
+    fixed = {}
+    for d in ph_indices:
+        for s in range(n_staff): fixed[(s, d)] = 0
+    for s, d in problem['off_requests']:
+        fixed[(s, d)] = 0
+    conflicts = []
+    if problem['month'] == 1 and num_days >= 4 and 3 not in ph_indices:
+        for s in range(n_staff):
+            if fixed.get((s, 3)) == 0: conflicts.append((s, 3))
+            fixed[(s, 3)] = 1
+    return fixed, conflicts
+
+
+def interchangeable_groups(problem):
+    """互いに入れ替えても制約・目的関数が変わらないスタッフのグループ（2人以上のもの）。
+    スキル・12月の必要休日数・前月末の勤務が同じで、希望休のないスタッフ同士をまとめる"""
+    requested = {s for s, _ in problem['off_requests']}
+    prev = problem['prev_history']
+    groups = {}
+    for s, sv in enumerate(problem['staff']):
+        if s in requested: continue
+        key = (bool(sv['jp']), bool(sv['en']), bool(sv['vet']),
+               _december_need(problem, sv) if problem['is_dec'] else None,
+               tuple(prev.get((s, -i), 0) for i in range(1, WINDOW)))
+        groups.setdefault(key, []).append(s)
+    return [g for g in groups.values() if len(g) > 1]
+
+
+def _add_lex_geq(model, a, b):
+    """行 a が行 b 以上（辞書式順）になる制約。先頭から等しい間は a[d] >= b[d]"""
+    prefix_eq = None
+    for i, (x, y) in enumerate(zip(a, b)):
+        if prefix_eq is None: model.Add(x >= y)
+        else: model.Add(x >= y).OnlyEnforceIf(prefix_eq)
+        if i == len(a) - 1: break
+        # next_eq ⇔ (ここまで等しい) かつ x == y
+        same = model.NewBoolVar("")
+        model.Add(x == y).OnlyEnforceIf(same)
+        model.Add(x != y).OnlyEnforceIf(same.Not())
+        next_eq = model.NewBoolVar("")
+        lits = [same] if prefix_eq is None else [prefix_eq, same]
+        for lit in lits: model.AddImplication(next_eq, lit)
+        model.AddBoolOr([lit.Not() for lit in lits] + [next_eq])
+        prefix_eq = next_eq
+
+
+def _is_const(v):
+    return isinstance(v, int)
+
+
+def _param(params, ct, key, sign=1):
+    """ひな形を作るときに、実行ごとの値 key で範囲をずらす制約を控える（params が None なら何もしない）"""
+    if params is not None: params['bounds'].append((ct.Index(), key, sign))
+
+
+def _add_staff_rules(model, problem, si, shifts, obj_terms, params=None):
+    """スタッフ si 1人分の制約（休日数・連勤・単発出勤）と目的関数の項（休日超過・3連休・週末偏り）を加える。
+    params を渡すと、休日数と前月末の勤務で範囲が変わる制約を控える（モデルのひな形用）"""
+    sv = problem['staff'][si]
+    month = problem['month']
+    num_days = problem['num_days']
+    all_days = range(num_days)
+    weekend_idx = problem['weekend_idx']
+    req_holidays = problem['req_holidays']
+    prev_month_history = problem['prev_history']
+
+    off = sum(1 - shifts[(si, d)] for d in all_days)
+    # 12月ロジックの修正: 「ちょうど使い切る」ように制約強化
+    if problem['is_dec']:
+        ned = _december_need(problem, sv)
+
+        # 制約: 必要数以上とる (実質、必要数に近づける)
+        _param(params, model.Add(off >= ned), ('off', si))
+        # 目的関数: 超過分を最小化する（＝必要数ピッタリに近づける）
+        obj_terms.append((off - ned) * W_OFF_EXCESS_DEC)
+        if params is not None: params['offset'].append((('off', si), -W_OFF_EXCESS_DEC))
+    else:
+        _param(params, model.Add(off >= req_holidays), ('off', si))
+        _param(params, model.Add(off <= req_holidays + 1), ('off', si))
+        obj_terms.append((off - req_holidays) * W_OFF_EXCESS)
+        if params is not None: params['offset'].append((('off', si), -W_OFF_EXCESS))
+
+    def gsv(s_i, d_i):
+        if d_i < 0: return prev_month_history.get((s_i, d_i), 0)
+        elif d_i < num_days: return shifts[(s_i, d_i)]
+        return 0
+
+    for start in range(-(WINDOW - 1), num_days - (WINDOW - 1)):
+        w_v = [gsv(si, start+i) for i in range(WINDOW)]
+        if not all(_is_const(v) for v in w_v):
+            ct = model.Add(sum(w_v) <= MAX_WORK_IN_WINDOW)
+            if start < 0: _param(params, ct, ('prev', si, start), -1)
+
+    if month != 1:
+        for d in range(num_days - 2):
+            window = [shifts[(si, d+i)] for i in range(3)]
+            if all(_is_const(v) for v in window):
+                if sum(window) == 0: obj_terms.append(W_THREE_OFF)
+                continue
+            is3off = model.NewBoolVar(f'o3_{si}_{d}')
+            model.Add(sum(window)==0).OnlyEnforceIf(is3off)
+            model.Add(sum(window)>0).OnlyEnforceIf(is3off.Not())
+            obj_terms.append(is3off * W_THREE_OFF)
+
+    for d in range(1, num_days-1):
+        if month==1 and d==3: continue
+        cur = shifts[(si, d)]
+        if _is_const(cur) and cur == 0: continue
+        neighbors = [shifts[(si, d-1)], shifts[(si, d+1)]]
+        if any(_is_const(v) and v == 1 for v in neighbors): continue
+        neighbors = [v for v in neighbors if not _is_const(v)]
+        if _is_const(cur): model.AddBoolOr(neighbors)
+        else: model.AddBoolOr(neighbors).OnlyEnforceIf(cur)
+
+    if weekend_idx:
+         wc = model.NewIntVar(0, len(weekend_idx), f'wc_{si}')
+         model.Add(wc == sum(shifts[(si, d)] for d in weekend_idx))
+         sq = model.NewIntVar(0, len(weekend_idx)**2, f'sq_{si}')
+         model.AddMultiplicationEquality(sq, [wc, wc])
+         obj_terms.append(sq * W_WEEKEND)
+
+
+def build_model(problem, params=None):
+    """problem から CP-SAT モデルを組み立て、(model, shifts) を返す。
+    値の決まっているセルは変数を作らず 0/1 の定数として shifts に入れ、
+    入れ替え可能なスタッフには辞書式の順序を付けて同じ形の解を探索しないようにする。
+    params を渡すとひな形として組み立てる（実行ごとの値で変わる制約を控え、辞書式の順序は付けない）"""
+    staffs = problem['staff']
+    month = problem['month']
+    num_days = problem['num_days']
+    all_staff = range(len(staffs))
+    all_days = range(num_days)
+    ph_indices = set(problem['ph_indices'])
+    required = problem['required']
+
+    model = cp_model.CpModel()
+    shifts = {}
+    obj_terms = []
+
+    fixed, conflicts = fixed_cells(problem)
+    for s in all_staff:
+        for d in all_days:
+            shifts[(s, d)] = fixed[(s, d)] if (s, d) in fixed else model.NewBoolVar(f's{s}d{d}')
+    # 1月4日の希望休は従来どおり解なしとして扱う
+    if conflicts: model.AddBoolOr([])
+
+    if params is None: _break_symmetry(model, interchangeable_groups(problem), shifts, len(staffs), num_days)
+
+    for d in all_days:
+        if d in ph_indices: continue
+        if month==1 and d==3: continue
+        dw = sum(shifts[(s, d)] for s in all_staff)
+        min_req = required.get(d, DEFAULT_REQUIRED)
+        _param(params, model.Add(dw >= min_req), ('req', d))
+        _param(params, model.Add(dw <= min_req + STAFF_CAP_MARGIN), ('req', d))
+        is_perfect = model.NewBoolVar(f'perf_{d}')
+        for ct, lit in ((model.Add(dw == min_req), is_perfect), (model.Add(dw != min_req), is_perfect.Not())):
+            ct.OnlyEnforceIf(lit)
+            _param(params, ct, ('req', d))
+        obj_terms.append(is_perfect.Not() * W_HEADCOUNT)
+        model.Add(sum(shifts[(s,d)] for s in all_staff if staffs[s]['jp']) >= 1)
+        model.Add(sum(shifts[(s,d)] for s in all_staff if staffs[s]['en']) >= 1)
+        model.Add(sum(shifts[(s,d)] for s in all_staff if staffs[s]['vet']) >= 1)
+
+    for si in all_staff:
+        _add_staff_rules(model, problem, si, shifts, obj_terms, params)
+
+    model.Minimize(sum(obj_terms))
+    return model, shifts
+
+
+def _break_symmetry(model, groups, shifts, n_staff, num_days):
+    """入れ替え可能なスタッフの行に辞書式の順序を付ける（値の決まっていない日だけで比べる）"""
+    free_days = [d for d in range(num_days) if not all(_is_const(shifts[(s, d)]) for s in range(n_staff))]
+    for group in groups:
+        for a, b in zip(group, group[1:]):
+            _add_lex_geq(model, [shifts[(a, d)] for d in free_days], [shifts[(b, d)] for d in free_days])
+
+
+# --- モデルのひな形（同じ月・同じ顔ぶれなら組み立てを使い回す） ---
+# 必要人数・必要休日数・希望休・前月末の勤務だけが違う計算では、制約の形は同じで範囲だけが変わる。
+# そこで値をすべて0にした problem でひな形を1回だけ組み立てておき、実行ごとに複製して
+#   範囲の変わる制約はその値だけ範囲をずらし、希望休のセルは変数の範囲を0に固定し、
+#   目的関数の定数項（休日超過の基準）を足す
+# ことで build_model と同じモデルにする。辞書式の順序（対称性の除去）は入れ替え可能なグループごとに
+# ひな形へ足したものを別に使い回す（必要人数・必要休日数だけを変えた計算ではグループは変わらない）
+
+TEMPLATE_CACHE_SIZE = 8
+
+
+def template_key(problem):
+    """ひな形を使い回せる範囲（月の形と、スタッフの並びとスキル）"""
+    return (problem['month'], problem['num_days'], tuple(sorted(problem['ph_indices'])), tuple(problem['weekend_idx']),
+            bool(problem['is_dec']), tuple((bool(sv['jp']), bool(sv['en']), bool(sv['vet'])) for sv in problem['staff']))
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _model_template(key):
+    """key のひな形 (model, consts, var_index, params) を組み立てる。
+    consts: 公休・1月4日など値の決まっているセル {(スタッフ, 日): 0/1}、var_index: それ以外のセルの変数の番号"""
+    month, num_days, ph_indices, weekend_idx, is_dec, skills = key
+    blank = {
+        "staff": [{"name": str(s), "jp": jp, "en": en, "vet": vet, "holiday_target": 0} for s, (jp, en, vet) in enumerate(skills)],
+        "month": month, "num_days": num_days, "ph_indices": list(ph_indices), "weekend_idx": list(weekend_idx),
+        "required": {d: 0 for d in range(num_days)}, "req_holidays": 0, "is_dec": is_dec,
+        "prev_history": {}, "past_holidays": {}, "off_requests": [],
+    }
+    params = {"bounds": [], "offset": []}
+    model, shifts = build_model(blank, params)
+    consts = {k: v for k, v in shifts.items() if _is_const(v)}
+    var_index = {k: v.Index() for k, v in shifts.items() if not _is_const(v)}
+    return model, consts, var_index, params
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _symmetric_template(key, groups):
+    """ひな形に、入れ替え可能なグループ groups の辞書式の順序を足したモデル（変数の番号はひな形と同じ）"""
+    template, consts, var_index, _ = _model_template(key)
+    if not groups: return template
+    model = template.clone()
+    shifts = dict(consts)
+    for k, i in var_index.items(): shifts[k] = model.get_bool_var_from_proto_index(i)
+    _break_symmetry(model, groups, shifts, len(key[-1]), key[1])
+    return model
+
+
+def _param_value(problem, key):
+    kind = key[0]
+    if kind == 'req': return problem['required'].get(key[1], DEFAULT_REQUIRED)
+    if kind == 'off':
+        sv = problem['staff'][key[1]]
+        return _december_need(problem, sv) if problem['is_dec'] else problem['req_holidays']
+    _, si, start = key
+    return sum(problem['prev_history'].get((si, d), 0) for d in range(start, 0))
+
+
+def _shift_domain(domain, delta):
+    for i, v in enumerate(domain):
+        if v not in (cp_model.INT_MIN, cp_model.INT_MAX): domain[i] = v + delta
+
+
+def instantiate_model(problem):
+    """ひな形の複製に problem の値を当てはめ、build_model と同じ (model, shifts) を返す"""
+    key = template_key(problem)
+    _, consts, var_index, params = _model_template(key)
+    groups = tuple(tuple(g) for g in interchangeable_groups(problem))
+    model = _symmetric_template(key, groups).clone()
+    proto = model.proto
+    values = {}
+    for index, key, sign in params['bounds']:
+        if key not in values: values[key] = _param_value(problem, key)
+        if values[key]: _shift_domain(proto.constraints[index].linear.domain, sign * values[key])
+    proto.objective.offset += sum(coef * _param_value(problem, key) for key, coef in params['offset'])
+
+    shifts = dict(consts)
+    fixed, conflicts = fixed_cells(problem)
+    for k, i in var_index.items():
+        if k in fixed:
+            proto.variables[i].domain[0] = proto.variables[i].domain[1] = fixed[k]
+            shifts[k] = fixed[k]
+        else:
+            shifts[k] = model.get_bool_var_from_proto_index(i)
+    # 1月4日の希望休は従来どおり解なしとして扱う
+    if conflicts: model.AddBoolOr([])
+    return model, shifts
+
+
+def objective_breakdown(problem, schedule):
+    """解（スタッフ×日の 1/0）から目的関数の内訳を計算する（重み込みの点数）"""
+    staffs = problem['staff']
+    month = problem['month']
+    num_days = problem['num_days']
+    ph_indices = set(problem['ph_indices'])
+    required = problem['required']
+
+    headcount = 0
+    for d in range(num_days):
+        if d in ph_indices or (month == 1 and d == 3): continue
+        if sum(row[d] for row in schedule) != required.get(d, DEFAULT_REQUIRED): headcount += W_HEADCOUNT
+
+    off_excess = 0
+    three_off = 0
+    weekend = 0
+    for sv, row in zip(staffs, schedule):
+        off = num_days - sum(row)
+        if problem['is_dec']:
+            off_excess += (off - _december_need(problem, sv)) * W_OFF_EXCESS_DEC
+        else:
+            off_excess += (off - problem['req_holidays']) * W_OFF_EXCESS
+        if month != 1:
+            three_off += sum(W_THREE_OFF for d in range(num_days - 2) if sum(row[d:d+3]) == 0)
+        weekend += sum(row[d] for d in problem['weekend_idx']) ** 2 * W_WEEKEND
+
+    return {"人数ズレ": headcount, "休日超過": off_excess, "3連休": three_off, "週末偏り": weekend}
+
+
+def solve_shift(problem, time_limit=TIME_LIMIT, num_workers=0):
+    """モデルを組み立てて解く。結果は pickle 可能な dict で返す
+    （num_workers=0 は CP-SAT の既定＝全コア）"""
+    t0 = time.perf_counter()
+    model, shifts = instantiate_model(problem)
+    t1 = time.perf_counter()
+
+    solver = cp_model.CpSolver()
+    solver.parameters.max_time_in_seconds = time_limit
+    if num_workers: solver.parameters.num_workers = num_workers
+    status = solver.Solve(model)
+    t2 = time.perf_counter()
+
+    result = {
+        "status": solver.StatusName(status),
+        "feasible": status in (cp_model.OPTIMAL, cp_model.FEASIBLE),
+        "schedule": None,
+        "objective": None,
+        "breakdown": {},
+        "build_seconds": t1 - t0,
+        "solve_seconds": t2 - t1,
+    }
+    if result["feasible"]:
+        schedule = [[solver.Value(shifts[(s, d)]) for d in range(problem['num_days'])]
+                    for s in range(len(problem['staff']))]
+        result.update(schedule=schedule, objective=int(solver.ObjectiveValue()),
+                      breakdown=objective_breakdown(problem, schedule))
+    return result
+
+
+# --- 多様な候補解（1回の計算で上位K件） ---
+
+class _SolutionCollector(cp_model.CpSolverSolutionCallback):
+    """探索中に見つかった解をすべて控えておくコールバック"""
+
+    def __init__(self, shifts, n_staff, n_days):
+        super().__init__()
+        self.shifts = shifts
+        self.n_staff = n_staff
+        self.n_days = n_days
+        self.solutions = []
+
+    def on_solution_callback(self):
+        schedule = [[self.Value(self.shifts[(s, d)]) for d in range(self.n_days)] for s in range(self.n_staff)]
+        self.solutions.append((int(self.ObjectiveValue()), schedule))
+
+
+def hamming(a, b):
+    """2つの解で異なるセル数"""
+    return sum(x != y for ra, rb in zip(a, b) for x, y in zip(ra, rb))
+
+
+def solve_shift_pool(problem, k=3, min_distance=10, time_limit=TIME_LIMIT, num_workers=0):
+    """互いに min_distance セル以上異なる良い解を最大 k 件返す（目的関数の良い順）。
+    1件目を見つけたら「既出の解から min_distance 以上離れる」制約を足して解き直し、
+    途中で見つかった解もコールバックで集めて最後に貪欲に選ぶ。
+    合計の計算時間は time_limit に収める（半分を1件目に、残りを2件目以降に等分）"""
+    t0 = time.perf_counter()
+    model, shifts = instantiate_model(problem)
+    build_seconds = time.perf_counter() - t0
+    n_staff, n_days = len(problem['staff']), problem['num_days']
+
+    budgets = [time_limit] if k <= 1 else [time_limit / 2] + [time_limit / 2 / (k - 1)] * (k - 1)
+    candidates = []
+    status_name = None
+    solve_seconds = 0.0
+    for budget in budgets:
+        solver = cp_model.CpSolver()
+        solver.parameters.max_time_in_seconds = budget
+        if num_workers: solver.parameters.num_workers = num_workers
+        collector = _SolutionCollector(shifts, n_staff, n_days)
+        t1 = time.perf_counter()
+        status = solver.Solve(model, collector)
+        solve_seconds += time.perf_counter() - t1
+        if status_name is None: status_name = solver.StatusName(status)
+        if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE): break
+
+        best = [[solver.Value(shifts[(s, d)]) for d in range(n_days)] for s in range(n_staff)]
+        candidates.extend(collector.solutions)
+        candidates.append((int(solver.ObjectiveValue()), best))
+        # no-good カット: 次の解はこの解と min_distance セル以上異なること
+        model.Add(sum(shifts[(s, d)] if best[s][d] == 0 else 1 - shifts[(s, d)]
+                      for s in range(n_staff) for d in range(n_days)) >= min_distance)
+
+    picked = []
+    for objective, schedule in sorted(candidates, key=lambda c: c[0]):
+        if all(hamming(schedule, p[1]) >= min_distance for p in picked):
+            picked.append((objective, schedule))
+        if len(picked) >= k: break
+
+    results = []
+    for objective, schedule in picked:
+        results.append({
+            "status": status_name,
+            "feasible": True,
+            "schedule": schedule,
+            "objective": objective,
+            "breakdown": objective_breakdown(problem, schedule),
+            "distance": hamming(schedule, picked[0][1]),
+            "build_seconds": build_seconds,
+            "solve_seconds": solve_seconds,
+        })
+    return results
+
+
+# --- 大人数向けの分割計算 ---
+# 150〜300人規模では全員を1つのモデルで解くと、時間内に良い解が出ないため3段階で解く。
+#   1. 各スキルの人が均等に入るようスタッフをグループに分け、日ごとの必要人数をグループの人数に比例して配る
+#   2. グループごとに、配られた人数を目標にして並列で解く（人数・スキルは罰則にして必ず解があるようにする）
+#   3. 2つのグループ×LNS_WINDOW 日だけを全体の人数で解き直す近傍探索（LNS）で、人数のずれと目的関数を改善する
+#      （人数が合わない日があればその日のまわりを優先して選ぶ）
+# どのモデルも大きさはグループの人数で決まるので、計算時間は人数にほぼ比例する
+
+DECOMPOSE_MIN_STAFF = 60  # これ以上の人数なら分割計算を使う
+GROUP_SIZE = 25           # 1グループの目安人数
+W_COVER = 10000           # 人数・スキルの不足/超過（最終的に0でなければ解なし扱い）
+LNS_STEP = 1.0            # 近傍1回あたりの計算時間(秒)
+LNS_WINDOW = 7            # 近傍で解き直す日数
+DECOMPOSE_TIME_PER_GROUP = 8.0  # 分割計算の制限時間(秒)の1グループあたりの目安
+SKILLS = ("jp", "en", "vet")
+
+
+def decomposed_time_limit(n_staff, group_size=GROUP_SIZE):
+    """分割計算の制限時間。グループ数に比例させ、TIME_LIMIT より短くはしない"""
+    return max(TIME_LIMIT, -(-n_staff // group_size) * DECOMPOSE_TIME_PER_GROUP)
+
+
+def _staffed_days(problem):
+    """人数・スキルの制約がかかる日（公休と1月4日以外）"""
+    ph_indices = set(problem['ph_indices'])
+    return [d for d in range(problem['num_days']) if d not in ph_indices and not (problem['month'] == 1 and d == 3)]
+
+
+def _partition(staffs, n_groups):
+    """スキルの組み合わせごとに、その人たちを n_groups 個のグループへ順番に配る"""
+    groups = [[] for _ in range(n_groups)]
+    order = sorted(range(len(staffs)), key=lambda s: tuple(not staffs[s][k] for k in SKILLS))
+    for i, s in enumerate(order):
+        groups[i % n_groups].append(s)
+    return [sorted(g) for g in groups]
+
+
+def _split_targets(problem, groups):
+    """日ごとの人数の範囲（必要人数〜+STAFF_CAP_MARGIN）をグループの人数に比例して配る。
+    [{日: (下限, 上限)}, ...] を返す。端数は余りの大きいグループから（同じなら日ごとに順番を回して）1人ずつ足す"""
+    n_staff = sum(len(g) for g in groups)
+    n_groups = len(groups)
+
+    def share(total, d):
+        parts = [divmod(total * len(g), n_staff) for g in groups]
+        rest = total - sum(q for q, _ in parts)
+        order = sorted(range(n_groups), key=lambda g: (-parts[g][1], (g - d) % n_groups))
+        out = [q for q, _ in parts]
+        for g in order[:rest]: out[g] += 1
+        return out
+
+    targets = [{} for _ in groups]
+    for d in _staffed_days(problem):
+        min_req = problem['required'].get(d, DEFAULT_REQUIRED)
+        lo, hi = share(min_req, d), share(min_req + STAFF_CAP_MARGIN, d)
+        for g in range(n_groups):
+            targets[g][d] = (lo[g], hi[g])
+    return targets
+
+
+def _solve_subset(problem, free, schedule, targets, time_limit, num_workers, days=None):
+    """free のスタッフだけを解き、(状態名, {スタッフ番号: [1/0, ...]}) を返す（解がなければ 解の部分は None）。
+    schedule が None なら free だけで targets {日: (下限, 上限)} の人数とスキル各1人を目指す（段階2）。
+    schedule があればほかの人（と days 以外の日）はその解で固定し、全体の人数とスキルを目指す（段階3）。
+    人数・スキルは違反を W_COVER の罰則にし、1人ずつの規則は solve_shift と同じく守る"""
+    staffs, num_days = problem['staff'], problem['num_days']
+    free_set = set(free)
+    open_days = set(range(num_days) if days is None else days)
+    others = [s for s in range(len(staffs)) if s not in free_set] if schedule is not None else []
+    fixed, _ = fixed_cells(problem)
+    model = cp_model.CpModel()
+    shifts = {}
+    for s in free:
+        for d in range(num_days):
+            if (s, d) in fixed or d not in open_days:
+                shifts[(s, d)] = fixed[(s, d)] if (s, d) in fixed else schedule[s][d]
+                continue
+            shifts[(s, d)] = model.NewBoolVar(f's{s}d{d}')
+            if schedule is not None: model.AddHint(shifts[(s, d)], schedule[s][d])
+    for s in others:
+        for d in range(num_days): shifts[(s, d)] = schedule[s][d]
+
+    obj_terms = []
+    for d, (lo, hi) in targets.items():
+        base = sum(schedule[s][d] for s in others)
+        cells = [shifts[(s, d)] for s in free]
+        if all(_is_const(v) for v in cells):
+            dw = base + sum(cells)
+            obj_terms.append(W_COVER * max(lo - dw, dw - hi, 0))
+            if schedule is not None and dw != lo: obj_terms.append(W_HEADCOUNT)
+        else:
+            dw = base + sum(cells)
+            short = model.NewIntVar(0, max(lo, 0), '')
+            excess = model.NewIntVar(0, len(staffs), '')
+            model.Add(dw + short >= lo)
+            model.Add(dw - excess <= hi)
+            obj_terms.append((short + excess) * W_COVER)
+            if schedule is not None:
+                is_perfect = model.NewBoolVar('')
+                model.Add(dw == lo).OnlyEnforceIf(is_perfect)
+                model.Add(dw != lo).OnlyEnforceIf(is_perfect.Not())
+                obj_terms.append(is_perfect.Not() * W_HEADCOUNT)
+        for k in SKILLS:
+            if any(schedule[s][d] for s in others if staffs[s][k]): continue
+            cells = [shifts[(s, d)] for s in free if staffs[s][k]]
+            if not cells: continue
+            missing = model.NewBoolVar('')
+            model.Add(sum(cells) + missing >= 1)
+            obj_terms.append(missing * W_COVER)
+    for s in free:
+        _add_staff_rules(model, problem, s, shifts, obj_terms)
+    model.Minimize(sum(obj_terms))
+
+    solver = cp_model.CpSolver()
+    solver.parameters.max_time_in_seconds = time_limit
+    solver.parameters.num_workers = max(1, num_workers)
+    status = solver.Solve(model)
+    if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE): return solver.StatusName(status), None
+    return solver.StatusName(status), {s: [solver.Value(shifts[(s, d)]) for d in range(num_days)] for s in free}
+
+
+def coverage_violations(problem, schedule):
+    """人数（必要人数〜+STAFF_CAP_MARGIN）とスキル（各1人以上）の不足・超過の合計"""
+    x = np.asarray(schedule, dtype=np.int64)
+    days = _staffed_days(problem)
+    count = x[:, days].sum(axis=0)
+    req = np.array([problem['required'].get(d, DEFAULT_REQUIRED) for d in days])
+    total = np.maximum(req - count, 0).sum() + np.maximum(count - req - STAFF_CAP_MARGIN, 0).sum()
+    for k in SKILLS:
+        flag = np.array([bool(sv[k]) for sv in problem['staff']])
+        total += int((x[flag][:, days].sum(axis=0) == 0).sum())
+    return int(total)
+
+
+def _penalty(problem, schedule):
+    """分割計算で比べる点数（目的関数 + 人数・スキル違反の罰則）"""
+    return sum(objective_breakdown(problem, schedule).values()) + coverage_violations(problem, schedule) * W_COVER
+
+
+def solve_shift_decomposed(problem, time_limit=TIME_LIMIT, num_workers=0, group_size=GROUP_SIZE, seed=0):
+    """大人数向けに分割して解く（結果の形は solve_shift と同じ）。グループが1つにしかならない人数なら solve_shift で解く。
+    時間の半分を段階2、残りを段階3 に使い、改善が続かなくなったら打ち切る。
+    status は 解なしが確定したとき（1月4日の希望休・解のないグループ）だけ INFEASIBLE、
+    時間内に人数・スキルを満たせなかったときは UNKNOWN にする"""
+    n_staff = len(problem['staff'])
+    n_groups = -(-n_staff // group_size)
+    if n_groups < 2: return solve_shift(problem, time_limit, num_workers)
+    cores = num_workers or os.cpu_count() or 1
+    t0 = time.perf_counter()
+    deadline = t0 + time_limit
+    result = {"status": "INFEASIBLE", "feasible": False, "schedule": None, "objective": None, "breakdown": {},
+              "build_seconds": 0.0, "solve_seconds": 0.0}
+    # 1月4日の希望休は従来どおり解なしとして扱う
+    if fixed_cells(problem)[1]: return result
+
+    groups = _partition(problem['staff'], n_groups)
+    targets = _split_targets(problem, groups)
+    result['build_seconds'] = time.perf_counter() - t0
+
+    # グループは並列に解く（CP-SATは計算中にGILを手放す）。同時に解く数ぶん1つあたりのコア数を減らす
+    parallel = min(n_groups, cores)
+    group_limit = time_limit * 0.5 * parallel / n_groups
+    schedule = [None] * n_staff
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as ex:
+        solved = list(ex.map(lambda gt: _solve_subset(problem, gt[0], None, gt[1], group_limit, cores // parallel),
+                             zip(groups, targets)))
+    parts = [part for _, part in solved]
+    if any(part is None for part in parts):
+        statuses = {status for status, part in solved if part is None}
+        result['status'] = "INFEASIBLE" if "INFEASIBLE" in statuses else "UNKNOWN"
+        result['solve_seconds'] = time.perf_counter() - t0 - result['build_seconds']
+        return result
+    for part in parts:
+        for s, row in part.items(): schedule[s] = row
+
+    # 2グループ×数日ずつ全体の人数で解き直す。人数が合っていて、ペアの数だけ続けて良くならなければ終える
+    num_days = problem['num_days']
+    overall = {d: (lo, lo + STAFF_CAP_MARGIN)
+               for d, lo in ((d, problem['required'].get(d, DEFAULT_REQUIRED)) for d in _staffed_days(problem))}
+    rng = np.random.default_rng(seed)
+    best = _penalty(problem, schedule)
+    patience = n_groups * (n_groups - 1) // 2
+    stale = 0
+    while time.perf_counter() + 0.1 < deadline:
+        count = np.asarray(schedule).sum(axis=0)
+        bad = [d for d, (lo, hi) in overall.items() if not lo <= count[d] <= hi]
+        if not bad and stale >= patience: break
+        center = int(rng.choice(bad)) if bad else int(rng.integers(num_days))
+        first = min(max(center - LNS_WINDOW // 2, 0), max(num_days - LNS_WINDOW, 0))
+        pick = rng.choice(n_groups, size=2, replace=False)
+        free = sorted(s for g in pick for s in groups[g])
+        _, rows = _solve_subset(problem, free, schedule, overall, min(LNS_STEP, deadline - time.perf_counter()), cores,
+                                days=range(first, min(first + LNS_WINDOW, num_days)))
+        if rows is None:
+            stale += 1
+            continue
+        trial = [rows.get(s, row) for s, row in enumerate(schedule)]
+        score = _penalty(problem, trial)
+        # 同点の解にも移って探索を続ける（改善がなければ打ち切りまでの回数は進める）
+        stale = 0 if score < best else stale + 1
+        if score <= best: schedule, best = trial, score
+
+    result['solve_seconds'] = time.perf_counter() - t0 - result['build_seconds']
+    if coverage_violations(problem, schedule) == 0:
+        breakdown = objective_breakdown(problem, schedule)
+        result.update(status="FEASIBLE", feasible=True, schedule=schedule,
+                      objective=int(sum(breakdown.values())), breakdown=breakdown)
+    else:
+        # 打ち切った時点で人数・スキルが足りないだけで、解がないとは限らない
+        result['status'] = "UNKNOWN"
+    return result
+
+
+# --- ルール検証（ソルバーと同じ規則で、できあがったシフトを点検する） ---
+
+def validate_schedule(schedule, staff, labels, required=None, holidays=None, fixed=None,
+                      prev=None, prior_off=None, off_limit=None, year_end=False):
+    """スタッフ×日の行列（1=出勤, 0=休み, NaN=空欄）をソルバーと同じ規則で点検し、
+    違反を [{"ルール", "名前", "日付", "内容"}] のリストで返す。行列演算だけで判定する。
+
+    required  : 日ごとの必要人数（NaN の日と None は人数チェックをしない）
+    holidays  : 公休日（人数・スキルのチェック対象外）
+    fixed     : 全員出勤日（1月4日。人数・スキル・単発出勤のチェック対象外）
+    prev      : 直前の日々の出勤（スタッフ×日）。5日間の連勤チェックを月をまたいで行う
+    prior_off : 今年のほかの期間の休日数（スタッフごと）
+    off_limit : 年間の付与休日（スタッフごと。inf はチェックしない）
+    year_end  : 年末の月か（付与休日の超過・未消化は年末の月だけ見る）"""
+    x = np.asarray(schedule, dtype=float).reshape(len(staff), len(labels))
+    n_staff, n_days = x.shape
+    work = x == 1
+    names = [s['name'] for s in staff]
+    holidays = np.zeros(n_days, bool) if holidays is None else np.asarray(holidays, bool)
+    fixed = np.zeros(n_days, bool) if fixed is None else np.asarray(fixed, bool)
+    staffed = ~(holidays | fixed)
+    out = []
+
+    def add(rule, s, d, msg):
+        out.append({"ルール": rule, "名前": "-" if s is None else names[s], "日付": labels[d], "内容": msg})
+
+    # 日ごとの人数（必要人数以上、必要人数+STAFF_CAP_MARGIN 以下）
+    count = work.sum(axis=0)
+    if required is not None:
+        req = np.asarray(required, dtype=float)
+        known = staffed & ~np.isnan(req)
+        for d in np.flatnonzero(known & (count < req)):
+            add("人数不足", None, d, f"必要{int(req[d])}人 -> {count[d]}人")
+        for d in np.flatnonzero(known & (count > req + STAFF_CAP_MARGIN)):
+            add("人数超過", None, d, f"上限{int(req[d]) + STAFF_CAP_MARGIN}人 -> {count[d]}人")
+
+    # 日本語・英語・ベテランが毎日1人以上
+    for key, label in (("jp", "日本語話者"), ("en", "英語話者"), ("vet", "ベテラン")):
+        flag = np.array([bool(s[key]) for s in staff], dtype=bool)
+        covered = (work & flag[:, None]).any(axis=0)
+        for d in np.flatnonzero(staffed & ~covered):
+            add(f"{label}不足", None, d, f"{label}が出勤していません")
+
+    # 連続 WINDOW 日のうち出勤は MAX_WORK_IN_WINDOW 日まで（直前の日々も含めて判定）
+    prev = np.zeros((n_staff, 0), bool) if prev is None else (np.asarray(prev, dtype=float).reshape(n_staff, -1) == 1)
+    full = np.concatenate([prev, work], axis=1).astype(np.int32)
+    if full.shape[1] >= WINDOW:
+        csum = np.concatenate([np.zeros((n_staff, 1), np.int32), full.cumsum(axis=1)], axis=1)
+        in_window = csum[:, WINDOW:] - csum[:, :-WINDOW]
+        window_end = np.arange(in_window.shape[1]) + WINDOW - 1 - prev.shape[1]
+        for s, j in np.argwhere((in_window > MAX_WORK_IN_WINDOW) & (window_end >= 0)):
+            add("連勤", s, window_end[j], f"{WINDOW}日間で{in_window[s, j]}日出勤（上限{MAX_WORK_IN_WINDOW}日）")
+
+    # 前後が両方休みの単発出勤はしない（月の両端は対象外）
+    if n_days >= 3:
+        single = work[:, 1:-1] & ~work[:, :-2] & ~work[:, 2:] & ~fixed[None, 1:-1]
+        for s, d in np.argwhere(single):
+            add("単発出勤", s, d + 1, "前後の日が休みです")
+
+    # 年間の付与休日（ソルバーと同じく年末の月だけ見る。途中の月は月ごとの休日数で調整している）
+    if off_limit is not None and year_end:
+        limit = np.asarray(off_limit, dtype=float)
+        total = (x == 0).sum(axis=1) + (0 if prior_off is None else np.asarray(prior_off))
+        for s in np.flatnonzero(total > limit):
+            add("休日超過", s, n_days - 1, f"休日{int(total[s])}日（付与{int(limit[s])}日）")
+        can_take = (x == 0).sum(axis=1) < n_days
+        for s in np.flatnonzero((total < limit) & can_take):
+            add("休日未消化", s, n_days - 1, f"休日{int(total[s])}日（付与{int(limit[s])}日）")
+    return out
+
+
+# --- 子プロセスの入口（python -m shift_solver） ---
+# app.py の実行キューがスレッドごとに1つ起動して使い回す。標準入力から pickle の (関数名, 引数) を順に受け取り、
+# 1件ごとに ("ok", 結果) または ("error", 内容) を pickle で標準出力へ返す。標準入力が閉じられたら終わる。
+# プロセスが生き続けるので、モデルのひな形のキャッシュ（_model_template など）が次の計算でも効く
+
+WORKER_FUNCS = ("solve_shift", "solve_shift_pool", "solve_shift_decomposed")
+
+def worker_main():
+    inp = sys.stdin.buffer
+    # 結果以外の出力（ソルバーのログなど）が混ざらないよう、標準出力は結果の書き出しだけに使う
+    out = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    while True:
+        try:
+            func_name, args = pickle.load(inp)
+        except EOFError:
+            break
+        try:
+            if func_name not in WORKER_FUNCS: raise ValueError(f"unknown solver function: {func_name}")
+            reply = ("ok", globals()[func_name](*args))
+        except Exception as e:
+            reply = ("error", f"{type(e).__name__}: {e}")
+        pickle.dump(reply, out)
+        out.flush()
+    out.close()
+
+if __name__ == "__main__":
+    worker_main()